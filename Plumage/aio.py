@@ -0,0 +1,439 @@
+'''
+Plumage aio:
+    asyncio interface for fetching TSDR data from the PTO (Python 3 only)
+
+The PTO fetch uses asyncio streams, so it never blocks the event loop; the
+CPU-bound processing (unzip, parse, XSLT, mapping) runs in an executor.
+No third-party HTTP library is needed. Keep-alive connections are kept in the
+request's TSDRConnectionPool (by default, the pool shared with the synchronous
+and batch paths), separately for each event loop.
+
+To use:
+    from Plumage import plumage
+    t = plumage.TSDRReq()
+    await t.getTSDRInfoAsync("76044902", "s")
+
+or, for many entries at once:
+    from Plumage import aio
+    async for t in aio.fetchMany([("76044902", "s"), ("2824281", "r")], concurrency=16):
+        ...
+
+For details, see https://github.com/codingatty/Plumage/wiki
+'''
+
+# Copyright 2014-2018 Terry Carroll
+# carroll@tjc.com
+#
+# License information:
+#
+# This program is licensed under Apache License, version 2.0 (January 2004);
+# see http://www.apache.org/licenses/LICENSE-2.0
+# SPX-License-Identifier: Apache-2.0
+#
+# Anyone who makes use of, or who modifies, this code is encouraged
+# (but not required) to notify the author.
+
+import asyncio
+import ssl
+import time
+import urllib.error
+import urllib.parse
+
+from Plumage import plumage
+from Plumage import batch
+
+_REDIRECT_CODES = (301, 302, 303, 307, 308)
+_MAX_REDIRECTS = 5
+_DEFAULT_PORTS = {"http" : 80, "https" : 443}
+_DEFAULT_TIMEOUT = 60     # seconds per request, without a pool (as TSDRConnectionPool's default)
+
+async def getTSDRInfo(t, number, tmtype, executor=None):
+    '''
+    Coroutine equivalent of t.getTSDRInfo(number, tmtype); normally invoked
+    as t.getTSDRInfoAsync(number, tmtype). Returns t.
+
+    Parameters:
+        t: TSDRReq to be filled in
+        number, tmtype: as for TSDRReq.getTSDRInfo
+        executor: concurrent.futures executor for the processing stages;
+            None for the event loop's default executor
+    '''
+    if t._lookupMapCache(number, tmtype):
+        return t
+    t.resetXMLData()
+    body = await _fetchFromPTO(t, number, tmtype)
+    if body is None or t._lookupRevalidatedMap(number, tmtype):
+        return t
+    loop = asyncio.get_event_loop()
+    await loop.run_in_executor(executor, _process, t, body)
+    t._storeMapCache(number, tmtype)
+    return t
+
+async def fetchMany(identifiers, concurrency=8, PTOFormat="zip", XSLT=None,
+                    executor=None, max_pending=None, cache=None, map_cache=None, retry_policy=None,
+                    rate_limiter=None, engine="XSLT", projection=None, retain_zip_data=True,
+                    retention="full", compact_maps=False, record_timings=False):
+    '''
+    Async generator: fetch and process TSDR data for many entries, yielding
+    one TSDRReq per entry, in the order completed.
+
+    As with batch.TSDRBatch.fetchMany, each result carries the usual validity
+    flags and ErrorCode/ErrorMessage, and an exception for one entry is
+    reported on its TSDRReq as ErrorCode "Batch-Exception".
+
+    Parameters:
+        identifiers: iterable of (number, tmtype) pairs, as for TSDRReq.getTSDRInfo
+        concurrency: maximum number of PTO fetches in progress at once
+        PTOFormat: format fetched from the PTO for each entry; see TSDRReq.setPTOFormat
+        XSLT: optional caller-supplied XSLT for each entry; see TSDRReq.setXSLT
+        executor: executor for the processing stages; None for the loop's default
+        max_pending: maximum number of entries started but not yet yielded;
+            defaults to four times concurrency
+        cache: optional TSDRResponseCache for PTO responses; see TSDRReq.setCache
+        map_cache: optional TSDRMapCache of finished TSDR maps; see TSDRReq.setMapCache
+        retry_policy: optional TSDRRetryPolicy for PTO fetches; see TSDRReq.setRetryPolicy
+        rate_limiter: optional TSDRRateLimiter for PTO fetches; see TSDRReq.setRateLimiter
+        engine: "XSLT" or "XPath"; see TSDRReq.setEngine
+        projection: optional names of the fields wanted; see TSDRReq.setProjection
+        retain_zip_data: False to let go of each zip file (and its images) once
+            its XML has been read; see TSDRReq.setRetainZipData
+        retention: "full" or "lean"; see TSDRReq.setRetention
+        compact_maps: True for compact, read-only TSDR maps; see TSDRReq.setCompactMaps
+        record_timings: True to record each TSDRReq's stage timings; see TSDRReq.setRecordTimings
+    '''
+    if concurrency < 1:
+        raise ValueError("concurrency must be at least 1")
+    if max_pending is None:
+        max_pending = 4 * concurrency
+    if max_pending < 1:
+        raise ValueError("max_pending must be at least 1")
+    options = dict(PTOFormat=PTOFormat, XSLT=XSLT, cache=cache, map_cache=map_cache,
+                   retry_policy=retry_policy, rate_limiter=rate_limiter, engine=engine,
+                   projection=projection, retain_zip_data=retain_zip_data,
+                   retention=retention, compact_maps=compact_maps,
+                   record_timings=record_timings)
+    # fail early on a bad option, rather than once per entry
+    batch._configureRequest(plumage.TSDRReq(), **options)
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one(number, tmtype):
+        t = batch._configureRequest(plumage.TSDRReq(), **options)
+        try:
+            if t._lookupMapCache(number, tmtype):
+                return t
+            t.resetXMLData()
+            async with semaphore:
+                body = await _fetchFromPTO(t, number, tmtype)
+            if body is None or t._lookupRevalidatedMap(number, tmtype):
+                return t
+        except Exception as e:
+            batch._recordBatchException(t, "fetch", e)
+            return t
+        try:
+            await asyncio.get_event_loop().run_in_executor(executor, _process, t, body)
+            t._storeMapCache(number, tmtype)
+        except Exception as e:
+            batch._recordBatchException(t, "processing", e)
+        return t
+
+    pending = set()
+    identifiers = iter(identifiers)
+    exhausted = False
+    try:
+        while True:
+            while not exhausted and len(pending) < max_pending:
+                try:
+                    number, tmtype = next(identifiers)
+                except StopIteration:
+                    exhausted = True
+                    break
+                pending.add(asyncio.ensure_future(one(number, tmtype)))
+            if not pending:
+                break
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                yield task.result()
+    finally:
+        for task in pending:
+            task.cancel()
+
+def _process(t, filedata):
+    '''
+    Processing stages (unzip through TSDR map), run in an executor
+    '''
+    t._processFileContents(filedata)
+    t._completeTSDRInfo()
+    return
+
+async def _fetchFromPTO(t, number, tmtype):
+    '''
+    Coroutine equivalent of t._fetchFromPTO(number, tmtype), using t's
+    response cache and connection pool
+    '''
+    started = t._startTiming()
+    body = await _fetchRawFromPTO(t, number, tmtype)
+    t._stopTiming("fetch", started, None if body is None else len(body))
+    return body
+
+async def _fetchRawFromPTO(t, number, tmtype):
+    '''
+    _fetchFromPTO, untimed
+    '''
+    pto_url, cached = await _offLoop(t, t._startPTOFetch, number, tmtype)
+    if cached is not None and cached.fresh:
+        return cached.data
+    request_headers = None
+    if cached is not None:
+        request_headers = cached.conditionalHeaders()
+    status, reason, headers, body = await _fetchWithRetry(t, pto_url, request_headers)
+    return await _offLoop(t, t._finishPTOFetch, number, tmtype, pto_url, cached,
+                          status, reason, headers, body)
+
+async def _offLoop(t, function, *arguments):
+    '''
+    function(*arguments), a step of a PTO fetch, without blocking the event
+    loop: with a response cache, the step reads or writes the cache's files
+    (and may scan its directory, to evict), so it is run in the default
+    executor; without one, it has no I/O, and is run directly
+    '''
+    if t.Cache is None:
+        return function(*arguments)
+    return await asyncio.get_event_loop().run_in_executor(None, function, *arguments)
+
+async def _fetchWithRetry(t, url, request_headers=None):
+    '''
+    Coroutine equivalent of t._fetchURLWithRetry(url, request_headers)
+    '''
+    started = time.time()
+    attempt = 0
+    rate_limiter = t._rateLimiter()
+    try:
+        while True:
+            attempt += 1
+            if rate_limiter is not None:
+                await asyncio.sleep(t._rateLimiterDelay(await _reserve(rate_limiter), started))
+            try:
+                timeout = _attemptTimeout(t, started)
+                if timeout is None:
+                    response = await _fetch(t, url, request_headers)
+                else:
+                    response = await asyncio.wait_for(_fetch(t, url, request_headers), timeout)
+            except Exception as e:
+                delay = t._retryDelay(attempt, started, exception=e)
+                if delay is None:
+                    raise
+            else:
+                delay = t._retryDelay(attempt, started, response=response)
+                if delay is None:
+                    return response
+            await asyncio.sleep(delay)
+    finally:
+        t.FetchAttempts = attempt
+        t.FetchSeconds = time.time() - started
+
+def _attemptTimeout(t, started):
+    '''
+    Timeout for a fetch attempt: the connection pool's timeout (or, without a
+    pool, _DEFAULT_TIMEOUT), capped at the time left before the retry
+    policy's deadline, as for a synchronous fetch (see TSDRConnectionPool.get)
+    '''
+    pool = t.ConnectionPool
+    timeout = _DEFAULT_TIMEOUT if pool is None else pool.timeout
+    remaining = t._attemptTimeout(started)
+    if remaining is not None and (timeout is None or remaining < timeout):
+        timeout = remaining
+    return timeout
+
+async def _reserve(rate_limiter):
+    '''
+    rate_limiter.reserve(), without blocking the event loop: a limiter shared
+    through a file (see TSDRRateLimiter) waits for the file's lock, which
+    another process may hold, so it is reserved in the default executor
+    '''
+    if rate_limiter.path is None:
+        return rate_limiter.reserve()
+    return await asyncio.get_event_loop().run_in_executor(None, rate_limiter.reserve)
+
+async def _fetch(t, url, request_headers=None):
+    '''
+    GET url using t's connection pool (see TSDRReq.setConnectionPool), if any
+    '''
+    pool = t.ConnectionPool
+    if pool is None:
+        return await _http_get(url, t.UNVERIFIED_CONTEXT, None, request_headers)
+    return await _http_get(url, pool.ssl_context, pool, request_headers)
+
+async def _http_get(url, ssl_context=None, pool=None, request_headers=None):
+    '''
+    Minimal HTTP/1.1 GET over asyncio streams, following redirects.
+    If pool (a TSDRConnectionPool) is given, connections are kept alive in it;
+    request_headers is an optional dictionary of additional request headers.
+    Returns (status, reason, headers, body); headers is a dict keyed by
+    lower-cased header name.
+    '''
+    for _ in range(_MAX_REDIRECTS + 1):
+        status, reason, headers, body = await _http_get_once(url, ssl_context, pool,
+                                                             request_headers)
+        if status in _REDIRECT_CODES and "location" in headers:
+            url = urllib.parse.urljoin(url, headers["location"])
+            continue
+        return status, reason, headers, body
+    raise urllib.error.HTTPError(url, status, "too many redirects", headers, None)
+
+class _StreamConnection(object):
+    '''
+    An asyncio stream connection, in the form kept by TSDRConnectionPool
+    '''
+
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.loop = asyncio.get_event_loop()
+
+    def close(self):
+        # the pool may discard a connection from any thread; a transport may
+        # only be touched from its own event loop
+        try:
+            try:
+                running = asyncio.get_running_loop()
+            except RuntimeError:
+                running = None
+            if running is self.loop:
+                self.writer.close()
+            elif not self.loop.is_closed():
+                self.loop.call_soon_threadsafe(self.writer.close)
+            # else: the loop is gone; the transport is closed when collected
+        except Exception:
+            pass
+
+    def is_stale(self):
+        return self.reader.at_eof() or self.writer.transport.is_closing()
+
+    @property
+    def defunct(self):
+        # once its event loop has closed, the connection can never be used again;
+        # the pool drops it (and so its reference to the loop) on its next checkout or checkin
+        return self.loop.is_closed()
+
+async def _http_get_once(url, ssl_context, pool, request_headers=None):
+    parts = urllib.parse.urlsplit(url)
+    scheme = parts.scheme.lower()
+    if scheme not in _DEFAULT_PORTS:
+        raise ValueError("unsupported URL scheme '%s'" % parts.scheme)
+    port = parts.port or _DEFAULT_PORTS[scheme]
+    if scheme == "https":
+        if ssl_context is None:
+            ssl_context = ssl.create_default_context()
+    else:
+        ssl_context = None
+    host_header = parts.hostname
+    if parts.port is not None:
+        host_header = "%s:%s" % (parts.hostname, parts.port)
+    path = parts.path or "/"
+    if parts.query:
+        path = path + "?" + parts.query
+    request = ("GET %s HTTP/1.1\r\n"
+               "Host: %s\r\n"
+               "User-Agent: Plumage-py/%s\r\n"
+               "Accept-Encoding: identity\r\n"
+               "Connection: %s\r\n") % (path, host_header, plumage.__version__,
+                                          "close" if pool is None else "keep-alive")
+    for name, value in sorted((request_headers or {}).items()):
+        request += "%s: %s\r\n" % (name, value)
+    request = (request + "\r\n").encode("latin-1")
+
+    async def connect():
+        if pool is not None:
+            pool._count("connections_opened")
+        reader, writer = await asyncio.open_connection(parts.hostname, port, ssl=ssl_context)
+        return _StreamConnection(reader, writer)
+
+    # stream connections belong to one event loop, so are pooled per loop
+    key = ("asyncio", asyncio.get_event_loop(), scheme, parts.hostname, port)
+    connection = None
+    if pool is not None:
+        connection = pool._checkout(key, _StreamConnection.is_stale)
+    reused = connection is not None
+    if reused:
+        pool._count("connections_reused")
+    else:
+        connection = await connect()
+    try:
+        try:
+            status, reason, headers, body, reusable = await _exchange(connection, request)
+        except (ConnectionError, asyncio.IncompleteReadError):
+            connection.close()
+            if not reused:
+                raise
+            # server closed the pooled connection; retry once on a fresh one
+            pool._count("stale_connections")
+            connection = await connect()
+            status, reason, headers, body, reusable = await _exchange(connection, request)
+    except BaseException:
+        connection.close()
+        raise
+    if pool is not None and reusable:
+        pool._checkin(key, connection)
+    else:
+        connection.close()
+    return status, reason, headers, body
+
+async def _exchange(connection, request):
+    '''
+    Send one request and read its response. Returns (status, reason, headers,
+    body, reusable), where reusable indicates whether the connection can be
+    kept alive for another request.
+    '''
+    connection.writer.write(request)
+    await connection.writer.drain()
+    status, reason, headers = await _read_head(connection.reader)
+    if status in (204, 304) or 100 <= status < 200:
+        body, delimited = b"", True     # no body, whatever the headers say
+    else:
+        body, delimited = await _read_body(connection.reader, headers)
+    reusable = delimited and headers.get("connection", "").lower() != "close"
+    return status, reason, headers, body, reusable
+
+async def _read_head(reader):
+    '''
+    Read the status line and headers of an HTTP response
+    '''
+    status_line = await reader.readline()
+    if status_line == b"":
+        raise ConnectionResetError("connection closed before response received")
+    status_line = status_line.decode("latin-1").rstrip("\r\n")
+    fields = status_line.split(" ", 2)
+    if len(fields) < 2 or not fields[0].startswith("HTTP/") or not fields[1].isdigit():
+        raise ValueError("malformed HTTP status line <%s>" % status_line)
+    status = int(fields[1])
+    reason = fields[2] if len(fields) > 2 else ""
+    headers = {}
+    while True:
+        line = (await reader.readline()).decode("latin-1").rstrip("\r\n")
+        if line == "":
+            break
+        name, _, value = line.partition(":")
+        headers[name.strip().lower()] = value.strip()
+    return status, reason, headers
+
+async def _read_body(reader, headers):
+    '''
+    Read the body of an HTTP response: chunked, by Content-Length, or to end of stream.
+    Returns (body, delimited); delimited is False if the body ran to end of stream
+    '''
+    if headers.get("transfer-encoding", "").lower() == "chunked":
+        chunks = []
+        while True:
+            size_line = (await reader.readline()).decode("latin-1")
+            size = int(size_line.split(";", 1)[0].strip(), 16)
+            if size == 0:
+                # skip any trailers, up to the terminating blank line
+                while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+                    pass
+                break
+            chunks.append(await reader.readexactly(size))
+            await reader.readline()
+        return b"".join(chunks), True
+    if "content-length" in headers:
+        return await reader.readexactly(int(headers["content-length"])), True
+    return await reader.read(), False
@@ -0,0 +1,481 @@
+'''
+Plumage batch:
+    Fetch and process many TSDR entries at once, overlapping network fetches
+    from the PTO with the CPU-bound unzip/XSLT/mapping work
+
+To use:
+    from Plumage import batch
+    b = batch.TSDRBatch(fetch_workers=16)
+    for t in b.fetchMany([("76044902", "s"), ("2824281", "r")]):
+        if t.TSDRData.TSDRMapIsValid:
+            print(t.TSDRData.TSDRSingle["MarkVerbalElementText"])
+        else:
+            print(t.ErrorCode, t.ErrorMessage)
+
+or, to re-run TSDR data already downloaded (a directory, or a tar or zip
+bundle, of content.zip/info.xml files) on a pool of processes:
+    r = batch.TSDRReprocessor(workers=8)
+    for chunk in r.reprocessMany("downloads.tar"):
+        for entry in chunk:
+            print(entry.source, entry.TSDRSingle.get("MarkVerbalElementText"))
+
+For details, see https://github.com/codingatty/Plumage/wiki
+'''
+
+# Copyright 2014-2018 Terry Carroll
+# carroll@tjc.com
+#
+# License information:
+#
+# This program is licensed under Apache License, version 2.0 (January 2004);
+# see http://www.apache.org/licenses/LICENSE-2.0
+# SPX-License-Identifier: Apache-2.0
+#
+# Anyone who makes use of, or who modifies, this code is encouraged
+# (but not required) to notify the author.
+
+from __future__ import print_function
+import collections
+import concurrent.futures
+import json
+import multiprocessing
+import os
+import tarfile
+import zipfile
+
+from Plumage import plumage
+
+class TSDRBatch(object):
+    '''
+    Batch front end to TSDRReq.
+
+    PTO fetches run on a pool of fetch_workers threads; as each fetch completes,
+    the unzip, parse, XSLT and mapping stages for that entry are handed to a
+    separate pool of process_workers threads (lxml releases the GIL while parsing
+    and transforming, so these overlap with each other and with the fetches).
+
+    Each result is a TSDRReq, with the same XMLDataIsValid/CSVDataIsValid/
+    TSDRData.TSDRMapIsValid flags and ErrorCode/ErrorMessage values it would
+    have after TSDRReq.getTSDRInfo(number, tmtype). An exception that
+    getTSDRInfo would have raised (an invalid number, a non-404 HTTP error,
+    a network failure) does not stop the batch; it is reported on that entry's
+    TSDRReq as ErrorCode "Batch-Exception".
+    '''
+
+    def __init__(self, fetch_workers=8, process_workers=None, PTOFormat="zip", XSLT=None,
+                 cache=None, map_cache=None, retry_policy=None, rate_limiter=None,
+                 engine="XSLT", projection=None, retain_zip_data=True,
+                 retention="full", compact_maps=False, record_timings=False):
+        '''
+        Initialize a TSDR batch
+
+        Parameters:
+            fetch_workers: number of concurrent fetches from the PTO
+            process_workers: number of entries processed (unzip through TSDR map)
+                concurrently; defaults to the number of CPUs
+            PTOFormat: format fetched from the PTO for each entry; see TSDRReq.setPTOFormat
+            XSLT: optional caller-supplied XSLT for each entry; see TSDRReq.setXSLT
+            cache: optional TSDRResponseCache for PTO responses; see TSDRReq.setCache
+            map_cache: optional TSDRMapCache of finished TSDR maps; see TSDRReq.setMapCache
+            retry_policy: optional TSDRRetryPolicy for PTO fetches; see TSDRReq.setRetryPolicy
+            rate_limiter: optional TSDRRateLimiter for PTO fetches; see TSDRReq.setRateLimiter
+            engine: "XSLT" or "XPath"; see TSDRReq.setEngine
+            projection: optional names of the fields wanted; see TSDRReq.setProjection
+            retain_zip_data: False to let go of each zip file (and its images) once
+                its XML has been read; see TSDRReq.setRetainZipData
+            retention: "full" or "lean"; see TSDRReq.setRetention
+            compact_maps: True for compact, read-only TSDR maps; see TSDRReq.setCompactMaps
+            record_timings: True to record each TSDRReq's stage timings; see TSDRReq.setRecordTimings
+        '''
+        if fetch_workers < 1:
+            raise ValueError("fetch_workers must be at least 1")
+        if process_workers is None:
+            process_workers = multiprocessing.cpu_count()
+        if process_workers < 1:
+            raise ValueError("process_workers must be at least 1")
+        self.fetch_workers = fetch_workers
+        self.process_workers = process_workers
+        self._options = dict(PTOFormat=PTOFormat, XSLT=XSLT, cache=cache, map_cache=map_cache,
+                             retry_policy=retry_policy, rate_limiter=rate_limiter,
+                             engine=engine, projection=projection,
+                             retain_zip_data=retain_zip_data, retention=retention,
+                             compact_maps=compact_maps, record_timings=record_timings)
+        # fail early on a bad option, rather than once per entry
+        self._newRequest()
+
+    def fetchMany(self, identifiers, ordered=True, max_pending=None):
+        '''
+        Fetch and process TSDR data for many entries; generator yielding one
+        TSDRReq per entry.
+
+        Parameters:
+            identifiers: iterable of (number, tmtype) pairs, as for TSDRReq.getTSDRInfo
+            ordered: True (default) to yield results in input order;
+                False to yield each result as soon as it is complete
+            max_pending: maximum number of entries in progress (fetching, waiting
+                to be processed, or, when ordered, finished but waiting on an
+                earlier entry) at any time; defaults to four times the total
+                number of workers. identifiers is consumed lazily, so a very
+                long (or unbounded) iterable is never held in memory.
+        '''
+        if max_pending is None:
+            max_pending = 4 * (self.fetch_workers + self.process_workers)
+        if max_pending < 1:
+            raise ValueError("max_pending must be at least 1")
+
+        fetch_pool = concurrent.futures.ThreadPoolExecutor(max_workers=self.fetch_workers)
+        process_pool = concurrent.futures.ThreadPoolExecutor(max_workers=self.process_workers)
+        pending = collections.deque()
+        try:
+            identifiers = iter(identifiers)
+            exhausted = False
+            while True:
+                # top up the window of in-progress entries
+                while not exhausted and len(pending) < max_pending:
+                    try:
+                        number, tmtype = next(identifiers)
+                    except StopIteration:
+                        exhausted = True
+                        break
+                    pending.append(self._submit(fetch_pool, process_pool, number, tmtype))
+                if not pending:
+                    break
+                if ordered:
+                    done = pending.popleft()
+                else:
+                    completed, _ = concurrent.futures.wait(
+                        pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                    done = next(f for f in pending if f in completed)
+                    pending.remove(done)
+                yield done.result()
+        finally:
+            # if the caller abandons the generator, at most max_pending entries
+            # are still in progress; let them finish before returning.
+            # Fetch pool first: its completion callbacks feed the process pool
+            fetch_pool.shutdown(wait=True)
+            process_pool.shutdown(wait=True)
+
+    def _newRequest(self):
+        '''
+        Create a TSDRReq configured for this batch
+        '''
+        return _configureRequest(plumage.TSDRReq(), **self._options)
+
+    def _submit(self, fetch_pool, process_pool, number, tmtype):
+        '''
+        Start one entry through the fetch and process pools; returns a Future
+        whose result is the finished TSDRReq
+        '''
+        result = concurrent.futures.Future()
+        result.set_running_or_notify_cancel()
+        t = self._newRequest()
+
+        def process(filedata):
+            try:
+                t._processFileContents(filedata)
+                t._completeTSDRInfo()
+                t._storeMapCache(number, tmtype)
+            except Exception as e:
+                _recordBatchException(t, "processing", e)
+            result.set_result(t)
+
+        def fetched(fetch_future):
+            exception = fetch_future.exception()
+            if exception is not None:
+                _recordBatchException(t, "fetch", exception)
+                result.set_result(t)
+                return
+            filedata = fetch_future.result()
+            if filedata is _MAP_CACHED:
+                result.set_result(t)
+                return
+            if filedata is None:
+                # PTO reported no such entry; ErrorCode/ErrorMessage already set
+                result.set_result(t)
+                return
+            try:
+                process_pool.submit(process, filedata)
+            except RuntimeError as e:
+                # pool shut down because the caller abandoned the batch
+                _recordBatchException(t, "processing", e)
+                result.set_result(t)
+
+        def fetch():
+            if t._lookupMapCache(number, tmtype):
+                return _MAP_CACHED
+            t.resetXMLData()
+            filedata = t._fetchFromPTO(number, tmtype)
+            if filedata is not None and t._lookupRevalidatedMap(number, tmtype):
+                return _MAP_CACHED
+            return filedata
+
+        fetch_pool.submit(fetch).add_done_callback(fetched)
+        return result
+
+_MAP_CACHED = object()     # fetch result: TSDR map was found in the map cache
+
+def _configureRequest(t, PTOFormat="zip", XSLT=None, cache=None, map_cache=None,
+                      retry_policy=None, rate_limiter=None, engine="XSLT", projection=None,
+                      retain_zip_data=True, retention="full", compact_maps=False,
+                      record_timings=False):
+    '''
+    Apply the options of a batch (TSDRBatch, TSDRReprocessor or aio.fetchMany;
+    see TSDRBatch for each) to a TSDRReq, raising ValueError on a bad one.
+    Returns t.
+    '''
+    t.setPTOFormat(PTOFormat)
+    t.setEngine(engine)
+    t.setProjection(projection)
+    t.setRetainZipData(retain_zip_data)
+    t.setRetention(retention)
+    t.setCompactMaps(compact_maps)
+    t.setRecordTimings(record_timings)
+    if XSLT is not None:
+        t.setXSLT(XSLT)
+    t.setCache(cache)
+    t.setMapCache(map_cache)
+    t.setRetryPolicy(retry_policy)
+    t.setRateLimiter(rate_limiter)
+    return t
+
+def _recordBatchException(t, stage, exception):
+    '''
+    Record an exception raised for one entry of a batch on its TSDRReq
+    '''
+    t.XMLDataIsValid = False
+    t.CSVDataIsValid = False
+    t.resetTSDRData()
+    t.ErrorCode = "Batch-Exception"
+    t.ErrorMessage = "fetchMany: exception during %s: %s: %s" % \
+                     (stage, type(exception).__name__, exception)
+    return
+
+class TSDRReprocessor(object):
+    '''
+    Offline bulk front end to TSDRReq: re-runs TSDR data already downloaded
+    (zip files from the PTO, or XML files) through to TSDR maps, on a pool of
+    worker processes, so that throughput scales with the number of CPUs.
+
+    The data is found by walking a directory, or reading a tar or zip bundle
+    (see iterPayloads), and handed to the workers chunk_size entries at a time.
+    Each worker keeps a single TSDRReq for its lifetime, so that each transform
+    is compiled once per worker rather than once per entry. Finished chunks
+    come back as lists of TSDRArchiveResult; no more than max_pending chunks
+    are in progress at any time, so that however large the archive, neither
+    its data nor its results are all held in memory at once.
+
+    As for TSDRBatch, an exception while processing an entry does not stop
+    the run; it is reported on that entry's result as ErrorCode "Batch-Exception".
+    '''
+
+    def __init__(self, workers=None, XSLT=None, engine="XSLT", projection=None):
+        '''
+        Initialize an archive reprocessor
+
+        Parameters:
+            workers: number of worker processes; defaults to the number of CPUs
+            XSLT: optional caller-supplied XSLT for each entry; see TSDRReq.setXSLT
+            engine: "XSLT" or "XPath"; see TSDRReq.setEngine
+            projection: optional names of the fields wanted; see TSDRReq.setProjection
+        '''
+        if workers is None:
+            workers = multiprocessing.cpu_count()
+        if workers < 1:
+            raise ValueError("workers must be at least 1")
+        # fail early on a bad engine or projection, rather than once per entry in each worker
+        _configureRequest(plumage.TSDRReq(), engine=engine, projection=projection)
+        self.workers = workers
+        self.XSLT = XSLT
+        self.engine = engine
+        self.projection = projection
+
+    def reprocessMany(self, source, chunk_size=64, ordered=True, max_pending=None):
+        '''
+        Re-run the TSDR data in source; generator yielding one list of
+        TSDRArchiveResult per chunk of (at most chunk_size) entries.
+
+        Parameters:
+            source: directory, tar file or zip file; see iterPayloads
+            chunk_size: number of entries handed to a worker at a time
+            ordered: True (default) to yield chunks in the order their entries
+                were found; False to yield each chunk as soon as it is complete
+            max_pending: maximum number of chunks in progress (waiting for, or
+                being processed by, a worker, or, when ordered, finished but
+                waiting on an earlier chunk) at any time; defaults to twice the
+                number of workers
+        '''
+        if chunk_size < 1:
+            raise ValueError("chunk_size must be at least 1")
+        if max_pending is None:
+            max_pending = 2 * self.workers
+        if max_pending < 1:
+            raise ValueError("max_pending must be at least 1")
+
+        settings = (self.XSLT, self.engine, self.projection)
+        pool = concurrent.futures.ProcessPoolExecutor(max_workers=self.workers)
+        pending = collections.deque()
+        payloads = iterPayloads(source)
+        try:
+            exhausted = False
+            while True:
+                # top up the window of in-progress chunks
+                while not exhausted and len(pending) < max_pending:
+                    chunk = []
+                    for payload in payloads:
+                        chunk.append(payload)
+                        if len(chunk) == chunk_size:
+                            break
+                    else:
+                        exhausted = True
+                    if chunk:
+                        pending.append((chunk, pool.submit(_reprocessChunk, settings, chunk)))
+                if not pending:
+                    break
+                if ordered:
+                    chunk, done = pending.popleft()
+                else:
+                    completed, _ = concurrent.futures.wait(
+                        [future for _, future in pending],
+                        return_when=concurrent.futures.FIRST_COMPLETED)
+                    chunk, done = next(entry for entry in pending if entry[1] in completed)
+                    pending.remove((chunk, done))
+                yield _chunkResults(chunk, done)
+        finally:
+            payloads.close()
+            pool.shutdown(wait=True)
+
+    def reprocessTo(self, source, sink, chunk_size=64, ordered=True, max_pending=None):
+        '''
+        Re-run the TSDR data in source, as reprocessMany, calling sink (for
+        example, a TSDRJSONLinesSink) with each finished chunk, a list of
+        TSDRArchiveResult. Returns the number of entries processed.
+        '''
+        count = 0
+        for chunk in self.reprocessMany(source, chunk_size, ordered, max_pending):
+            sink(chunk)
+            count += len(chunk)
+        return count
+
+# One re-run entry: its source (see iterPayloads), the same validity flag, TSDR
+# map (TSDRSingle, TSDRMulti), ErrorCode and ErrorMessage a TSDRReq would have
+# after getTSDRInfo, and the SHA-256 of its data (see TSDRReq.PayloadDigest)
+TSDRArchiveResult = collections.namedtuple("TSDRArchiveResult",
+    ["source", "TSDRMapIsValid", "TSDRSingle", "TSDRMulti",
+     "ErrorCode", "ErrorMessage", "PayloadDigest"])
+
+_PAYLOAD_EXTENSIONS = (".zip", ".xml")
+
+def _isPayload(name):
+    return name.lower().endswith(_PAYLOAD_EXTENSIONS)
+
+def iterPayloads(source):
+    '''
+    Generator finding the TSDR data (zip files from the PTO, or XML files; by
+    extension, .zip or .xml) in source, yielding a (label, pathname, data) triple
+    for each, in order:
+      a directory is walked (in sorted order); for each file, label and pathname
+        are its pathname, and data is None (the file is read by the worker);
+      a tar file (compressed or not) or zip file is read a member at a time; for
+        each member, label is "BUNDLE!MEMBER", pathname is None and data its
+        contents, as bytes.
+    '''
+    if os.path.isdir(source):
+        for dirpath, dirnames, filenames in os.walk(source):
+            dirnames.sort()
+            for filename in sorted(filenames):
+                if _isPayload(filename):
+                    pathname = os.path.join(dirpath, filename)
+                    yield pathname, pathname, None
+    elif tarfile.is_tarfile(source):
+        with tarfile.open(source, "r:*") as bundle:
+            for member in bundle:
+                if member.isfile() and _isPayload(member.name):
+                    f = bundle.extractfile(member)
+                    try:
+                        data = f.read()
+                    finally:
+                        f.close()
+                    yield "%s!%s" % (source, member.name), None, data
+                bundle.members = []     # (so that a large bundle's index is not kept)
+    elif zipfile.is_zipfile(source):
+        with zipfile.ZipFile(source, "r") as bundle:
+            for member in bundle.infolist():
+                if _isPayload(member.filename):
+                    yield "%s!%s" % (source, member.filename), None, bundle.read(member)
+    else:
+        raise ValueError("not a directory, tar file or zip file: %s" % source)
+
+class TSDRJSONLinesSink(object):
+    '''
+    Sink for TSDRReprocessor.reprocessTo: writes each result to f (a file open
+    for writing text) as one line of JSON, an object with the fields of
+    TSDRArchiveResult
+    '''
+
+    def __init__(self, f):
+        self.f = f
+
+    def __call__(self, chunk):
+        for result in chunk:
+            self.f.write(json.dumps(dict(zip(result._fields, result)), sort_keys=True))
+            self.f.write("\n")
+        return
+
+_worker_settings = None     # in a worker process: settings of _worker_request
+_worker_request = None      # in a worker process: the TSDRReq kept for its lifetime
+
+def _workerRequest(settings):
+    '''
+    In a worker process, the TSDRReq for these (XSLT, engine, projection)
+    settings; created (and its transforms compiled) on first use, then reused
+    '''
+    global _worker_settings, _worker_request
+    if _worker_request is None or _worker_settings != settings:
+        XSLT, engine, projection = settings
+        t = _configureRequest(plumage.TSDRReq(), XSLT=XSLT, engine=engine,
+                              projection=projection, retain_zip_data=False, retention="lean")
+        if XSLT is None:
+            for descriptor in plumage._xslt_table.values():
+                descriptor.transform    # compile each once, up front
+        _worker_settings, _worker_request = settings, t
+    return _worker_request
+
+def _reprocessChunk(settings, chunk):
+    '''
+    In a worker process: re-run a chunk of (label, pathname, data) entries;
+    returns a list of TSDRArchiveResult
+    '''
+    t = _workerRequest(settings)
+    results = []
+    for label, pathname, data in chunk:
+        try:
+            t.resetXMLData()
+            if pathname is not None:
+                t.getXMLDataFromFile(pathname)
+            else:
+                t.getXMLDataFromBytes(data, source_label=label)
+            t._completeTSDRInfo()
+        except Exception as e:
+            _recordBatchException(t, "processing", e)
+        results.append(_archiveResult(label, t))
+    return results
+
+def _archiveResult(label, t):
+    '''
+    TSDRArchiveResult for one entry, from its TSDRReq
+    '''
+    return TSDRArchiveResult(label, t.TSDRData.TSDRMapIsValid, t.TSDRData.TSDRSingle,
+                             t.TSDRData.TSDRMulti, t.ErrorCode, t.ErrorMessage,
+                             t.PayloadDigest)
+
+def _chunkResults(chunk, future):
+    '''
+    Results of a chunk handed to a worker; if the worker failed altogether
+    (a worker process died, say), each entry reports the exception
+    '''
+    exception = future.exception()
+    if exception is None:
+        return future.result()
+    t = plumage.TSDRReq()
+    _recordBatchException(t, "processing", exception)
+    return [_archiveResult(label, t) for label, _, _ in chunk]
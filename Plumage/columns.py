@@ -0,0 +1,238 @@
+'''
+Plumage columns:
+    Collect many TSDR maps column by column, as NumPy arrays, for portfolio
+    reports (status breakdowns, renewal windows, filing-date histograms)
+    computed over whole columns rather than map by map
+
+Requires NumPy (http://www.numpy.org/), which Plumage itself does not.
+
+Each TSDRSingle key is a column, with one row per map collected:
+  date fields (keys ending "Date" or "DateTruncated", e.g. ApplicationDate,
+    "2000-05-09-04:00") are parsed, in one step for the whole column, into a
+    datetime64[D] array (the time zone is dropped; a missing, empty or malformed
+    date, "N/A" say, is NaT);
+  status fields (see ENCODED_FIELDS) are dictionary-encoded as they are
+    collected: an integer code per row, and the distinct values once;
+  other fields are object arrays of strings (None where a map has no such key).
+
+To use:
+    from Plumage import columns
+    c = columns.TSDRColumns()
+    for t in results:       # TSDRReq, TSDRMap or batch.TSDRArchiveResult
+        c.add(t)
+    filed = c.column("ApplicationDate")
+    recent = (filed >= numpy.datetime64("2015-01-01")).sum()
+    print(c.valueCounts("MarkCurrentStatusExternalDescriptionText"))
+
+For details, see https://github.com/codingatty/Plumage/wiki
+'''
+
+# Copyright 2014-2018 Terry Carroll
+# carroll@tjc.com
+#
+# License information:
+#
+# This program is licensed under Apache License, version 2.0 (January 2004);
+# see http://www.apache.org/licenses/LICENSE-2.0
+# SPX-License-Identifier: Apache-2.0
+#
+# Anyone who makes use of, or who modifies, this code is encouraged
+# (but not required) to notify the author.
+
+import array
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Status fields, dictionary-encoded by default: few distinct values, many rows
+ENCODED_FIELDS = (
+    "MarkCurrentStatusExternalDescriptionText",
+    "RegisterCategory",
+    "CurrentLocationCode",
+    "CurrentLocationText",
+    "LawOfficeAssignedText",
+    "DiagnosticInfoXSLTFormat",
+    )
+
+_DATE_LENGTH = len("YYYY-MM-DD")
+
+def isDateField(name):
+    '''
+    True if the TSDRSingle key name is a date field (parsed to datetime64)
+    '''
+    return name.endswith("Date") or name.endswith("DateTruncated")
+
+class TSDRColumns(object):
+    '''
+    Collector of TSDR maps, column by column; see the module documentation.
+
+    A TSDRColumns is also a sink for batch.TSDRReprocessor.reprocessTo.
+    '''
+
+    def __init__(self, fields=None, encoded=ENCODED_FIELDS):
+        '''
+        Initialize an (empty) collector
+
+        Parameters:
+            fields: optional names of the TSDRSingle keys to collect; if None,
+                every key seen is collected (a key first seen part way through
+                is missing from the earlier rows)
+            encoded: names of the fields to dictionary-encode
+        '''
+        if numpy is None:
+            raise ImportError("Plumage.columns requires NumPy")
+        self.fields = None if fields is None else frozenset(fields)
+        self.encoded = frozenset(encoded)
+        self._rows = 0
+        self._values = {}       # field: list of its values, one per row
+        self._codes = {}        # encoded field: array of its codes, one per row (-1: missing)
+        self._categories = {}   # encoded field: list of its distinct values, by code
+        self._category_codes = {}   # encoded field: dict of its distinct values' codes
+
+    def __len__(self):
+        return self._rows
+
+    def names(self):
+        '''
+        Names of the columns collected, sorted
+        '''
+        return sorted(list(self._values) + list(self._codes))
+
+    def add(self, tsdrmap):
+        '''
+        Collect one TSDR map (a TSDRMap; or a TSDRReq, or anything with TSDRSingle,
+        a batch.TSDRArchiveResult, say); one that is not valid is skipped.
+        Returns True if collected.
+        '''
+        tsdrmap = getattr(tsdrmap, "TSDRData", tsdrmap)    # (a TSDRReq)
+        if not tsdrmap.TSDRMapIsValid:
+            return False
+        single = tsdrmap.TSDRSingle
+        row = self._rows
+        values_columns, codes_columns = self._values, self._codes
+        collected = 0
+        for name, value in single.items():
+            if self.fields is not None and name not in self.fields:
+                continue
+            collected += 1
+            values = values_columns.get(name)
+            if values is not None:
+                values.append(value)
+                continue
+            if name not in self.encoded:
+                values_columns[name] = [_missing(name)] * row + [value]
+                continue
+            codes = codes_columns.get(name)
+            if codes is None:
+                codes = codes_columns[name] = array.array("l", [-1]) * row
+                self._categories[name] = []
+                self._category_codes[name] = {}
+            category_codes = self._category_codes[name]
+            code = category_codes.get(value)
+            if code is None:
+                code = category_codes[value] = len(category_codes)
+                self._categories[name].append(value)
+            codes.append(code)
+        self._rows = row + 1
+        if collected < len(values_columns) + len(codes_columns):
+            # fields this map does not have
+            for name, values in values_columns.items():
+                if len(values) == row:
+                    values.append(_missing(name))
+            for codes in codes_columns.values():
+                if len(codes) == row:
+                    codes.append(-1)
+        return True
+
+    def addMany(self, tsdrmaps):
+        '''
+        Collect TSDR maps (see add); returns the number collected
+        '''
+        count = 0
+        for tsdrmap in tsdrmaps:
+            if self.add(tsdrmap):
+                count += 1
+        return count
+
+    def __call__(self, chunk):
+        '''
+        As a sink for batch.TSDRReprocessor.reprocessTo: collect a chunk of results
+        '''
+        self.addMany(chunk)
+        return
+
+    def column(self, name):
+        '''
+        The column for a field, as a NumPy array with a row per map: datetime64[D]
+        for a date field; otherwise, an object array of the values (decoded, for
+        an encoded field), None where a map had no such field
+        '''
+        if name in self._codes:
+            codes, categories = self.codes(name)
+            # (code -1, missing, takes the None appended to the categories)
+            return numpy.append(categories, None)[codes]
+        if name not in self._values:
+            raise KeyError(name)
+        values = self._values[name]
+        if isDateField(name):
+            return _parseDates(values)
+        result = numpy.empty(len(values), dtype=object)
+        result[:] = values
+        return result
+
+    def codes(self, name):
+        '''
+        An encoded field as (codes, categories): codes, an integer array with a
+        row per map, the index in categories of its value (-1 if missing); and
+        categories, an object array of the field's distinct values, as first seen
+        '''
+        if name not in self._codes:
+            raise KeyError(name)
+        categories = numpy.empty(len(self._categories[name]), dtype=object)
+        categories[:] = self._categories[name]
+        return numpy.frombuffer(self._codes[name], dtype=numpy.dtype("l")).copy(), categories
+
+    def valueCounts(self, name):
+        '''
+        For an encoded field: dictionary of the number of maps with each value
+        (those without the field are not counted)
+        '''
+        codes, categories = self.codes(name)
+        counts = numpy.bincount(codes[codes >= 0], minlength=len(categories))
+        return dict(zip(categories.tolist(), counts.tolist()))
+
+    def columns(self):
+        '''
+        Dictionary of every column (see column), by name
+        '''
+        return dict((name, self.column(name)) for name in self.names())
+
+def _parseDates(values):
+    '''
+    datetime64[D] array of date strings ("YYYY-MM-DD", and anything after);
+    NaT for each that is empty or not a date
+    '''
+    # one step for the whole column: as fixed-width strings, each cut to its
+    # first ten characters ("YYYY-MM-DD"), then parsed
+    dates = numpy.array(values, dtype="U%d" % _DATE_LENGTH)
+    try:
+        return dates.astype("datetime64[D]")
+    except ValueError:
+        pass
+    # some value is not a date: parse value by value, so that only it is NaT
+    result = numpy.empty(len(dates), dtype="datetime64[D]")
+    for row, date in enumerate(dates.tolist()):
+        try:
+            result[row] = numpy.datetime64(date, "D")
+        except ValueError:
+            result[row] = numpy.datetime64("NaT")
+    return result
+
+def _missing(name):
+    '''
+    Value of a field in a row whose map does not have it: for a date field, an
+    empty string (parsed as NaT); otherwise, None
+    '''
+    return "" if isDateField(name) else None
@@ -0,0 +1,875 @@
+'''
+Plumage extract:
+    XSLT-free extraction of TSDR data from ST.66 and ST.96 XML
+
+An alternative to running the package-supplied ST66.xsl and ST96.xsl: the
+parsed XML tree is walked with precompiled, namespace-bound etree.XPath
+expressions that mirror the stylesheets template for template, producing the
+same (key, value) fields, in the same order, that the stylesheets write as
+KEY,"VALUE" lines -- without producing (and then re-parsing) the CSV text.
+
+Each xsl:template is described by a _Template.  All the value-of and test
+expressions of one template are evaluated with a single XPath call (a concat()
+of the expressions, separated by a character that cannot occur in XML), so
+the number of XPath calls is the number of template applications, not the
+number of fields.
+
+Used by TSDRReq when the "XPath" engine is selected (see TSDRReq.setEngine),
+and for streaming (see TSDRReq.iterTSDRInfo and iterFields); not normally used
+directly.  ST66.xsl and ST96.xsl remain the reference: a
+change to either must be made here, too (tests/test_offline.py checks that
+both engines produce the same TSDR maps).
+
+For details, see https://github.com/codingatty/Plumage/wiki
+'''
+
+# Copyright 2014-2018 Terry Carroll
+# carroll@tjc.com
+#
+# License information:
+#
+# This program is licensed under Apache License, version 2.0 (January 2004);
+# see http://www.apache.org/licenses/LICENSE-2.0
+# SPX-License-Identifier: Apache-2.0
+#
+# Anyone who makes use of, or who modifies, this code is encouraged
+# (but not required) to notify the author.
+
+import collections
+import copy
+import sys
+import threading
+from lxml import etree
+PYTHON2 = sys.version_info.major == 2
+PYTHON3 = sys.version_info.major == 3
+
+# Separates the values in a template's concat(): a private-use character, not
+# expected in the data (lxml won't pass one that is illegal in XML).  If it does
+# occur, the split yields too many values, and the template falls back to
+# evaluating its expressions one at a time.
+_SEPARATOR = u"\ue000"
+
+# What libxslt (the XSLT processor lxml uses) reports for system-property()
+_XSL_PROCESSOR_VERSION = "1.0"
+_XSL_PROCESSOR_VENDOR = "libxslt"
+_XSL_PROCESSOR_VENDOR_URL = "http://xmlsoft.org/XSLT/"
+
+def _expression_index(expressions, expression):
+    '''
+    Index of expression in a template's list of expressions, adding it if new
+    (so an expression used twice, e.g. a date and its truncated form, is
+    evaluated once)
+    '''
+    if expression not in expressions:
+        expressions.append(expression)
+    return expressions.index(expression)
+
+class _Field(object):
+    '''
+    KEY,"<xsl:value-of select="expression"/>"
+    '''
+
+    def __init__(self, key, expression):
+        self.key = key
+        self.expression = expression
+        self.index = None
+
+    def compile(self, expressions, namespaces):
+        self.index = _expression_index(expressions, self.expression)
+
+    def project(self, projection):
+        return copy.copy(self) if self.key in projection else None
+
+    def run(self, node, values, substitutions, fields):
+        fields.append((self.key, values[self.index]))
+
+class _Truncated(_Field):
+    '''
+    KEY,"<xsl:value-of select="substring(expression,1,10)"/>" (a date, without
+    its time zone)
+    '''
+
+    def run(self, node, values, substitutions, fields):
+        fields.append((self.key, values[self.index][:10]))
+
+class _Constant(object):
+    '''
+    KEY,"literal text"
+    '''
+
+    def __init__(self, key, value):
+        self.key = key
+        self.value = value
+
+    def compile(self, expressions, namespaces):
+        pass
+
+    def project(self, projection):
+        return self if self.key in projection else None
+
+    def run(self, node, values, substitutions, fields):
+        fields.append((self.key, self.value))
+
+class _Placeholder(object):
+    '''
+    KEY,"$PLACEHOLDER$" (value supplied at run time; see plumage._TSDR_substitutions)
+    '''
+
+    def __init__(self, key, placeholder):
+        self.key = key
+        self.placeholder = placeholder
+
+    def compile(self, expressions, namespaces):
+        pass
+
+    def project(self, projection):
+        return self if self.key in projection else None
+
+    def run(self, node, values, substitutions, fields):
+        fields.append((self.key, substitutions[self.placeholder]))
+
+class _Choose(object):
+    '''
+    <xsl:choose><xsl:when test="test">when</xsl:when><xsl:otherwise>otherwise</xsl:otherwise></xsl:choose>
+    '''
+
+    def __init__(self, test, when, otherwise):
+        self.test = test
+        self.when = when
+        self.otherwise = otherwise
+        self.index = None
+
+    def compile(self, expressions, namespaces):
+        # a boolean, which concat() turns into "true" or "false"
+        self.index = _expression_index(expressions, "(%s)" % self.test)
+        for step in self.when + self.otherwise:
+            step.compile(expressions, namespaces)
+
+    def project(self, projection):
+        when = _project_steps(self.when, projection)
+        otherwise = _project_steps(self.otherwise, projection)
+        if not (when or otherwise):
+            return None
+        return _Choose(self.test, when, otherwise)
+
+    def run(self, node, values, substitutions, fields):
+        if values[self.index] == "true":
+            steps = self.when
+        else:
+            steps = self.otherwise
+        for step in steps:
+            step.run(node, values, substitutions, fields)
+
+class _If(_Choose):
+    '''
+    <xsl:if test="test">steps</xsl:if>
+    '''
+
+    def __init__(self, test, steps):
+        _Choose.__init__(self, test, steps, [])
+
+class _Apply(object):
+    '''
+    <xsl:apply-templates select="select"/>, where template is the one the
+    selected nodes match
+    '''
+
+    def __init__(self, select, template):
+        self.select = select
+        self.template = template
+        self._select = None
+
+    def compile(self, expressions, namespaces):
+        if self._select is None:    # (already compiled, if shared by a projection)
+            self._select = etree.XPath(self.select, namespaces=namespaces)
+        self.template.compile(namespaces)
+
+    def project(self, projection):
+        list_name = self.template.list_name
+        if list_name is not None:
+            # a repeated field is kept whole, or not evaluated at all
+            return self if list_name in projection else None
+        template = self.template.project(projection)
+        if template is None:
+            return None
+        return _Apply(self.select, template)
+
+    def run(self, node, values, substitutions, fields):
+        for selected in self._select(node):
+            self.template.run(selected, substitutions, fields)
+
+class _Template(object):
+    '''
+    An xsl:template: steps (_Field, _Truncated, _Constant, _Placeholder, _If,
+    _Choose, _Apply) run, in order, against each node the template is applied to
+    '''
+
+    def __init__(self, steps):
+        self.steps = steps
+        self._expressions = []
+        self._namespaces = None
+        self._values = None
+        self._each = None       # one XPath per expression, for the fallback
+        self._compiled = False
+
+    @property
+    def list_name(self):
+        '''
+        For the template of a repeated field (e.g., "MarkEvent"), the name of
+        its list in TSDRMulti (e.g., "MarkEventList"); otherwise None
+        '''
+        first = self.steps[0] if self.steps else None
+        if isinstance(first, _Constant) and first.key == "BeginRepeatedField":
+            return first.value + "List"
+        return None
+
+    def project(self, projection):
+        '''
+        A new (uncompiled) template with only the steps needed for the
+        projection; or None, if none are
+        '''
+        steps = _project_steps(self.steps, projection)
+        if not steps:
+            return None
+        return _Template(steps)
+
+    def compile(self, namespaces):
+        '''
+        Compile the template's expressions into one XPath, and compile the
+        templates it applies
+        '''
+        if self._compiled:
+            return
+        self._compiled = True
+        self._namespaces = namespaces
+        for step in self.steps:
+            step.compile(self._expressions, namespaces)
+        if self._expressions:
+            self._values = etree.XPath("concat(%s, '')" % ", $separator, ".join(self._expressions),
+                                       namespaces=namespaces, smart_strings=False)
+
+    def run(self, node, substitutions, fields):
+        if self._values is None:
+            values = []
+        else:
+            values = self._values(node, separator=_SEPARATOR).split(_SEPARATOR)
+            if len(values) != len(self._expressions):
+                values = self._evaluate_each(node)
+            if PYTHON2:
+                values = [value.encode("utf-8") if isinstance(value, unicode) else value
+                          for value in values]
+        for step in self.steps:
+            step.run(node, values, substitutions, fields)
+
+    def _evaluate_each(self, node):
+        '''
+        The template's values, one XPath call per expression (for data
+        containing _SEPARATOR)
+        '''
+        if self._each is None:
+            self._each = [etree.XPath("string(%s)" % expression, namespaces=self._namespaces,
+                                      smart_strings=False)
+                          for expression in self._expressions]
+        return [each(node) for each in self._each]
+
+class _StreamedElement(object):
+    '''
+    An element iterFields extracts as soon as it is parsed, then discards
+      parent_tag: tag its parent must have; or None, if any
+      template: template to run on it; or None, if nothing is needed from it
+        (it is discarded all the same)
+    '''
+
+    def __init__(self, parent_tag, template):
+        self.parent_tag = parent_tag
+        self.template = template
+
+def _project_steps(steps, projection):
+    '''
+    The steps (projected) needed for the projection
+    '''
+    projected = [step.project(projection) for step in steps]
+    return [step for step in projected if step is not None]
+
+class _Stylesheet(object):
+    '''
+    The templates mirroring one package-supplied stylesheet
+      root_tag: tag of the root element the stylesheet's top template matches
+      namespaces: prefixes used in the expressions
+      template: the top template, applied to the root element
+    Projections of the stylesheet (see projected) are kept, up to max_projections.
+    '''
+
+    def __init__(self, root_tag, namespaces, template, max_projections=32):
+        self.root_tag = root_tag
+        self.namespaces = namespaces
+        self.template = template
+        self.max_projections = max_projections
+        self._projections = collections.OrderedDict()
+        self._streamed = None   # see streamed
+        self._lock = threading.Lock()
+        template.compile(namespaces)
+
+    def projected(self, projection):
+        '''
+        The stylesheet pruned to what is needed for projection (a frozenset of
+        TSDRSingle keys and TSDRMulti list names): templates, and expressions
+        within templates, that would contribute nothing are dropped, so that
+        the parts of the document they read are never evaluated
+        '''
+        with self._lock:
+            stylesheet = self._projections.pop(projection, None)
+            if stylesheet is None:
+                template = self.template.project(projection) or _Template([])
+                stylesheet = _Stylesheet(self.root_tag, self.namespaces, template, 0)
+            self._projections[projection] = stylesheet     # most recently used last
+            while len(self._projections) > self.max_projections:
+                self._projections.popitem(last=False)
+        return stylesheet
+
+    def streamed(self, projection=None):
+        '''
+        The elements iterFields streams, for projection (None for all fields), as
+        a dictionary: tag -> list of _StreamedElement.  These are the elements
+        the top template's templates apply to; except that those of repeated
+        fields within them (e.g., a MarkEvent, within an ST.96 Trademark) are
+        streamed separately, and so are left out of the enclosing element's template.
+        '''
+        stylesheet = self if projection is None else self.projected(projection)
+        with self._lock:
+            if stylesheet._streamed is None:
+                elements = {}
+                for tag, parent_tag, template in _streamed_templates(self.template, self.namespaces,
+                                                                     self.root_tag):
+                    if projection is not None:
+                        if template.list_name is not None:
+                            template = template if template.list_name in projection else None
+                        else:
+                            template = template.project(projection)
+                    if template is not None:
+                        template.compile(self.namespaces)
+                    elements.setdefault(tag, []).append(_StreamedElement(parent_tag, template))
+                stylesheet._streamed = elements
+        return stylesheet._streamed
+
+    def extract(self, tree, substitutions):
+        '''
+        Fields, as a list of (key, value) pairs, from a parsed XML tree; or None,
+        if the root element is not the one the stylesheet expects
+        '''
+        root = tree.getroot()
+        if root.tag != self.root_tag:
+            return None
+        fields = []
+        self.template.run(root, substitutions, fields)
+        return fields
+
+def _element_tags(select, namespaces, context_tag):
+    '''
+    (tag, parent_tag) of the elements selected by select (a path of element
+    names, such as "ns2:MarkEventBag/ns2:MarkEvent" or ".//tm:MarkEvent"), from
+    an element with tag context_tag; parent_tag is None if any parent will do
+    '''
+    descendants = select.startswith(".//")
+    if descendants:
+        select = select[len(".//"):]
+    tags = ["{%s}%s" % (namespaces[prefix], name)
+            for prefix, name in (step.split(":") for step in select.split("/"))]
+    if len(tags) > 1:
+        return tags[-1], tags[-2]
+    return tags[0], (None if descendants else context_tag)
+
+def _streamed_templates(template, namespaces, context_tag):
+    '''
+    Generator for _Stylesheet.streamed: (tag, parent_tag, template) for each
+    element to be streamed, below one with tag context_tag that template is
+    applied to
+    '''
+    for step in template.steps:
+        if not isinstance(step, _Apply):
+            continue
+        tag, parent_tag = _element_tags(step.select, namespaces, context_tag)
+        if step.template.list_name is not None:
+            yield tag, parent_tag, step.template
+            continue
+        steps = []
+        for inner in step.template.steps:
+            if isinstance(inner, _Apply) and inner.template.list_name is not None:
+                for streamed in _streamed_templates(_Template([inner]), namespaces, tag):
+                    yield streamed
+            else:
+                steps.append(inner)
+        yield tag, parent_tag, _Template(steps)
+
+########################################################################
+# ST66.xsl
+########################################################################
+
+_ST66_namespaces = {
+    "tm"  : "http://www.wipo.int/standards/XMLSchema/trademarks",
+    "pto" : "urn:us:gov:doc:uspto:trademark:status",
+    }
+
+_ST66_word_mark = _Template([
+    _Field("MarkVerbalElementText", "tm:MarkVerbalElementText"),
+    ])
+
+_ST66_office_details = _Template([
+    _Field("LawOfficeAssignedText", "pto:LawOfficeAssignedText"),
+    _Field("CurrentLocationCode", "pto:CurrentLocationCode"),
+    _Field("CurrentLocationText", "pto:CurrentLocationText"),
+    _Field("CurrentLocationDate", "pto:CurrentLocationDate"),
+    _Truncated("CurrentLocationDateTruncated", "pto:CurrentLocationDate"),
+    ])
+
+_ST66_trademark_ext = _Template([
+    _Field("MarkCurrentStatusExternalDescriptionText", "pto:MarkCurrentStatusExternalDescriptionText"),
+    _Field("RegisterCategory", "pto:RegisterCategory"),
+    _Field("RenewalDate", "pto:AdditionalMarkDetails/pto:RenewalDate"),
+    _Truncated("RenewalDateTruncated", "pto:AdditionalMarkDetails/pto:RenewalDate"),
+    _If("pto:RelatedMarkDetails/pto:InternationalApplicationNumber != ''", [
+        _Field("InternationalApplicationNumber",
+               "pto:RelatedMarkDetails/pto:InternationalApplicationNumber"),
+        ]),
+    _If("pto:RelatedMarkDetails/pto:InternationalRegistrationNumber != ''", [
+        _Field("InternationalRegistrationNumber",
+               "pto:RelatedMarkDetails/pto:InternationalRegistrationNumber"),
+        ]),
+    _Apply("pto:OfficeDetails", _ST66_office_details),
+    ])
+
+_ST66_publication_details = _Template([
+    _Field("PublicationDate", "tm:Publication/tm:PublicationDate"),
+    _Truncated("PublicationDateTruncated", "tm:Publication/tm:PublicationDate"),
+    ])
+
+_ST66_correspondent_address = _Template([
+    _Field("CorrespondentAddressLine01", "normalize-space(tm:AddressBuilding)"),
+    _Field("CorrespondentAddressLine02", "normalize-space(tm:AddressStreet)"),
+    _Field("CorrespondentAddressCity", "normalize-space(tm:AddressCity)"),
+    _Field("CorrespondentAddressGeoRegion", "normalize-space(tm:AddressState)"),
+    _Field("CorrespondentPostalCode", "normalize-space(tm:AddressPostcode)"),
+    _Field("CorrespondentCountryCode", "normalize-space(tm:FormattedAddressCountryCode)"),
+    _Field("CorrespondentCombinedAddress",
+           "concat(normalize-space(tm:AddressBuilding), '/', "
+           "normalize-space(tm:AddressStreet), '/', "
+           "normalize-space(tm:AddressCity), '/', "
+           "normalize-space(tm:AddressState), '/', "
+           "normalize-space(tm:AddressPostcode), '/', "
+           "normalize-space(tm:FormattedAddressCountryCode))"),
+    ])
+
+_ST66_contact_information = _Template([
+    _Field("CorrespondentPhoneNumber", "tm:Phone"),
+    _Field("CorrespondentFaxNumber", "tm:Fax"),
+    _Field("CorrespondentEmailAddress", "tm:Email"),
+    ])
+
+_ST66_representative_details = _Template([
+    _If("tm:Representative/tm:Comment = 'Domestic Correspondent'", [
+        _Field("CorrespondentName",
+               "tm:Representative/tm:RepresentativeAddressBook/tm:FormattedNameAddress/tm:Name/"
+               "tm:FreeFormatName/tm:FreeFormatNameDetails/tm:FreeFormatNameLine[1]"),
+        _Field("CorrespondentOrganization",
+               "tm:Representative/tm:RepresentativeAddressBook/tm:FormattedNameAddress/tm:Name/"
+               "tm:FreeFormatName/tm:FreeFormatNameDetails/tm:FreeFormatNameLine[2]"),
+        _Apply(".//tm:FormattedAddress", _ST66_correspondent_address),
+        _Apply(".//tm:ContactInformationDetails", _ST66_contact_information),
+        ]),
+    ])
+
+_ST66_staff_details = _Template([
+    _Field("StaffName", "tm:Staff/tm:StaffName"),
+    _Field("StaffOfficialTitle", "tm:Staff/tm:OfficialTitle"),
+    ])
+
+_ST66_trademark = _Template([
+    _Placeholder("DiagnosticInfoXSLTFilename", "$XSLTFILENAME$"),
+    _Placeholder("DiagnosticInfoXSLTLocation", "$XSLTLOCATION$"),
+    _Constant("DiagnosticInfoXSLTVersion", "1.1.1"),
+    _Constant("DiagnosticInfoXSLTDate", "2017-03-15"),
+    _Constant("DiagnosticInfoXSLTFormat", "ST.66"),
+    _Constant("DiagnosticInfoXSLTAuthor", "Terry Carroll"),
+    _Constant("DiagnosticInfoXSLTURL", "https://github.com/codingatty/Plumage"),
+    _Constant("DiagnosticInfoXSLTCopyright", "Copyright 2014-2017 Terry Carroll"),
+    _Constant("DiagnosticInfoXSLTLicense", "Apache License, version 2.0 (January 2004)"),
+    _Constant("DiagnosticInfoXSLTSPDXLicenseIdentifier", "Apache-2.0"),
+    _Constant("DiagnosticInfoXSLTLicenseURL", "http://www.apache.org/licenses/LICENSE-2.0"),
+    _Placeholder("DiagnosticInfoImplementationName", "$IMPLEMENTATIONNAME$"),
+    _Placeholder("DiagnosticInfoImplementationVersion", "$IMPLEMENTATIONVERSION$"),
+    _Placeholder("DiagnosticInfoImplementationDate", "$IMPLEMENTATIONDATE$"),
+    _Placeholder("DiagnosticInfoImplementationAuthor", "$IMPLEMENTATIONAUTHOR$"),
+    _Placeholder("DiagnosticInfoImplementationURL", "$IMPLEMENTATIONURL$"),
+    _Placeholder("DiagnosticInfoImplementationCopyright", "$IMPLEMENTATIONCOPYRIGHT$"),
+    _Placeholder("DiagnosticInfoImplementationLicense", "$IMPLEMENTATIONLICENSE$"),
+    _Placeholder("DiagnosticInfoImplementationSPDXLicenseIdentifier", "$IMPLEMENTATIONSPDXLID$"),
+    _Placeholder("DiagnosticInfoImplementationLicenseURL", "$IMPLEMENTATIONLICENSEURL$"),
+    _Placeholder("DiagnosticInfoExecutionDateTime", "$EXECUTIONDATETIME$"),
+    _Placeholder("DiagnosticInfoXMLSource", "$XMLSOURCE$"),
+    _Constant("DiagnosticInfoXSLProcessorVersion", _XSL_PROCESSOR_VERSION),
+    _Constant("DiagnosticInfoXSLProcessorVendor", _XSL_PROCESSOR_VENDOR),
+    _Constant("DiagnosticInfoXSLProcessorVendorURL", _XSL_PROCESSOR_VENDOR_URL),
+    _Field("MarkCurrentStatusDate", "tm:MarkCurrentStatusDate"),
+    _Truncated("MarkCurrentStatusDateTruncated", "tm:MarkCurrentStatusDate"),
+    _Field("ApplicationNumber", "tm:ApplicationNumber"),
+    _Field("ApplicationDate", "tm:ApplicationDate"),
+    _Truncated("ApplicationDateTruncated", "tm:ApplicationDate"),
+    _Field("RegistrationNumber", "tm:RegistrationNumber"),
+    _Field("RegistrationDate", "tm:RegistrationDate"),
+    _Truncated("RegistrationDateTruncated", "tm:RegistrationDate"),
+    _Apply("tm:WordMarkSpecification", _ST66_word_mark),
+    _Apply("tm:TradeMarkExt", _ST66_trademark_ext),
+    _Apply("tm:PublicationDetails", _ST66_publication_details),
+    _Apply("tm:RepresentativeDetails", _ST66_representative_details),
+    _Apply("tm:StaffDetails", _ST66_staff_details),
+    ])
+
+_ST66_applicant_address = _Template([
+    _Field("ApplicantAddressLine01", "tm:AddressRoom"),
+    _Constant("ApplicantAddressLine02", ""),
+    _Field("ApplicantAddressCity", "tm:AddressCity"),
+    _Field("ApplicantAddressGeoRegion", "tm:AddressState"),
+    _Field("ApplicantPostalCode", "tm:AddressPostcode"),
+    _Field("ApplicantCountryCode", "tm:FormattedAddressCountryCode"),
+    _Field("ApplicantCombinedAddress",
+           "concat(tm:AddressRoom, '/', '/', tm:AddressCity, '/', tm:AddressState, '/', "
+           "tm:AddressPostcode, '/', tm:FormattedAddressCountryCode)"),
+    ])
+
+_ST66_applicant = _Template([
+    _Constant("BeginRepeatedField", "Applicant"),
+    _Field("ApplicantName",
+           "tm:ApplicantAddressBook/tm:FormattedNameAddress/tm:Name/tm:FreeFormatName/"
+           "tm:FreeFormatNameDetails/tm:FreeFormatNameLine"),
+    _Field("ApplicantDescription", "tm:ApplicantExt/pto:PartyTypeDescriptionText"),
+    _Apply("tm:ApplicantAddressBook/tm:FormattedNameAddress/tm:Address/tm:FormattedAddress",
+           _ST66_applicant_address),
+    _Constant("EndRepeatedField", "Applicant"),
+    ])
+
+_ST66_mark_event = _Template([
+    _Constant("BeginRepeatedField", "MarkEvent"),
+    _Field("MarkEventDate", "tm:MarkEventDate"),
+    _Truncated("MarkEventDateTruncated", "tm:MarkEventDate"),
+    _Field("MarkEventDescription", "tm:MarkEventExt/pto:MarkEventInternalDescriptionText"),
+    _Field("MarkEventEntryNumber", "tm:MarkEventExt/pto:MarkEventEntryNumber"),
+    _Constant("EndRepeatedField", "MarkEvent"),
+    ])
+
+_ST66_assignment = _Template([
+    _Constant("BeginRepeatedField", "Assignment"),
+    _Field("AssignmentIdentifier", "pto:AssignmentIdentifier"),
+    _Field("AssignmentConveyanceCategory", "pto:AssignmentConveyanceCategory"),
+    _Field("AssignmentGroupCategory", "pto:AssignmentGroupCategory"),
+    _Field("AssignmentRecordedDate", "pto:AssignmentRecordedDate"),
+    _Truncated("AssignmentRecordedDateTruncated", "pto:AssignmentRecordedDate"),
+    _Field("AssignmentExecutedDate", "pto:Assignor/pto:AssignmentExecutionDate"),
+    _Truncated("AssignmentExecutedDateTruncated", "pto:Assignor/pto:AssignmentExecutionDate"),
+    _Field("AssignorEntityName", "pto:Assignor/pto:Contact/pto:Name/pto:EntityName"),
+    _Field("AssigneeEntityName", "pto:Assignee/pto:Contact/pto:Name/pto:EntityName"),
+    _Field("AssignmentDocumentURL", "pto:AssignmentDocumentBag"),
+    _Constant("EndRepeatedField", "Assignment"),
+    ])
+
+_ST66_assignment_bag = _Template([
+    _Apply("pto:Assignment", _ST66_assignment),
+    ])
+
+_ST66_transaction = _Template([
+    _Apply(".//tm:TradeMark", _ST66_trademark),
+    _Apply(".//tm:Applicant", _ST66_applicant),
+    _Apply(".//tm:MarkEvent", _ST66_mark_event),
+    _Apply(".//tm:AssignmentBagExt", _ST66_assignment_bag),
+    ])
+
+########################################################################
+# ST96.xsl
+########################################################################
+
+_ST96_namespaces = {
+    "ns1" : "http://www.wipo.int/standards/XMLSchema/ST96/Common",
+    "ns2" : "http://www.wipo.int/standards/XMLSchema/ST96/Trademark",
+    "ns3" : "urn:us:gov:doc:uspto:trademark",
+    }
+
+_ST96_word_mark = _Template([
+    _Field("MarkVerbalElementText", "ns2:MarkVerbalElementText"),
+    ])
+
+_ST96_case_location = _Template([
+    _Field("LawOfficeAssignedText", "ns2:LawOfficeAssignedText"),
+    _Field("CurrentLocationCode", "ns2:CurrentLocationCode"),
+    _Field("CurrentLocationText", "ns2:CurrentLocationText"),
+    _Field("CurrentLocationDate", "ns2:CurrentLocationDate"),
+    _Truncated("CurrentLocationDateTruncated", "ns2:CurrentLocationDate"),
+    ])
+
+_ST96_national_information = _Template([
+    _Field("MarkCurrentStatusExternalDescriptionText", "ns2:MarkCurrentStatusExternalDescriptionText"),
+    # kludge: ST.96 format uses "Primary" instead of "Principal" for the Principal Register
+    _Choose("ns2:RegisterCategory = 'Primary'",
+            [_Constant("RegisterCategory", "Principal")],
+            [_Field("RegisterCategory", "ns2:RegisterCategory")]),
+    _Field("RenewalDate", "ns2:RenewalDate"),
+    _Truncated("RenewalDateTruncated", "ns2:RenewalDate"),
+    _Apply("ns2:NationalCaseLocation", _ST96_case_location),
+    ])
+
+_ST96_associated_mark = _Template([
+    _If("ns2:AssociationCategory = 'International application or registration'", [
+        _Field("InternationalApplicationNumber", "ns1:ApplicationNumber/ns1:ApplicationNumberText"),
+        # the *registration* number is stored under "InternationalApplicationNumber"
+        _Field("InternationalRegistrationNumber",
+               "ns2:InternationalApplicationNumber/ns1:ApplicationNumberText"),
+        ]),
+    ])
+
+_ST96_publication = _Template([
+    _Field("PublicationDate", "ns1:PublicationDate"),
+    _Truncated("PublicationDateTruncated", "ns1:PublicationDate"),
+    ])
+
+_ST96_correspondent_address = _Template([
+    _Field("CorrespondentAddressLine01", "ns1:AddressLineText[@ns1:sequenceNumber='1']"),
+    _Field("CorrespondentAddressLine02", "ns1:AddressLineText[@ns1:sequenceNumber='2']"),
+    _Field("CorrespondentAddressCity", "ns1:CityName"),
+    _Field("CorrespondentAddressGeoRegion", "ns1:GeographicRegionName"),
+    _Field("CorrespondentPostalCode", "ns1:PostalCode"),
+    _Field("CorrespondentCountryCode", "ns1:CountryCode"),
+    _Field("CorrespondentCombinedAddress",
+           "concat(ns1:AddressLineText[@ns1:sequenceNumber='1'], '/', "
+           "ns1:AddressLineText[@ns1:sequenceNumber='2'], '/', "
+           "ns1:CityName, '/', ns1:GeographicRegionName, '/', "
+           "ns1:PostalCode, '/', ns1:CountryCode)"),
+    ])
+
+_ST96_correspondent = _Template([
+    _Field("CorrespondentName", "ns1:Name/ns1:PersonName/ns1:PersonFullName"),
+    _Field("CorrespondentOrganization", "ns1:Name/ns1:OrganizationName/ns1:OrganizationStandardName"),
+    _Apply("ns1:PostalAddressBag/ns1:PostalAddress/ns1:PostalStructuredAddress",
+           _ST96_correspondent_address),
+    _Field("CorrespondentPhoneNumber", "ns1:PhoneNumberBag/ns1:PhoneNumber"),
+    _Field("CorrespondentFaxNumber", "ns1:FaxNumberBag/ns1:FaxNumber"),
+    _Field("CorrespondentEmailAddress", "ns1:EmailAddressBag/ns1:EmailAddressText"),
+    ])
+
+_ST96_applicant_address = _Template([
+    _Field("ApplicantAddressLine01", "ns1:AddressLineText[@ns1:sequenceNumber='1']"),
+    _Field("ApplicantAddressLine02", "ns1:AddressLineText[@ns1:sequenceNumber='2']"),
+    _Field("ApplicantAddressCity", "ns1:CityName"),
+    _Field("ApplicantAddressGeoRegion", "ns1:GeographicRegionName"),
+    _Field("ApplicantPostalCode", "ns1:PostalCode"),
+    _Field("ApplicantCountryCode", "ns1:CountryCode"),
+    _Field("ApplicantCombinedAddress",
+           "concat(ns1:AddressLineText[@ns1:sequenceNumber='1'], '/', "
+           "ns1:AddressLineText[@ns1:sequenceNumber='2'], '/', "
+           "ns1:CityName, '/', ns1:GeographicRegionName, '/', "
+           "ns1:PostalCode, '/', ns1:CountryCode)"),
+    ])
+
+_ST96_applicant = _Template([
+    _Constant("BeginRepeatedField", "Applicant"),
+    _Choose("ns1:Contact/ns1:Name/ns1:EntityName != ''",
+            [_Field("ApplicantName", "ns1:Contact/ns1:Name/ns1:EntityName")],
+            [_Field("ApplicantName",
+                    "ns1:Contact/ns1:Name/ns1:OrganizationName/ns1:OrganizationStandardName")]),
+    _Choose("ns1:Version/ns1:CommentText != ''",
+            [_Field("ApplicantDescription", "ns1:Version/ns1:CommentText")],
+            [_Field("ApplicantDescription", "ns1:CommentText")]),
+    _Apply("ns1:Contact/ns1:PostalAddressBag/ns1:PostalAddress/ns1:PostalStructuredAddress",
+           _ST96_applicant_address),
+    _Constant("EndRepeatedField", "Applicant"),
+    ])
+
+_ST96_staff = _Template([
+    _Field("StaffName", "ns1:StaffName"),
+    _Field("StaffOfficialTitle", "ns1:OfficialTitleText"),
+    ])
+
+_ST96_mark_event = _Template([
+    _Constant("BeginRepeatedField", "MarkEvent"),
+    _Field("MarkEventDate", "ns2:MarkEventDate"),
+    _Truncated("MarkEventDateTruncated", "ns2:MarkEventDate"),
+    _Field("MarkEventDescription", "ns2:NationalMarkEvent/ns2:MarkEventDescriptionText"),
+    _Field("MarkEventEntryNumber", "ns2:NationalMarkEvent/ns2:MarkEventEntryNumber"),
+    _Constant("EndRepeatedField", "MarkEvent"),
+    ])
+
+_ST96_assignment = _Template([
+    _Constant("BeginRepeatedField", "Assignment"),
+    _Field("AssignmentIdentifier", "ns2:AssignmentIdentifier"),
+    _Field("AssignmentConveyanceCategory", "ns2:AssignmentConveyanceCategory"),
+    _Field("AssignmentGroupCategory", "ns2:AssignmentGroupCategory"),
+    _Field("AssignmentRecordedDate", "ns2:AssignmentRecordedDate"),
+    _Truncated("AssignmentRecordedDateTruncated", "ns2:AssignmentRecordedDate"),
+    _Field("AssignmentExecutedDate", "ns2:AssignmentExecutedDate"),
+    _Truncated("AssignmentExecutedDateTruncated", "ns2:AssignmentExecutedDate"),
+    _Choose("ns2:AssignorBag/ns2:Assignor/ns1:Contact/ns1:Name/ns1:EntityName != ''",
+            [_Field("AssignorEntityName",
+                    "ns2:AssignorBag/ns2:Assignor/ns1:Contact/ns1:Name/ns1:EntityName")],
+            [_Field("AssignorEntityName",
+                    "ns2:AssignorBag/ns2:Assignor/ns1:Contact/ns1:Name/ns1:OrganizationName/"
+                    "ns1:OrganizationStandardName")]),
+    _Choose("ns2:AssigneeBag/ns2:Assignee/ns1:Contact/ns1:Name/ns1:EntityName != ''",
+            [_Field("AssigneeEntityName",
+                    "ns2:AssigneeBag/ns2:Assignee/ns1:Contact/ns1:Name/ns1:EntityName")],
+            [_Field("AssigneeEntityName",
+                    "ns2:AssigneeBag/ns2:Assignee/ns1:Contact/ns1:Name/ns1:OrganizationName/"
+                    "ns1:OrganizationStandardName")]),
+    _Field("AssignmentDocumentURL",
+           "ns2:AssignmentDocumentBag/ns2:TrademarkDocument/ns1:DocumentIdentifier"),
+    _Constant("EndRepeatedField", "Assignment"),
+    ])
+
+_ST96_trademark = _Template([
+    _Placeholder("DiagnosticInfoXSLTFilename", "$XSLTFILENAME$"),
+    _Placeholder("DiagnosticInfoXSLTLocation", "$XSLTLOCATION$"),
+    _Constant("DiagnosticInfoXSLTVersion", "1.1.1"),
+    _Constant("DiagnosticInfoXSLTDate", "2017-03-15"),
+    _Constant("DiagnosticInfoXSLTFormat", "ST.96"),
+    _Constant("DiagnosticInfoXSLTAuthor", "Terry Carroll"),
+    _Constant("DiagnosticInfoXSLTURL", "https://github.com/codingatty/Plumage"),
+    _Constant("DiagnosticInfoXSLTCopyright", "Copyright 2014-2017 Terry Carroll"),
+    _Constant("DiagnosticInfoXSLTLicense", "Apache License, version 2.0 (January 2004)"),
+    _Constant("DiagnosticInfoXSLTSPDXLicenseIdentifier", "Apache-2.0"),
+    _Constant("DiagnosticInfoXSLTLicenseURL", "http://www.apache.org/licenses/LICENSE-2.0"),
+    _Placeholder("DiagnosticInfoImplementationName", "$IMPLEMENTATIONNAME$"),
+    _Placeholder("DiagnosticInfoImplementationVersion", "$IMPLEMENTATIONVERSION$"),
+    _Placeholder("DiagnosticInfoImplementationDate", "$IMPLEMENTATIONDATE$"),
+    _Placeholder("DiagnosticInfoImplementationAuthor", "$IMPLEMENTATIONAUTHOR$"),
+    _Placeholder("DiagnosticInfoImplementationURL", "$IMPLEMENTATIONURL$"),
+    _Placeholder("DiagnosticInfoImplementationCopyright", "$IMPLEMENTATIONCOPYRIGHT$"),
+    _Placeholder("DiagnosticInfoImplementationSPDXLicenseIdentifier", "$IMPLEMENTATIONSPDXLID$"),
+    _Placeholder("DiagnosticInfoImplementationLicense", "$IMPLEMENTATIONLICENSE$"),
+    _Placeholder("DiagnosticInfoImplementationLicenseURL", "$IMPLEMENTATIONLICENSEURL$"),
+    _Placeholder("DiagnosticInfoExecutionDateTime", "$EXECUTIONDATETIME$"),
+    _Placeholder("DiagnosticInfoXMLSource", "$XMLSOURCE$"),
+    _Constant("DiagnosticInfoXSLProcessorVersion", _XSL_PROCESSOR_VERSION),
+    _Constant("DiagnosticInfoXSLProcessorVendor", _XSL_PROCESSOR_VENDOR),
+    _Constant("DiagnosticInfoXSLProcessorVendorURL", _XSL_PROCESSOR_VENDOR_URL),
+    _Field("MarkCurrentStatusDate", "ns2:MarkCurrentStatusDate"),
+    _Truncated("MarkCurrentStatusDateTruncated", "ns2:MarkCurrentStatusDate"),
+    _Field("ApplicationNumber", "ns1:ApplicationNumber/ns1:ApplicationNumberText"),
+    _Field("ApplicationDate", "ns2:ApplicationDate"),
+    _Truncated("ApplicationDateTruncated", "ns2:ApplicationDate"),
+    _Field("RegistrationNumber", "ns1:RegistrationNumber"),
+    _Field("RegistrationDate", "ns1:RegistrationDate"),
+    _Truncated("RegistrationDateTruncated", "ns1:RegistrationDate"),
+    _Apply("ns2:MarkRepresentation/ns2:MarkReproduction/ns2:WordMarkSpecification", _ST96_word_mark),
+    _Apply("ns2:NationalTrademarkInformation", _ST96_national_information),
+    _Apply("ns2:AssociatedMarkBag/ns2:AssociatedMark", _ST96_associated_mark),
+    _Apply("ns2:PublicationBag/ns2:Publication", _ST96_publication),
+    _Apply("ns2:NationalCorrespondent/ns1:Contact", _ST96_correspondent),
+    _Apply("ns2:ApplicantBag/ns2:Applicant", _ST96_applicant),
+    _Apply("ns1:StaffBag/ns1:Staff", _ST96_staff),
+    _Apply("ns2:MarkEventBag/ns2:MarkEvent", _ST96_mark_event),
+    _Apply("ns2:AssignmentBag/ns2:Assignment", _ST96_assignment),
+    ])
+
+_ST96_transaction = _Template([
+    _Apply(".//ns2:TrademarkBag/ns2:Trademark", _ST96_trademark),
+    ])
+
+_stylesheets = {
+    "ST66" : _Stylesheet("{http://www.wipo.int/standards/XMLSchema/trademarks}Transaction",
+                         _ST66_namespaces, _ST66_transaction),
+    "ST96" : _Stylesheet("{http://www.wipo.int/standards/XMLSchema/ST96/Trademark}TrademarkTransaction",
+                         _ST96_namespaces, _ST96_transaction),
+    }
+
+def extractFields(tree, xml_format, substitutions, projection=None):
+    '''
+    Fields that the package-supplied stylesheet for xml_format ("ST66" or "ST96")
+    would write for a parsed XML tree, as a list of (key, value) pairs, in order;
+    or None, if the tree's root element is not the one the stylesheet expects.
+
+        substitutions: values of the stylesheet's $PLACEHOLDER$s (see
+            plumage._TSDR_substitutions)
+        projection: optional frozenset of TSDRSingle keys and TSDRMulti list
+            names; if given, only the fields for those are extracted
+    '''
+    stylesheet = _stylesheets[xml_format]
+    if projection is not None:
+        stylesheet = stylesheet.projected(projection)
+    return stylesheet.extract(tree, substitutions)
+
+class UnexpectedRoot(ValueError):
+    '''
+    Raised by iterFields for a document whose root element is not one the
+    stylesheet (or any stylesheet) expects
+      tag: the root element's tag
+    '''
+
+    def __init__(self, tag):
+        ValueError.__init__(self, "Unexpected root element: %s" % tag)
+        self.tag = tag
+
+def iterFields(source, substitutions, projection=None, xml_format=None, started=None):
+    '''
+    Streaming counterpart of extractFields, for very large documents: source (a
+    filename, or a file object open for reading bytes) is parsed incrementally,
+    with etree.iterparse.  Each element a template applies to -- the trademark,
+    and each repeated field (a MarkEvent, say) -- is extracted as soon as it has
+    been parsed, and then cleared from the tree, so that memory use does not
+    grow with the number of repeated fields.
+
+    Yields, for each such element, the list of (key, value) pairs extracted
+    from it.  The fields are those extractFields returns, but the lists come
+    in the order the elements end in the document (so repeated fields within
+    the trademark element come before the trademark's own fields).
+
+        substitutions, projection: as for extractFields
+        xml_format: "ST66" or "ST96"; or None, to go by the root element
+        started: optional function, called with the format ("ST66" or "ST96")
+            once the root element is read, before anything is extracted
+
+    Raises UnexpectedRoot if the root element is not the one expected; and
+    etree.XMLSyntaxError if the XML is not well-formed.
+    '''
+    if xml_format is None:
+        candidates = list(_stylesheets.items())
+    else:
+        candidates = [(xml_format, _stylesheets[xml_format])]
+    tags = set()
+    for name, stylesheet in candidates:
+        tags.add(stylesheet.root_tag)
+        tags.update(stylesheet.streamed(projection))
+    elements = None
+    context = etree.iterparse(source, events=("start", "end"), tag=sorted(tags))
+    for event, element in context:
+        if elements is None:
+            root_tag = element.getroottree().getroot().tag
+            for name, stylesheet in candidates:
+                if stylesheet.root_tag == root_tag:
+                    break
+            else:
+                raise UnexpectedRoot(root_tag)
+            elements = stylesheet.streamed(projection)
+            if started is not None:
+                started(name)
+        if event != "end":
+            continue
+        for streamed in elements.get(element.tag, ()):
+            parent = element.getparent()
+            if streamed.parent_tag is None or (parent is not None and parent.tag == streamed.parent_tag):
+                if streamed.template is not None:
+                    fields = []
+                    streamed.template.run(element, substitutions, fields)
+                    yield fields
+                _discard(element)
+                break
+    if elements is None:
+        # none of the tags looked for occurs, not even the root's
+        raise UnexpectedRoot(context.root.tag)
+
+def _discard(element):
+    '''
+    Free an element iterFields is done with: clear it, and remove the (already
+    cleared) elements of the same kind before it
+    '''
+    element.clear()
+    parent = element.getparent()
+    previous = element.getprevious()
+    while previous is not None and previous.tag == element.tag:
+        parent.remove(previous)
+        previous = element.getprevious()
@@ -34,7 +34,15 @@ if PYTHON2:
     bytesio = StringIO.StringIO # In Python2, stringIO takes strings of binary data
     import urllib2
     URL_open = urllib2.urlopen
+    URL_request = urllib2.Request
     HTTPError = urllib2.HTTPError
+    URLError = urllib2.URLError
+    import httplib as http_client
+    import urlparse
+    URL_split = urlparse.urlsplit
+    URL_join = urlparse.urljoin
+    from collections import Mapping, Sequence
+    intern_string = intern
     
 if PYTHON3:
     import io
@@ -42,16 +50,42 @@ if PYTHON3:
     bytesio  = io.BytesIO # In Python3, use BytesIO for binary data
     import urllib.request
     URL_open = urllib.request.urlopen
+    URL_request = urllib.request.Request
     import urllib.error
     HTTPError = urllib.error.HTTPError
+    URLError = urllib.error.URLError
+    import http.client as http_client
+    import urllib.parse
+    URL_split = urllib.parse.urlsplit
+    URL_join = urllib.parse.urljoin
+    from collections.abc import Mapping, Sequence
+    intern_string = sys.intern
 
 import zipfile
+import collections
+import email.utils
+import json
+import mmap
+import os
 import os.path
+import random
+import re
+import select
+import shutil
+import socket
+import hashlib
 import string
+import tempfile
+import threading
 import time
-import unittest
 from lxml import etree
 
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+    import msvcrt
+
 ### PEP 476 begin
 try:
     import ssl
@@ -72,6 +106,8 @@ __licenseURL__ = "http://www.apache.org/licenses/LICENSE-2.0"
 COMMA = ","
 LINE_SEPARATOR = "\n"
 WHITESPACE = string.whitespace
+_csv_key_pattern = re.compile(r"[A-Za-z0-9]*\Z")   # CSV key: letters and digits only
+_clock = getattr(time, "perf_counter", time.time)   # for stage timings (see TSDRReq.setRecordTimings)
         
 class _XSLTDescriptor(object):
     '''
@@ -79,7 +115,10 @@ class _XSLTDescriptor(object):
       filename: name of XSLT file
       location: location (directory) of XSLT file
       pathname: full pathname of XSLT file
-      transform: compiled XSLT transform
+      transform: compiled XSLT transform (compiled on first use, so that
+        importing Plumage does not pay for transforms that are never used)
+      needs_substitution: True if the transform's output must still go through
+        TSDRReq._perform_substitution (see _compile_stylesheet)
     '''
 
     def __init__(self, XMLformat):
@@ -89,19 +128,36 @@ class _XSLTDescriptor(object):
         xslt_dirname = _TSDR_dirname
         xslt_filename = XMLformat+".xsl"
         xslt_pathname = os.path.join(xslt_dirname, xslt_filename)
-        with open(xslt_pathname, "rb") as _f:
+        self.filename = xslt_filename
+        self.location = xslt_dirname
+        self.pathname = xslt_pathname
+        self._compiled = None   # (transform, needs_substitution), once compiled
+        self._lock = threading.Lock()
+
+    @property
+    def transform(self):
+        return self._compiled_stylesheet()[0]
+
+    @property
+    def needs_substitution(self):
+        return self._compiled_stylesheet()[1]
+
+    def _compiled_stylesheet(self):
+        if self._compiled is None:
+            with self._lock:
+                if self._compiled is None:     # not compiled by another thread meanwhile
+                    self._compiled = self._compile()
+        return self._compiled
+
+    def _compile(self):
+        with open(self.pathname, "rb") as _f:
             # Note: reading this in as binary for Py2/Py3 compatibility, even though it's a text file
             #  Python2 will read it in as a string anyway;
             #  Python 3 will read it in as bytes, which etree.XML() requires;
             #  using bin mode will avoid having to treat Py2 and Py3 differently,
             #  i.e., having to use:  _stylesheet.encode(encoding="utf-8") for Py3 
             _stylesheet = _f.read()
-            _xslt_root = etree.XML(_stylesheet)
-            transform = etree.XSLT(_xslt_root)
-        self.filename = xslt_filename
-        self.location = xslt_dirname
-        self.pathname = xslt_pathname
-        self.transform = transform
+        return _compile_stylesheet(_stylesheet)
 
 class TSDRMap(object):
     '''
@@ -119,6 +175,204 @@ class TSDRMap(object):
         self.TSDRMulti = None
         self.TSDRMapIsValid = False
 
+    def copy(self):
+        '''
+        Return an independent copy of this TSDRMap: changing the dictionaries or
+        lists of one does not affect the other. (Values are strings, and so are
+        shared; so are the records of a compact map, which cannot be changed.)
+        '''
+        result = TSDRMap()
+        if isinstance(self.TSDRSingle, TSDRRecord):
+            result.TSDRSingle = self.TSDRSingle
+        elif self.TSDRSingle is not None:
+            result.TSDRSingle = dict(self.TSDRSingle)
+        if self.TSDRMulti is not None:
+            result.TSDRMulti = dict((list_name, _copy_items(items))
+                                    for list_name, items in self.TSDRMulti.items())
+        result.TSDRMapIsValid = self.TSDRMapIsValid
+        return result
+
+    def compact(self):
+        '''
+        Return a compact, read-only copy of this TSDRMap, for holding many maps in
+        memory at once (see TSDRReq.setCompactMaps): TSDRSingle is a TSDRRecord,
+        and each TSDRMulti list a TSDRRecordList (or, if its entries do not all
+        have the same keys, a list of TSDRRecord). They are read as the
+        dictionaries and lists of an ordinary TSDRMap are, and compare equal to them.
+        A value repeated within the map (a date, say) is kept once.
+        '''
+        result = TSDRMap()
+        values = {}     # each value, as first seen, so that repeats share it
+        if self.TSDRSingle is not None:
+            result.TSDRSingle = _compact_record(self.TSDRSingle, values)
+        if self.TSDRMulti is not None:
+            result.TSDRMulti = dict((_intern(list_name), _compact_list(items, values))
+                                    for list_name, items in self.TSDRMulti.items())
+        result.TSDRMapIsValid = self.TSDRMapIsValid
+        return result
+
+def _copy_items(items):
+    '''
+    Copy of a TSDRMulti list, for TSDRMap.copy
+    '''
+    if isinstance(items, TSDRRecordList):
+        return items
+    return [item if isinstance(item, TSDRRecord) else dict(item) for item in items]
+
+def _intern(key):
+    try:
+        return intern_string(key)
+    except TypeError:   # (Python 2: a unicode key)
+        return key
+
+class _KeySchema(object):
+    '''
+    Keys of a compact record (see TSDRRecord), interned and in order, with the
+    position of each; shared by every record with the same keys
+    '''
+    __slots__ = ("keys", "positions")
+
+    def __init__(self, keys):
+        self.keys = tuple(_intern(key) for key in keys)
+        self.positions = dict((key, position) for position, key in enumerate(self.keys))
+
+# Shared key schemas, by keys; a caller-supplied XSLT with ever-changing keys
+# cannot make the table grow without bound: past the limit, schemas are not shared
+_MAX_KEY_SCHEMAS = 4096
+_key_schemas = {}
+_key_schemas_lock = threading.Lock()
+
+def _key_schema(keys):
+    '''
+    The shared _KeySchema for keys (a tuple)
+    '''
+    schema = _key_schemas.get(keys)
+    if schema is None:
+        with _key_schemas_lock:
+            schema = _key_schemas.get(keys)
+            if schema is None:
+                schema = _KeySchema(keys)
+                if len(_key_schemas) < _MAX_KEY_SCHEMAS:
+                    _key_schemas[schema.keys] = schema
+    return schema
+
+class TSDRRecord(Mapping):
+    '''
+    Read-only mapping of keys to values, as in a TSDR map's TSDRSingle, or an
+    entry in one of its TSDRMulti lists (see TSDRMap.compact). Only the values
+    are kept for each record, in a tuple; the keys are kept, once, in a schema
+    shared with every other record that has the same keys.
+    '''
+    __slots__ = ("_schema", "_values")
+
+    def __init__(self, schema, values):
+        self._schema = schema
+        self._values = values
+
+    def __getitem__(self, key):
+        try:
+            return self._values[self._schema.positions[key]]
+        except KeyError:
+            raise KeyError(key)
+
+    def __contains__(self, key):
+        return key in self._schema.positions
+
+    def __iter__(self):
+        return iter(self._schema.keys)
+
+    def __len__(self):
+        return len(self._values)
+
+    def __repr__(self):
+        return "TSDRRecord(%r)" % (dict(zip(self._schema.keys, self._values)),)
+
+    def __reduce__(self):
+        return (_tsdr_record, (self._schema.keys, self._values))
+
+def _tsdr_record(keys, values):
+    '''
+    TSDRRecord with keys (a tuple) and values (a tuple); also used to unpickle one
+    '''
+    return TSDRRecord(_key_schema(keys), values)
+
+def _compact_record(mapping, values):
+    '''
+    TSDRRecord with the keys and values of mapping, in order; values (a dict) maps
+    each value to the same value as first seen, so that repeats can share it
+    '''
+    if isinstance(mapping, TSDRRecord):
+        return mapping
+    return _tsdr_record(tuple(mapping), tuple(values.setdefault(value, value)
+                                              for value in mapping.values()))
+
+class TSDRRecordList(Sequence):
+    '''
+    Read-only list of records that all have the same keys, as in one of a TSDR
+    map's TSDRMulti lists (see TSDRMap.compact): kept as a tuple of values (a
+    column) for each key, and the keys, once, in a shared schema. Each entry is
+    a TSDRRecord, made as it is asked for.
+    '''
+    __slots__ = ("_schema", "_columns", "_length")
+
+    def __init__(self, schema, columns, length):
+        self._schema = schema
+        self._columns = columns
+        self._length = length
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return TSDRRecordList(self._schema,
+                                  tuple(column[index] for column in self._columns),
+                                  len(range(*index.indices(self._length))))
+        if index < 0:
+            index += self._length
+        if not 0 <= index < self._length:
+            raise IndexError("TSDRRecordList index out of range")
+        return TSDRRecord(self._schema, tuple(column[index] for column in self._columns))
+
+    def __len__(self):
+        return self._length
+
+    def __eq__(self, other):
+        if not isinstance(other, (list, tuple, TSDRRecordList)):
+            return NotImplemented
+        return len(self) == len(other) and all(mine == theirs for mine, theirs in zip(self, other))
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        return equal if equal is NotImplemented else not equal
+
+    __hash__ = None
+
+    def __repr__(self):
+        return "TSDRRecordList(%r)" % (list(self),)
+
+    def __reduce__(self):
+        return (_tsdr_record_list, (self._schema.keys, self._columns, self._length))
+
+def _tsdr_record_list(keys, columns, length):
+    '''
+    TSDRRecordList with keys (a tuple) and columns; also used to unpickle one
+    '''
+    return TSDRRecordList(_key_schema(keys), columns, length)
+
+def _compact_list(items, values):
+    '''
+    TSDRRecordList of items (mappings), if they all have the same keys, in
+    the same order; otherwise, a list of TSDRRecord. values: see _compact_record
+    '''
+    if isinstance(items, TSDRRecordList):
+        return items
+    keys = tuple(items[0]) if items else ()
+    if any(tuple(item) != keys for item in items):
+        return [_compact_record(item, values) for item in items]
+    columns = tuple(tuple(values.setdefault(item[key], item[key]) for item in items)
+                    for key in keys)
+    return _tsdr_record_list(keys, columns, len(items))
+
+# Default substitution values; each TSDRReq takes its own copy (see resetXMLData),
+# so run-time values set for one request are never seen by another
 _TSDR_substitutions = {
     "$XSLTFILENAME$":"Not Set",                 # XSLT stylesheet file name
     "$XSLTLOCATION$":"Not Set",                 # XSLT stylesheet location (e.g., directory pathname)
@@ -137,79 +391,1711 @@ _TSDR_substitutions = {
 
 _TSDR_dirname = os.path.dirname(__file__)
 
+# PTO URL for each fetch format; "%sn%s" takes the tmtype ("s"/"r") and number
+_pto_url_templates = {
+    "ST66" : "https://tsdrapi.uspto.gov/ts/cd/status66/%sn%s/info.xml",
+    "ST96" : "https://tsdrapi.uspto.gov/ts/cd/casestatus/%sn%s/info.xml",
+    "zip"  : "https://tsdrapi.uspto.gov/ts/cd/casestatus/%sn%s/content.zip"
+    }
+
+# Mark images in the PTO's zip files
+_ZIP_IMAGE_FULL = "markImage.jpg"
+_ZIP_IMAGE_THUMB = "markThumbnailImage.jpg"
+
 _xslt_table = {
     "ST66" : _XSLTDescriptor("ST66"),
     "ST96" : _XSLTDescriptor("ST96")
     }
 
+_XSL_NAMESPACE = "http://www.w3.org/1999/XSL/Transform"
+_placeholder_pattern = re.compile(r"(\$[A-Z]+\$)")
+
+def _placeholder_parameter(placeholder):
+    '''
+    Name of the xsl:param that carries a $PLACEHOLDER$'s value, e.g. PLUMAGE_XMLSOURCE
+    '''
+    return "PLUMAGE_" + placeholder.strip("$")
+
+def _compile_stylesheet(stylesheet):
+    '''
+    Compile XSLT stylesheet (bytes). Returns (transform, needs_substitution).
+
+    $PLACEHOLDER$s (the keys of _TSDR_substitutions) in the stylesheet's literal
+    text are rewritten, before compiling, as xsl:value-of of top-level xsl:params,
+    so their values are passed in when transforming (see TSDRReq._transform_parameters)
+    rather than substituted into the output afterwards; no data from the PTO
+    is ever mistaken for a placeholder. needs_substitution is True if
+    placeholders remain where they can't be rewritten (e.g., in an attribute),
+    so that the output must still go through TSDRReq._perform_substitution.
+    '''
+    xslt_root = etree.XML(stylesheet)
+    parameters = set()
+    for node in list(xslt_root.iter()):
+        if node.tail and node.getparent() is not None:
+            _rewrite_placeholders(node, node.tail, "tail", parameters)
+        if isinstance(node.tag, str) and node.text:
+            if node.tag == "{%s}text" % _XSL_NAMESPACE:
+                _rewrite_placeholders(node, node.text, "xsl:text", parameters)
+            else:
+                _rewrite_placeholders(node, node.text, "text", parameters)
+    position = len([child for child in xslt_root
+                    if child.tag == "{%s}import" % _XSL_NAMESPACE])  # imports must come first
+    for name in sorted(parameters):
+        parameter = etree.Element("{%s}param" % _XSL_NAMESPACE, name=name)
+        xslt_root.insert(position, parameter)
+    remaining = _placeholder_pattern.findall(etree.tostring(xslt_root).decode("utf-8"))
+    needs_substitution = any(p in _TSDR_substitutions for p in remaining)
+    return etree.XSLT(xslt_root), needs_substitution
+
+def _rewrite_placeholders(node, text, where, parameters):
+    '''
+    Rewrite the placeholders in text, which is node's tail ("tail"), the text
+    of xsl:text element node ("xsl:text") or of any other element node ("text"),
+    as literal text and xsl:value-of elements; adds the xsl:param names used to parameters
+    '''
+    pieces = _placeholder_pattern.split(text)
+    if not any(p in _TSDR_substitutions for p in pieces[1::2]):
+        return
+    leading = []    # literal text before the first new element
+    new_nodes = []
+    for n, piece in enumerate(pieces):
+        if n % 2 == 1 and piece in _TSDR_substitutions:
+            name = _placeholder_parameter(piece)
+            parameters.add(name)
+            new_nodes.append(etree.Element("{%s}value-of" % _XSL_NAMESPACE, select="$" + name))
+        elif piece == "":
+            continue
+        elif where == "xsl:text" or piece.strip() == "":
+            # keep it exactly (whitespace-only literal text would be stripped)
+            text_node = etree.Element("{%s}text" % _XSL_NAMESPACE)
+            text_node.text = piece
+            new_nodes.append(text_node)
+        elif new_nodes:
+            new_nodes[-1].tail = (new_nodes[-1].tail or "") + piece
+        else:
+            leading.append(piece)
+    if where == "tail":
+        node.tail = "".join(leading) or None
+        anchor = node
+        for new_node in new_nodes:
+            anchor.addnext(new_node)
+            anchor = new_node
+    elif where == "text":
+        node.text = "".join(leading) or None
+        for index, new_node in enumerate(new_nodes):
+            node.insert(index, new_node)
+    else:
+        # replace the xsl:text element with the new elements, keeping its tail
+        tail = node.tail
+        node.tail = None
+        parent = node.getparent()
+        index = parent.index(node)
+        parent.remove(node)
+        for offset, new_node in enumerate(new_nodes):
+            parent.insert(index + offset, new_node)
+        if tail:
+            last = new_nodes[-1]
+            last.tail = (last.tail or "") + tail
+    return
+
+class _BufferFile(object):
+    '''
+    Read-only, seekable file object over a buffer (bytearray, memoryview, mmap
+    or the like), for zipfile and lxml to read from; unlike io.BytesIO, it does
+    not copy the buffer first: each read copies just what it returns
+    '''
+
+    def __init__(self, data):
+        try:
+            self._view = memoryview(data)
+        except TypeError:   # (Python 2 mmap: no memoryview)
+            self._view = memoryview(data[:])
+        self._position = 0
+
+    def read(self, size=-1):
+        start = min(self._position, len(self._view))
+        if size is None or size < 0:
+            end = len(self._view)
+        else:
+            end = min(start + size, len(self._view))
+        self._position = end
+        return self._view[start:end].tobytes()
+
+    def seek(self, offset, whence=0):
+        if whence == 1:
+            offset += self._position
+        elif whence == 2:
+            offset += len(self._view)
+        if offset < 0:
+            raise ValueError("negative seek position %d" % offset)
+        self._position = offset
+        return offset
+
+    def tell(self):
+        return self._position
+
+    def seekable(self):
+        return True
+
+    def readable(self):
+        return True
+
+    def close(self):
+        pass
+
+def _buffer_file(data):
+    '''
+    A file object reading data (bytes, or another buffer), without copying it
+    '''
+    if isinstance(data, bytes):
+        return bytesio(data)    # (io.BytesIO shares, rather than copies, bytes)
+    return _BufferFile(data)
+
+def _buffer_bytes(data):
+    '''
+    data (bytes, or another buffer) as bytes
+    '''
+    if isinstance(data, bytes):
+        return data
+    return _BufferFile(data).read()
+
+# Local files at least this large are memory-mapped rather than read (see _map_file);
+# smaller ones are read, as mapping them gains nothing (and, on Windows, a mapped
+# file cannot be deleted while the data is kept)
+_MMAP_MIN_SIZE = 1024 * 1024
+
+def _map_file(f):
+    '''
+    The contents of f, a file object open for reading bytes, from its current
+    position: without reading them, if possible (a memory-mapped regular file of
+    at least _MMAP_MIN_SIZE, or the value of an io.BytesIO, which it shares);
+    otherwise, as read
+    '''
+    if hasattr(f, "getvalue"):
+        position = f.tell()
+        return f.getvalue() if position == 0 else f.getvalue()[position:]
+    try:
+        if f.tell() == 0 and os.fstat(f.fileno()).st_size >= max(_MMAP_MIN_SIZE, 1):
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (AttributeError, IOError, OSError, ValueError):
+        pass    # not a regular file
+    return f.read()
+
+def _map_fields(fields, projection=None):
+    '''
+    Map (key, value) fields, in the order written by the transform, into the
+    dictionaries for a TSDR map (see TSDRReq.getTSDRData).
+    If projection (a set of TSDRSingle keys and TSDRMulti list names) is given,
+    other fields are skipped; repeated fields not in it are never built.
+    Returns (tsdr_single, tsdr_multi).
+    '''
+    repeated_item_dict = {}
+    output_dict = {}
+    current_dict = output_dict
+    for key, data in fields:
+        if key == "BeginRepeatedField":
+            if projection is None or data+"List" in projection:
+                current_dict = dict()
+            else:
+                current_dict = None     # skip to the EndRepeatedField
+        elif key == "EndRepeatedField":
+            if current_dict is not None:
+                # first time, allocate an empty list to be added to;
+                # else re-use existing list
+                if data+"List" not in repeated_item_dict:
+                    repeated_item_dict[data+"List"] = []
+                repeated_item_dict[data+"List"].append(current_dict)
+            # done processing list, resume regular output
+            current_dict = output_dict
+        elif current_dict is output_dict:
+            if projection is None or key in projection:
+                output_dict[key] = data
+        elif current_dict is not None:
+            current_dict[key] = data
+    return output_dict, repeated_item_dict
+
+class _CompiledXSLTCache(object):
+    '''
+    LRU cache of compiled caller-supplied XSLT transforms (see TSDRReq.setXSLT
+    and setXSLTFile), keyed by a hash of the stylesheet text, so that a
+    stylesheet used for many requests is compiled only once per process.
+      max_entries: number of compiled transforms kept
+      compilations: number of stylesheets compiled so far (for diagnostics)
+    '''
+
+    def __init__(self, max_entries=32):
+        self.max_entries = max_entries
+        self.compilations = 0
+        # digest -> (transform, needs_substitution); least recently used first
+        self._transforms = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def compile(self, stylesheet, digest=None):
+        '''
+        Compiled stylesheet (bytes), as (transform, needs_substitution); see
+        _compile_stylesheet. digest, if given, is _stylesheet_digest(stylesheet),
+        already computed by the caller
+        '''
+        if digest is None:
+            digest = _stylesheet_digest(stylesheet)
+        with self._lock:
+            compiled = self._transforms.pop(digest, None)
+            if compiled is not None:
+                self._transforms[digest] = compiled    # now most recently used
+                return compiled
+        # compile outside the lock; if two threads race, both compile, one is kept
+        compiled = _compile_stylesheet(stylesheet)
+        with self._lock:
+            self.compilations += 1
+            self._transforms[digest] = compiled
+            while len(self._transforms) > self.max_entries:
+                self._transforms.popitem(last=False)
+        return compiled
+
+    def clear(self):
+        with self._lock:
+            self._transforms.clear()
+        return
+
+_compiled_xslt_cache = _CompiledXSLTCache()
+
+class _XSLTFileCache(object):
+    '''
+    Contents of stylesheet files named in TSDRReq.setXSLTFile, re-read only
+    when a file's modification time (or size) changes
+    '''
+
+    def __init__(self):
+        self._files = {}    # pathname -> ((mtime, size), stylesheet, digest)
+        self._lock = threading.Lock()
+
+    def read(self, pathname):
+        '''
+        Returns (stylesheet, digest) for the current contents of pathname
+        '''
+        info = os.stat(pathname)
+        version = (info.st_mtime, info.st_size)
+        with self._lock:
+            entry = self._files.get(pathname)
+        if entry is not None and entry[0] == version:
+            return entry[1], entry[2]
+        with open(pathname, "rb") as f:
+            stylesheet = f.read()
+        digest = _stylesheet_digest(stylesheet)
+        with self._lock:
+            self._files[pathname] = (version, stylesheet, digest)
+        return stylesheet, digest
+
+_xslt_file_cache = _XSLTFileCache()
+
+def _stylesheet_digest(stylesheet):
+    return hashlib.sha1(stylesheet).hexdigest()
+
+def _unverified_ssl_context():
+    '''
+    SSL context used for PTO fetches (PEP 476); None if not supported
+    '''
+    if SSL_INSTALLED:
+        try:
+            return ssl._create_unverified_context()
+        except AttributeError:
+            return None
+    return None
+
+class TSDRConnectionPool(object):
+    '''
+    Pool of persistent (keep-alive) HTTP/HTTPS connections, used for fetches from
+    the PTO so that each fetch does not pay for a new TCP and TLS handshake.
+
+    Idle connections are kept per host (scheme, host name and port); a connection
+    is checked out by one thread for the duration of a request and then returned,
+    so any number of threads can share one pool.
+      max_connections: maximum number of idle connections kept per host; a request
+        that finds none idle opens a new one, and connections beyond this limit
+        are closed after use rather than kept
+      idle_timeout: idle connections older than this many seconds are closed
+        rather than reused (as are idle asyncio connections whose event loop
+        has closed)
+      timeout: socket timeout, in seconds, for each request
+      ssl_context: SSL context for HTTPS connections
+    A pooled connection that the server has since closed is detected before
+    reuse where possible; if a request on a reused connection fails before any
+    response arrives, it is retried once on a new connection.
+
+    Counters (for diagnostics):
+      connections_opened: new connections made
+      connections_reused: requests sent on a pooled connection
+      stale_connections: pooled connections discarded as closed by the server
+    '''
+
+    REDIRECT_CODES = (301, 302, 303, 307, 308)
+    MAX_REDIRECTS = 5
+    DEFAULT_PORTS = {"http" : 80, "https" : 443}
+
+    def __init__(self, max_connections=10, idle_timeout=30, timeout=60, ssl_context=None):
+        '''
+        Initialize an (empty) connection pool
+        '''
+        if max_connections < 0:
+            raise ValueError("max_connections must not be negative")
+        self.max_connections = max_connections
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        self.ssl_context = ssl_context
+        self.connections_opened = 0
+        self.connections_reused = 0
+        self.stale_connections = 0
+        self._idle = {}     # key -> list of (connection, time returned to pool)
+        self._lock = threading.Lock()
+
+    def get(self, url, headers=None, timeout=None):
+        '''
+        HTTP GET, following redirects; headers is an optional dictionary of
+        additional request headers (e.g., If-None-Match); timeout, if given, caps
+        the pool's socket timeout for this request (e.g., at a retry deadline).
+        Returns a tuple (status, reason, headers, body):
+          status: HTTP status code (e.g. 200, 404)
+          reason: HTTP reason phrase
+          headers: response headers (a message object, as in HTTPError.hdrs)
+          body: response body, as bytes
+        '''
+        for _ in range(self.MAX_REDIRECTS + 1):
+            status, reason, response_headers, body = self._get_once(url, headers, timeout)
+            location = response_headers.get("Location")
+            if status in self.REDIRECT_CODES and location is not None:
+                url = URL_join(url, location)
+                continue
+            return status, reason, response_headers, body
+        raise HTTPError(url, status, "too many redirects", response_headers, None)
+
+    def close(self):
+        '''
+        Close all idle connections
+        '''
+        with self._lock:
+            idle, self._idle = self._idle, {}
+        for entries in idle.values():
+            for connection, _ in entries:
+                self._close_quietly(connection)
+        return
+
+    def _get_once(self, url, headers=None, timeout=None):
+        '''
+        One GET, without following redirects
+        '''
+        if timeout is None or (self.timeout is not None and self.timeout < timeout):
+            timeout = self.timeout
+        parts = URL_split(url)
+        scheme = parts.scheme.lower()
+        if scheme not in self.DEFAULT_PORTS:
+            raise ValueError("unsupported URL scheme '%s'" % parts.scheme)
+        host = parts.hostname
+        port = parts.port or self.DEFAULT_PORTS[scheme]
+        path = parts.path or "/"
+        if parts.query:
+            path = path + "?" + parts.query
+        request_headers = {
+            "User-Agent" : "Plumage-py/%s" % __version__,
+            "Accept-Encoding" : "identity"
+            }
+        if headers:
+            request_headers.update(headers)
+        key = ("http.client", scheme, host, port)
+
+        connection = self._checkout(key, self._socket_is_stale)
+        reused = connection is not None
+        if reused:
+            self._count("connections_reused")
+            # this request's timeout, not the one the connection was last used with
+            connection.timeout = timeout
+            if connection.sock is not None:
+                connection.sock.settimeout(timeout)
+        else:
+            connection = self._new_connection(scheme, host, port, timeout)
+        try:
+            connection.request("GET", path, headers=request_headers)
+            response = connection.getresponse()
+            body = response.read()
+        except (http_client.BadStatusLine, socket.error):
+            connection.close()
+            if not reused:
+                raise
+            # server closed the pooled connection (e.g., its keep-alive timeout
+            # expired); GET is idempotent, so retry once on a fresh connection
+            self._count("stale_connections")
+            connection = self._new_connection(scheme, host, port, timeout)
+            try:
+                connection.request("GET", path, headers=request_headers)
+                response = connection.getresponse()
+                body = response.read()
+            except Exception:
+                connection.close()
+                raise
+        if response.will_close:
+            connection.close()
+        else:
+            self._checkin(key, connection)
+        return response.status, response.reason, response.msg, body
+
+    def _new_connection(self, scheme, host, port, timeout):
+        '''
+        Open a new HTTP or HTTPS connection
+        '''
+        self._count("connections_opened")
+        if scheme == "https":
+            if self.ssl_context is not None:
+                return http_client.HTTPSConnection(host, port, timeout=timeout,
+                                                   context=self.ssl_context)
+            return http_client.HTTPSConnection(host, port, timeout=timeout)
+        return http_client.HTTPConnection(host, port, timeout=timeout)
+
+    def _checkout(self, key, is_stale):
+        '''
+        Take the most recently used idle connection for key from the pool,
+        discarding any that have expired or that is_stale(connection) reports
+        as closed by the server. Returns None if no usable connection is idle.
+        '''
+        now = time.time()
+        discards = []
+        connection = None
+        with self._lock:
+            self._expire_idle(now, discards)
+            entries = self._idle.get(key, [])
+            while entries:
+                candidate, _ = entries.pop()
+                if is_stale(candidate):
+                    self.stale_connections += 1
+                    discards.append(candidate)
+                else:
+                    connection = candidate
+                    break
+        for discard in discards:
+            self._close_quietly(discard)
+        return connection
+
+    def _checkin(self, key, connection):
+        '''
+        Return a connection to the pool, or close it if the pool is full
+        '''
+        now = time.time()
+        discards = []
+        with self._lock:
+            self._expire_idle(now, discards)
+            entries = self._idle.setdefault(key, [])
+            if len(entries) < self.max_connections:
+                entries.append((connection, now))
+                connection = None
+        if connection is not None:
+            discards.append(connection)
+        for discard in discards:
+            self._close_quietly(discard)
+        return
+
+    def _expire_idle(self, now, discards):
+        '''
+        Move idle connections older than idle_timeout, or defunct (an asyncio
+        connection whose event loop has closed), to discards (lock held)
+        '''
+        def usable(connection, returned):
+            return now - returned <= self.idle_timeout and \
+                   not getattr(connection, "defunct", False)
+        for key in list(self._idle):
+            entries = self._idle[key]
+            keep = [(c, returned) for (c, returned) in entries if usable(c, returned)]
+            discards.extend(c for (c, returned) in entries if not usable(c, returned))
+            if keep:
+                self._idle[key] = keep
+            else:
+                del self._idle[key]
+        return
+
+    def _socket_is_stale(self, connection):
+        '''
+        An idle keep-alive socket should have nothing to read; if it is readable,
+        the server has closed it (or sent something unexpected). Either way, it
+        can't be reused.
+        '''
+        sock = connection.sock
+        if sock is None:
+            return False    # not connected; http.client will reconnect
+        try:
+            readable, _, _ = select.select([sock], [], [], 0)
+        except (ValueError, socket.error):
+            return True
+        return len(readable) > 0
+
+    def _count(self, counter):
+        '''
+        Increment one of the diagnostic counters
+        '''
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+        return
+
+    def _close_quietly(self, connection):
+        try:
+            connection.close()
+        except Exception:
+            pass
+        return
+
+# Pool shared by all TSDRReq objects that don't specify one (see TSDRReq.setConnectionPool)
+_shared_connection_pool = None
+_shared_connection_pool_lock = threading.Lock()
+
+def sharedConnectionPool():
+    '''
+    Return the process-wide TSDRConnectionPool used by default for PTO fetches,
+    creating it on first use
+    '''
+    global _shared_connection_pool
+    with _shared_connection_pool_lock:
+        if _shared_connection_pool is None:
+            _shared_connection_pool = TSDRConnectionPool(ssl_context=_unverified_ssl_context())
+        return _shared_connection_pool
+
+class TSDRCacheEntry(object):
+    '''
+    One cached PTO response, as returned by TSDRResponseCache.get
+      data: raw response body (bytes), exactly as received from the PTO
+      url: URL it was fetched from
+      stored: time (seconds since the epoch) it was fetched
+      expires: time (seconds since the epoch) after which it is no longer fresh
+      fresh: True if not yet expired when looked up
+      etag, last_modified: the ETag and Last-Modified response headers, if the
+        PTO sent them (None if not); used to revalidate the entry once it expires
+    '''
+
+    def __init__(self, data, url, stored, expires, fresh, etag=None, last_modified=None):
+        '''
+        initialize a TSDRCacheEntry
+        '''
+        self.data = data
+        self.url = url
+        self.stored = stored
+        self.expires = expires
+        self.fresh = fresh
+        self.etag = etag
+        self.last_modified = last_modified
+
+    def validator(self):
+        '''
+        Identifies the version of the PTO data held in this entry: (etag, last_modified);
+        or None if the PTO sent neither, in which case the entry cannot be revalidated
+        '''
+        if self.etag is None and self.last_modified is None:
+            return None
+        return (self.etag, self.last_modified)
+
+    def conditionalHeaders(self):
+        '''
+        Request headers asking the PTO to send the data only if changed since this entry
+        '''
+        headers = {}
+        if self.etag is not None:
+            headers["If-None-Match"] = self.etag
+        if self.last_modified is not None:
+            headers["If-Modified-Since"] = self.last_modified
+        return headers
+
+class TSDRResponseCache(object):
+    '''
+    On-disk cache of raw PTO responses, keyed by (tmtype, number, PTOFormat).
+
+    Each entry is one file in directory, written atomically (to a temporary file,
+    then renamed into place), so several processes can share one directory.
+      ttl: default time-to-live, in seconds, of an entry; put() can override it
+        per entry. Expired entries are not returned by get() (but remain on disk
+        until evicted or replaced). An expired entry whose ETag or Last-Modified
+        is known is revalidated with a conditional request; if the PTO answers
+        304 (not modified), the cached data is used and the entry renewed.
+      max_bytes: cap on the total size of the cache directory; when it is
+        exceeded, least-recently-used entries are evicted. Usage is tracked
+        per process and re-checked against the directory every rescan_interval
+        stores, so entries written by other processes are eventually counted.
+
+    Counters (for this process only):
+      hits: lookups answered from the cache
+      misses: lookups not answered (no entry, expired, or unreadable)
+      evictions: entries removed to stay under max_bytes
+      full_fetches: full responses from the PTO stored (by put; renew is counted
+        as a revalidation instead)
+      revalidations: expired entries renewed after a 304 (not modified) response
+      bytes_saved: size of the responses not downloaded again, thanks to revalidation
+    '''
+
+    FILE_SUFFIX = ".tsdr"
+    TEMP_PREFIX = ".tmp-"
+    TEMP_FILE_MAX_AGE = 3600    # leftover temp files (crashed writers) older than this are removed
+
+    def __init__(self, directory, ttl=24*60*60, max_bytes=1024*1024*1024, rescan_interval=100):
+        '''
+        Initialize a response cache in directory (created if it does not exist)
+        '''
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                if not os.path.isdir(directory):   # lost a race with another process? fine
+                    raise
+        self.directory = directory
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.rescan_interval = rescan_interval
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.full_fetches = 0
+        self.revalidations = 0
+        self.bytes_saved = 0
+        self._lock = threading.Lock()
+        self._size_estimate = None   # unknown until first scan
+        self._stores_since_scan = 0
+
+    def get(self, key, include_stale=False):
+        '''
+        Look up key, a (tmtype, number, PTOFormat) tuple. Returns a TSDRCacheEntry
+        if a fresh entry exists; otherwise None. If include_stale is True, an
+        expired entry that can be revalidated is returned too (with fresh False),
+        though it counts as a miss.
+        '''
+        entry = self._read(key)
+        if entry is None or not entry.fresh:
+            self._count("misses")
+            if entry is not None and include_stale and entry.validator() is not None:
+                return entry
+            return None
+        self._count("hits")
+        self._touch(key)
+        return entry
+
+    def put(self, key, url, data, ttl=None, etag=None, last_modified=None):
+        '''
+        Store data (raw response bytes, fetched from url) under key,
+        a (tmtype, number, PTOFormat) tuple; ttl defaults to self.ttl.
+        etag and last_modified are the response's ETag and Last-Modified headers, if any.
+        '''
+        self._store(key, url, data, ttl, etag, last_modified)
+        self._count("full_fetches")
+        return
+
+    def _store(self, key, url, data, ttl=None, etag=None, last_modified=None):
+        '''
+        Write an entry (see put), without counting it
+        '''
+        if ttl is None:
+            ttl = self.ttl
+        stored = time.time()
+        header = {"url" : url, "stored" : stored, "expires" : stored + ttl,
+                  "etag" : etag, "last_modified" : last_modified}
+        header_line = json.dumps(header, sort_keys=True).encode("utf-8") + b"\n"
+        path = self._path(key)
+        fd, temp_path = tempfile.mkstemp(dir=self.directory, prefix=self.TEMP_PREFIX)
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(header_line)
+                f.write(data)
+            _replace_file(temp_path, path)
+        except BaseException:
+            _remove_quietly(temp_path)
+            raise
+        with self._lock:
+            if self._size_estimate is not None:
+                self._size_estimate += len(header_line) + len(data)
+            self._stores_since_scan += 1
+            rescan = (self._size_estimate is None or
+                      self._size_estimate > self.max_bytes or
+                      self._stores_since_scan >= self.rescan_interval)
+        if rescan:
+            self._evict()
+        return
+
+    def renew(self, key, entry, ttl=None, etag=None, last_modified=None):
+        '''
+        Renew entry (as returned by get(key, include_stale=True)) after the PTO
+        has reported it not modified: store it again, with a new expiration time
+        (and any new ETag or Last-Modified the 304 response carried)
+        '''
+        self._store(key, entry.url, entry.data, ttl,
+                    etag if etag is not None else entry.etag,
+                    last_modified if last_modified is not None else entry.last_modified)
+        with self._lock:
+            self.revalidations += 1
+            self.bytes_saved += len(entry.data)
+        return
+
+    def invalidate(self, key):
+        '''
+        Remove the entry for key, if any
+        '''
+        _remove_quietly(self._path(key))
+        return
+
+    def clear(self):
+        '''
+        Remove all entries
+        '''
+        for name in os.listdir(self.directory):
+            if name.endswith(self.FILE_SUFFIX):
+                _remove_quietly(os.path.join(self.directory, name))
+        with self._lock:
+            self._size_estimate = None
+        return
+
+    def _path(self, key):
+        tmtype, number, PTOFormat = key
+        # all three parts are validated (letters and digits only) before fetching
+        return os.path.join(self.directory,
+                            "%s-%sn%s%s" % (PTOFormat, tmtype, number, self.FILE_SUFFIX))
+
+    def _read(self, key):
+        '''
+        Read the entry for key, fresh or not; None if absent or unreadable
+        '''
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f:
+                contents = f.read()
+        except (IOError, OSError):
+            return None
+        header_line, separator, data = contents.partition(b"\n")
+        try:
+            header = json.loads(header_line.decode("utf-8"))
+            url, stored, expires = header["url"], header["stored"], header["expires"]
+        except (ValueError, KeyError, TypeError):
+            _remove_quietly(path)    # corrupt; get rid of it
+            return None
+        if not separator:
+            _remove_quietly(path)
+            return None
+        return TSDRCacheEntry(data, url, stored, expires, time.time() < expires,
+                              header.get("etag"), header.get("last_modified"))
+
+    def _touch(self, key):
+        '''
+        Mark an entry as recently used (file modification time drives LRU eviction)
+        '''
+        try:
+            os.utime(self._path(key), None)
+        except OSError:
+            pass
+        return
+
+    def _evict(self):
+        '''
+        Scan the cache directory; evict least-recently-used entries until the
+        total size is within max_bytes
+        '''
+        now = time.time()
+        entries = []
+        total = 0
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            try:
+                info = os.stat(path)
+            except OSError:
+                continue    # removed by another process meanwhile
+            if name.startswith(self.TEMP_PREFIX):
+                if now - info.st_mtime > self.TEMP_FILE_MAX_AGE:
+                    _remove_quietly(path)
+                continue
+            if name.endswith(self.FILE_SUFFIX):
+                entries.append((info.st_mtime, info.st_size, path))
+                total += info.st_size
+        entries.sort()
+        evicted = 0
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            _remove_quietly(path)
+            total -= size
+            evicted += 1
+        with self._lock:
+            self._size_estimate = total
+            self._stores_since_scan = 0
+            self.evictions += evicted
+        return
+
+    def _count(self, counter):
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+        return
+
+class TSDRMapCache(object):
+    '''
+    In-memory LRU cache of finished TSDR maps, so that a mark already resolved
+    need not be fetched, transformed and mapped again.
+
+    Bounded both by number of entries (max_entries) and by approximate memory
+    use (max_bytes); least-recently-used entries are evicted to stay within both.
+    Entries expire ttl seconds after being stored (put() can override ttl per entry).
+    An expired entry stays until evicted or replaced: if it was built from a PTO
+    response that is later revalidated (see TSDRResponseCache), it is reused,
+    rather than transforming the same data again.
+    The cache keeps its own copy of each map, and get() returns a fresh copy
+    (see TSDRMap.copy), so no caller can alter another caller's result.
+    Safe for use from multiple threads.
+
+    Counters:
+      hits: lookups answered from the cache
+      misses: lookups not answered (no entry, or expired)
+      evictions: entries removed to stay within max_entries/max_bytes
+    '''
+
+    def __init__(self, max_entries=1000, max_bytes=64*1024*1024, ttl=60*60):
+        '''
+        Initialize an (empty) TSDR map cache
+        '''
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.size = 0   # approximate bytes held
+        # key -> (TSDRMap, expires, size, ttl, validator); least recently used first
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, validator=None):
+        '''
+        Return a copy of the TSDRMap stored under key; or None if there is none,
+        or it has expired. If validator is given, an expired entry is returned
+        (and renewed) if it was stored with the same validator: it was built from
+        the same version of the PTO data, which the PTO has just reported unchanged.
+        '''
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and now >= entry[1]:
+                if validator is not None and validator == entry[4]:
+                    entry = (entry[0], now + entry[3]) + entry[2:]
+                else:
+                    entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            del self._entries[key]
+            self._entries[key] = entry    # re-insert as most recently used
+            self.hits += 1
+        return entry[0].copy()
+
+    def put(self, key, tsdrmap, ttl=None, validator=None):
+        '''
+        Store a copy of tsdrmap (only if valid) under key. validator identifies the
+        version of the PTO data it was built from (see TSDRCacheEntry.validator), if known.
+        '''
+        if not tsdrmap.TSDRMapIsValid:
+            return
+        if ttl is None:
+            ttl = self.ttl
+        stored_map = tsdrmap.copy()
+        size = self._approximate_size(stored_map)
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.size -= old[2]
+            self._entries[key] = (stored_map, time.time() + ttl, size, ttl, validator)
+            self.size += size
+            while self._entries and (len(self._entries) > self.max_entries or
+                                     self.size > self.max_bytes):
+                _, evicted = self._entries.popitem(last=False)
+                self.size -= evicted[2]
+                self.evictions += 1
+        return
+
+    def invalidate(self, key):
+        '''
+        Remove the entry for key, if any
+        '''
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self.size -= entry[2]
+        return
+
+    def clear(self):
+        '''
+        Remove all entries
+        '''
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+        return
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _approximate_size(self, tsdrmap):
+        '''
+        Approximate memory used by a TSDRMap: its dictionaries, lists, keys and values
+        '''
+        def dict_size(d):
+            return sys.getsizeof(d) + sum(sys.getsizeof(k) + sys.getsizeof(v)
+                                          for k, v in d.items())
+        size = dict_size(tsdrmap.TSDRSingle)
+        size += sys.getsizeof(tsdrmap.TSDRMulti)
+        for list_name, items in tsdrmap.TSDRMulti.items():
+            size += sys.getsizeof(list_name) + sys.getsizeof(items)
+            size += sum(dict_size(item) for item in items)
+        return size
+
+class TSDRRetryPolicy(object):
+    '''
+    When, and after how long a wait, to retry a PTO fetch that failed transiently:
+    an HTTP status in retry_statuses (by default, 429 (too many requests) and
+    500, 502, 503, 504), or a network error (connection refused or reset, timeout).
+
+      max_attempts: maximum number of attempts, including the first
+      backoff: wait, in seconds, before the first retry; doubled for each
+        further retry, up to max_backoff
+      jitter: fraction (0 to 1) of each wait that is randomized, so that many
+        clients throttled at once do not all retry at once
+      deadline: if not None, the whole fetch, retries and all, is bounded to
+        this many seconds after the first attempt starts: no attempt is started
+        after it, each attempt's timeout is capped at the time remaining, and a
+        rate limiter wait that would pass it is not waited out (socket.timeout
+        is raised at once, as by an attempt that times out)
+    A Retry-After header (seconds, or an HTTP date) on the response is respected,
+    as a minimum wait, even beyond max_backoff; but not beyond the deadline.
+    '''
+
+    RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+    def __init__(self, max_attempts=5, backoff=1, max_backoff=60, jitter=0.5,
+                 deadline=None, retry_statuses=RETRY_STATUSES):
+        '''
+        Initialize a retry policy
+        '''
+        if max_attempts < 1:
+            raise ValueError("max_attempts must be at least 1")
+        if not 0 <= jitter <= 1:
+            raise ValueError("jitter must be from 0 to 1")
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.jitter = jitter
+        self.deadline = deadline
+        self.retry_statuses = tuple(retry_statuses)
+
+    def retryDelay(self, attempt, elapsed, status=None, headers=None, exception=None):
+        '''
+        Decide whether to retry after attempt number attempt (counting from 1),
+        elapsed seconds after the first attempt started, which ended with either
+        an HTTP response (status and headers) or an exception.
+        Returns the number of seconds to wait before retrying; or None not to retry.
+        '''
+        if exception is not None:
+            if not self._is_transient(exception):
+                return None
+        elif status not in self.retry_statuses:
+            return None
+        if attempt >= self.max_attempts:
+            return None
+        delay = min(self.max_backoff, self.backoff * (2 ** (attempt - 1)))
+        delay -= delay * self.jitter * random.random()
+        retry_after = _retry_after_seconds(_response_header(headers, "Retry-After"))
+        if retry_after is not None:
+            delay = max(delay, retry_after)
+        if self.deadline is not None and elapsed + delay > self.deadline:
+            return None
+        return delay
+
+    def remaining(self, elapsed):
+        '''
+        Seconds left before the deadline, elapsed seconds after the first attempt
+        started (negative, once passed); None if there is no deadline
+        '''
+        if self.deadline is None:
+            return None
+        return self.deadline - elapsed
+
+    def _is_transient(self, exception):
+        '''
+        Network errors are worth retrying; HTTP errors (the status decides) and
+        anything else (e.g., a malformed URL) are not
+        '''
+        if isinstance(exception, HTTPError):
+            return False
+        return isinstance(exception, (socket.error, URLError, http_client.HTTPException, EOFError))
+
+class TSDRRateLimiter(object):
+    '''
+    Token-bucket limit on the rate of requests to the PTO: on average no more than
+    rate requests per second, with bursts of up to burst requests at once.
+
+    Implemented as a schedule of reserved send times (the "generic cell rate
+    algorithm" form of a token bucket), so the limit is never exceeded, however
+    many threads, async tasks, or (with path) processes share the limiter:
+    each request reserves the next available slot, and waits until it arrives.
+      path: if given, the schedule is kept in this file (created if necessary),
+        locked while updated, so every process using the same path, on one
+        machine, shares one limit. If None, the limit applies to this process only.
+
+    Counters (for this process only):
+      requests: requests admitted
+      delayed: requests that had to wait
+      wait_seconds: total time waited
+    '''
+
+    def __init__(self, rate, burst=1, path=None):
+        '''
+        Initialize a rate limiter, initially full (burst requests may go at once)
+        '''
+        if rate <= 0:
+            raise ValueError("rate must be positive")
+        if burst < 1:
+            raise ValueError("burst must be at least 1")
+        self.rate = rate
+        self.burst = burst
+        self.path = path
+        self.requests = 0
+        self.delayed = 0
+        self.wait_seconds = 0.0
+        self._interval = 1.0 / rate
+        self._tolerance = (burst - 1) * self._interval
+        self._next_time = 0.0   # theoretical arrival time of the next request
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        '''
+        Wait (block) until a request may be sent; returns the time waited, in seconds
+        '''
+        delay = self.reserve()
+        if delay > 0:
+            time.sleep(delay)
+        return delay
+
+    def reserve(self):
+        '''
+        Reserve the next slot for a request, without waiting; returns the number
+        of seconds to wait before sending it (0 if it may go now). For async
+        callers:
+            await asyncio.sleep(limiter.reserve())
+        '''
+        with self._lock:
+            if self.path is None:
+                delay = self._reserve_slot(time.time())
+            else:
+                delay = self._reserve_shared_slot()
+            self.requests += 1
+            if delay > 0:
+                self.delayed += 1
+                self.wait_seconds += delay
+        return delay
+
+    def _reserve_slot(self, now):
+        '''
+        Take the next slot in the schedule, as of now; returns seconds until it arrives
+        '''
+        next_time = max(self._next_time, now)
+        send_time = max(now, next_time - self._tolerance)
+        self._next_time = next_time + self._interval
+        return send_time - now
+
+    def _reserve_shared_slot(self):
+        '''
+        _reserve_slot, with the schedule kept in (and locked in) the shared file
+        '''
+        # opened afresh each time: a file lock shared through a descriptor
+        # inherited across fork() would not exclude the other process
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o666)
+        try:
+            _lock_file(fd)
+            try:
+                contents = os.read(fd, 64)
+                try:
+                    self._next_time = float(contents.decode("ascii"))
+                except ValueError:
+                    self._next_time = 0.0   # new (or damaged) file: start full
+                delay = self._reserve_slot(time.time())
+                os.lseek(fd, 0, os.SEEK_SET)
+                os.write(fd, ("%.6f" % self._next_time).ljust(32).encode("ascii"))
+            finally:
+                _unlock_file(fd)
+        finally:
+            os.close(fd)
+        return delay
+
+def _lock_file(fd):
+    '''
+    Take an exclusive lock on an open file, waiting as long as necessary
+    '''
+    if fcntl is not None:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        return
+    os.lseek(fd, 0, os.SEEK_SET)
+    while True:
+        try:
+            msvcrt.locking(fd, msvcrt.LK_LOCK, 1)
+            return
+        except (IOError, OSError):
+            pass    # LK_LOCK gives up after 10 seconds; keep waiting
+
+def _unlock_file(fd):
+    if fcntl is not None:
+        fcntl.flock(fd, fcntl.LOCK_UN)
+        return
+    os.lseek(fd, 0, os.SEEK_SET)
+    msvcrt.locking(fd, msvcrt.LK_UNLCK, 1)
+
+# Rate limiter shared by all TSDRReq objects that don't specify one (see setSharedRateLimiter)
+_shared_rate_limiter = None
+
+def setSharedRateLimiter(rate_limiter):
+    '''
+    Set the process-wide TSDRRateLimiter applied to PTO fetches by every TSDRReq
+    that does not specify its own (see TSDRReq.setRateLimiter); None for no limit
+    '''
+    global _shared_rate_limiter
+    _shared_rate_limiter = rate_limiter
+    return
+
+def sharedRateLimiter():
+    '''
+    Return the process-wide TSDRRateLimiter (None, unless set by setSharedRateLimiter)
+    '''
+    return _shared_rate_limiter
+
+# Time (seconds) and size (bytes, or None if not measured) of one processing stage;
+# see TSDRReq.setRecordTimings
+TSDRStageTiming = collections.namedtuple("TSDRStageTiming", ["seconds", "bytes"])
+
+class _StageStatistics(object):
+    '''
+    Running statistics of one stage, for TSDRTimingAggregator
+    '''
+
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+        self.bytes = 0
+        self.sample = []
+
+class TSDRTimingAggregator(object):
+    '''
+    Running statistics of the stage timings of every TSDRReq in the process (see
+    setTimingAggregator): for each stage, the number timed, their total time and
+    bytes, and percentiles of the time taken. The percentiles are of a uniform
+    random sample (a reservoir) of at most sample_size timings per stage, so that
+    memory use stays the same however many TSDRReqs are timed.
+    '''
+
+    def __init__(self, sample_size=1000):
+        '''
+        Initialize a timing aggregator, with no timings
+        '''
+        if sample_size < 1:
+            raise ValueError("sample_size must be at least 1")
+        self.sample_size = sample_size
+        self._stages = collections.OrderedDict()   # stage: _StageStatistics, in order first timed
+        self._random = random.Random()
+        self._lock = threading.Lock()
+
+    def add(self, stage, seconds, nbytes=None):
+        '''
+        Add one timing of stage
+        '''
+        with self._lock:
+            statistics = self._stages.get(stage)
+            if statistics is None:
+                statistics = self._stages[stage] = _StageStatistics()
+            statistics.count += 1
+            statistics.seconds += seconds
+            if nbytes is not None:
+                statistics.bytes += nbytes
+            if len(statistics.sample) < self.sample_size:
+                statistics.sample.append(seconds)
+            else:
+                # reservoir sampling: the new timing replaces one at random, with
+                # probability sample_size/count, so every timing is equally likely kept
+                slot = self._random.randrange(statistics.count)
+                if slot < self.sample_size:
+                    statistics.sample[slot] = seconds
+        return
+
+    def stages(self):
+        '''
+        Names of the stages timed, in the order first timed
+        '''
+        with self._lock:
+            return list(self._stages)
+
+    def percentile(self, stage, percent):
+        '''
+        Time (seconds) taken by stage at the given percentile (0 to 100), as
+        interpolated from the sample; KeyError if the stage has not been timed
+        '''
+        if not 0 <= percent <= 100:
+            raise ValueError("percent must be between 0 and 100")
+        with self._lock:
+            sample = sorted(self._stages[stage].sample)
+        return _percentile(sample, percent)
+
+    def summary(self, percents=(50, 90, 99)):
+        '''
+        Dictionary, by stage (in the order first timed), of dictionaries of that
+        stage's statistics: count, seconds (total), bytes (total), mean (seconds),
+        and "p50", etc. (seconds) for each of percents
+        '''
+        result = collections.OrderedDict()
+        with self._lock:
+            stages = [(stage, statistics.count, statistics.seconds, statistics.bytes,
+                       sorted(statistics.sample))
+                      for stage, statistics in self._stages.items()]
+        for stage, count, seconds, nbytes, sample in stages:
+            statistics = {"count" : count, "seconds" : seconds, "bytes" : nbytes,
+                          "mean" : seconds / count}
+            for percent in percents:
+                statistics["p%s" % percent] = _percentile(sample, percent)
+            result[stage] = statistics
+        return result
+
+    def reset(self):
+        '''
+        Discard all timings
+        '''
+        with self._lock:
+            self._stages.clear()
+        return
+
+def _percentile(sorted_values, percent):
+    '''
+    Value at percent (0 to 100) of sorted_values (not empty), interpolating
+    linearly between the two nearest
+    '''
+    position = (len(sorted_values) - 1) * percent / 100.0
+    lower = int(position)
+    upper = min(lower + 1, len(sorted_values) - 1)
+    return sorted_values[lower] + (sorted_values[upper] - sorted_values[lower]) * (position - lower)
+
+_timing_aggregator = None
+
+def setTimingAggregator(aggregator):
+    '''
+    Set the process-wide TSDRTimingAggregator, to which every TSDRReq adds its
+    stage timings (timing them even if not set to; see TSDRReq.setRecordTimings);
+    None (default) for none
+    '''
+    global _timing_aggregator
+    _timing_aggregator = aggregator
+    return
+
+def timingAggregator():
+    '''
+    Return the process-wide TSDRTimingAggregator (None, unless set by setTimingAggregator)
+    '''
+    return _timing_aggregator
+
+def _retry_after_seconds(value):
+    '''
+    Seconds to wait according to a Retry-After header value (a number of seconds,
+    or an HTTP date); None if absent or unparseable
+    '''
+    if value is None:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return int(value)
+    parsed = email.utils.parsedate_tz(value)
+    if parsed is None:
+        return None
+    return max(0, email.utils.mktime_tz(parsed) - time.time())
+
+def _response_header(headers, name):
+    '''
+    Value of response header name, or None; headers is either a message object
+    (case-insensitive) or a dictionary keyed by lower-cased header name
+    '''
+    if headers is None:
+        return None
+    value = headers.get(name)
+    if value is None:
+        value = headers.get(name.lower())
+    return value
+
+def _replace_file(source, destination):
+    '''
+    Atomically rename source to destination, replacing any existing destination
+    '''
+    if PYTHON3:
+        os.replace(source, destination)
+    else:
+        os.rename(source, destination)  # atomic replace on POSIX
+    return
+
+def _remove_quietly(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+    return
+
 class TSDRReq(object):
     '''
     TSDR request object
     '''
 
-    def __init__(self):
+    def __init__(self):
+        '''
+        Initialize TDSR request
+        '''
+        self.reset()
+
+        ### PEP 476
+        self.UNVERIFIED_CONTEXT = _unverified_ssl_context()
+        ### PEP 476
+
+    def reset(self):
+        '''
+        Resets all values (but not control fields) in TDSRReq object
+        '''
+        # Reset control fields (XSLT transform, PTO format, connection pool, caches)
+        self.unsetXSLT()
+        self.unsetPTOFormat()
+        self.unsetEngine()
+        self.unsetProjection()
+        self.unsetRetainZipData()
+        self.unsetRetention()
+        self.unsetCompactMaps()
+        self.unsetRecordTimings()
+        self.unsetConnectionPool()
+        self.unsetCache()
+        self.unsetMapCache()
+        self.unsetRetryPolicy()
+        self.unsetRateLimiter()
+        # reset data fields
+        self.resetXMLData() # Resetting TSDR data will cascade to CSV and TSDR map, too
+        return
+
+    def setXSLT(self, template):
+        '''
+        Specifies text of an XSLT transform to be used to transform the PTO-supplied
+        XML data into key-value pairs.  If not set (default), one of the package-
+        supplied templates will be used. The compiled transform is cached, so
+        the same text is compiled only once per process.
+        '''
+        self.XSLT = template
+        self.XSLTFile = None
+        return
+
+    def setXSLTFile(self, pathname):
+        '''
+        As setXSLT, but with the XSLT transform read from file pathname. The file
+        is read (and the transform compiled) again only if it has changed since
+        last used.
+        '''
+        self.XSLT = None
+        self.XSLTFile = pathname
+        return
+
+    def unsetXSLT(self):
+        '''
+        Resets self.XSLT (and self.XSLTFile) to None, causing the package-supplied
+        templates to be used.
+        '''
+        self.XSLT = None
+        self.XSLTFile = None
+        return
+
+    def _callerXSLT(self):
+        '''
+        The caller-supplied XSLT transform, if any, from setXSLT or setXSLTFile:
+        returns (stylesheet, digest), stylesheet as bytes; or (None, None)
+        '''
+        if self.XSLTFile is not None:
+            return _xslt_file_cache.read(self.XSLTFile)
+        if self.XSLT is None:
+            return None, None
+        stylesheet = self.XSLT
+        if PYTHON3 and not isinstance(stylesheet, bytes):
+            # Py3 req's byte-string or string w/o Unicode declaration
+            stylesheet = stylesheet.encode(encoding="utf-8")
+        return stylesheet, _stylesheet_digest(stylesheet)
+
+    def setPTOFormat(self, PTOFormat):
+        '''
+        Determines what format file will be fetched from the PTO.
+            "ST66": ST66-format XML
+            "ST96": ST96-format XML
+             "zip": zip file.  The zip file obtained from
+                    the PTO is currently ST66-format XML.
+        If this is unset, "zip" will be assumed.
+        '''
+        valid_formats = ["ST66", "ST96", "zip"]
+        if PTOFormat not in valid_formats:
+            raise ValueError("invalid PTO format '%s'" % PTOFormat)
+        self.PTOFormat = PTOFormat
+        return
+
+    def unsetPTOFormat(self):
+        '''
+        Resets PTO format to "zip" (default)
+        '''
+        self.setPTOFormat("zip")
+        return
+
+    def setEngine(self, engine):
+        '''
+        Determines how getCSVData extracts data from the XML:
+            "XSLT": run the package-supplied XSLT transform (ST66.xsl or ST96.xsl)
+                    and parse its CSV output
+           "XPath": extract the same fields directly from the parsed XML, with
+                    precompiled XPath expressions mirroring those transforms
+                    (see Plumage.extract); CSVData is then only produced if asked for
+        Both produce the same TSDR map.  A caller-supplied XSLT transform (setXSLT,
+        setXSLTFile) is always run as XSLT.
+        If this is unset, "XSLT" will be assumed.
+        '''
+        valid_engines = ["XSLT", "XPath"]
+        if engine not in valid_engines:
+            raise ValueError("invalid engine '%s'" % engine)
+        self.Engine = engine
+        return
+
+    def unsetEngine(self):
+        '''
+        Resets engine to "XSLT" (default)
+        '''
+        self.setEngine("XSLT")
+        return
+
+    def setProjection(self, projection):
+        '''
+        Limits the TSDR map to the fields named in projection, an iterable of
+        TSDRSingle keys (e.g. "MarkCurrentStatusDate") and TSDRMulti list names
+        (e.g. "MarkEventList"); a repeated field is included whole, or not at all.
+        Takes effect from the next getCSVData.
+
+        With the XPath engine (see setEngine), only the parts of the XML needed for
+        those fields are evaluated; CSVData, if asked for, holds only those fields.
+        With XSLT, the transform still produces (and getCSVData checks) all the CSV
+        data, but repeated fields not asked for are skipped when mapping it.
+        If None (default), the map has every field.
+        '''
+        if isinstance(projection, str):
+            raise ValueError("projection must be an iterable of names, not a string")
+        if projection is not None:
+            projection = frozenset(projection)
+        self.Projection = projection
+        return
+
+    def unsetProjection(self):
+        '''
+        Resets projection to None: the TSDR map has every field
+        '''
+        self.setProjection(None)
+        return
+
+    def setRetainZipData(self, retain):
+        '''
+        Determines whether a zip file's contents remain available once its XML
+        data has been read:
+            True: ZipData, ImageFull and ImageThumb are available (each image
+                  is decompressed only when first asked for; see writeImage)
+           False: the zip file is let go as soon as its XML data has been read;
+                  ZipData, ImageFull and ImageThumb are None
+        If this is unset, True will be assumed.
+        '''
+        if retain not in [True, False]:
+            raise ValueError("invalid retain value '%s'; True or False required" % retain)
+        self.RetainZipData = retain
+        return
+
+    def unsetRetainZipData(self):
+        '''
+        Resets zip data retention to True (default)
+        '''
+        self.setRetainZipData(True)
+        return
+
+    def setRetention(self, retention):
+        '''
+        Determines what getTSDRInfo keeps once it has built the TSDR map:
+            "full": everything it read and produced on the way: XMLData, XMLTree,
+                    CSVData, ZipData (and so the images)
+            "lean": only TSDRData (and ErrorCode and ErrorMessage), plus
+                    PayloadDigest, the SHA-256 (hex) of the data as fetched or
+                    read; everything else is let go as soon as the map is built
+        The step-by-step methods (getXMLData, getCSVData, getTSDRData) always keep
+        what they produce, so that the next step can use it.
+        If this is unset, "full" will be assumed.
+        '''
+        valid_retentions = ["full", "lean"]
+        if retention not in valid_retentions:
+            raise ValueError("invalid retention '%s'" % retention)
+        self.Retention = retention
+        return
+
+    def unsetRetention(self):
+        '''
+        Resets retention to "full" (default)
+        '''
+        self.setRetention("full")
+        return
+
+    def setCompactMaps(self, compact_maps):
+        '''
+        Determines whether TSDR maps are built compact (see TSDRMap.compact), for
+        holding many in memory at once. If True, TSDRData.TSDRSingle is a
+        read-only TSDRRecord and each TSDRMulti list a read-only TSDRRecordList:
+        read as dictionaries and lists, but with their keys kept once, for every
+        map, rather than in each dictionary.
+        If this is unset, False will be assumed: ordinary dictionaries and lists.
+        '''
+        if compact_maps not in [True, False]:
+            raise ValueError("invalid compact maps setting '%s'" % compact_maps)
+        self.CompactMaps = compact_maps
+        return
+
+    def unsetCompactMaps(self):
+        '''
+        Resets compact maps to False (default)
+        '''
+        self.setCompactMaps(False)
+        return
+
+    def setRecordTimings(self, record_timings):
+        '''
+        Determines whether the time taken by each stage of processing (and the
+        size of its output, where it has one) is recorded in Timings, a dictionary
+        of TSDRStageTiming by stage, in the order run:
+            "fetch": fetch from the PTO (or the response cache); bytes fetched
+            "read": read of a local file (getXMLDataFromFile); bytes read
+            "unzip": XML file taken from a zip file; bytes of XML
+            "parse": XML parsed; bytes of XML
+            "transform": XSLT transform (or XPath extraction); bytes of CSV
+            "substitute": run-time values substituted into the CSV (only for an
+                XSLT with placeholders the transform cannot fill in); bytes of CSV
+            "validate": CSV validated (and, in the same pass, mapped)
+            "map": TSDR map set (and made compact, if set to; see setCompactMaps)
+        Timings is emptied by resetXMLData (and so by getTSDRInfo, getXMLData).
+        Of the streamed methods (see iterTSDRInfo), only the fetch is timed: their
+        other stages are interleaved.
+        With a process-wide aggregator (see setTimingAggregator), the stages
+        are timed, and added to it, whether this is set or not.
+        If this is unset, False will be assumed: no timings.
+        '''
+        if record_timings not in [True, False]:
+            raise ValueError("invalid record timings setting '%s'" % record_timings)
+        self.RecordTimings = record_timings
+        return
+
+    def unsetRecordTimings(self):
+        '''
+        Resets record timings to False (default)
+        '''
+        self.setRecordTimings(False)
+        return
+
+    def _startTiming(self):
+        '''
+        Start timing a stage: returns the time, if stages are being timed (see
+        setRecordTimings); otherwise None
+        '''
+        if self.RecordTimings or _timing_aggregator is not None:
+            return _clock()
+        return None
+
+    def _stopTiming(self, stage, started, nbytes=None):
+        '''
+        Finish timing a stage (started, from _startTiming), recording it
+        '''
+        if started is None:
+            return
+        seconds = _clock() - started
+        self.Timings[stage] = TSDRStageTiming(seconds, nbytes)
+        aggregator = _timing_aggregator
+        if aggregator is not None:
+            aggregator.add(stage, seconds, nbytes)
+        return
+
+    def setConnectionPool(self, pool):
+        '''
+        Specifies the TSDRConnectionPool used for fetches from the PTO.
+        If None, each fetch opens (and closes) its own connection.
+        If unset (default), the shared pool returned by sharedConnectionPool() is used.
+        '''
+        self.ConnectionPool = pool
+        return
+
+    def unsetConnectionPool(self):
+        '''
+        Resets connection pool to the shared pool (default)
+        '''
+        self.setConnectionPool(sharedConnectionPool())
+        return
+
+    def setCache(self, cache):
+        '''
+        Specifies a TSDRResponseCache to be consulted, and updated, by
+        getXMLDataFromPTO. If not set (default), every fetch goes to the PTO.
+        '''
+        self.Cache = cache
+        return
+
+    def unsetCache(self):
         '''
-        Initialize TDSR request
+        Resets cache to None (default): no caching
         '''
-        self.reset()
+        self.setCache(None)
+        return
 
-        ### PEP 476
-        if SSL_INSTALLED:
-            try:
-                self.UNVERIFIED_CONTEXT = ssl._create_unverified_context()
-            except AttributeError:
-                self.UNVERIFIED_CONTEXT = None
-        else:
-            self.UNVERIFIED_CONTEXT = None
-        ### PEP 476
+    def setRetryPolicy(self, retry_policy):
+        '''
+        Specifies a TSDRRetryPolicy for fetches from the PTO: transient failures
+        (throttling, server errors, network errors) are retried as it directs.
+        If not set (default), the first failure is final.
+        '''
+        self.RetryPolicy = retry_policy
+        return
 
-    def reset(self):
+    def unsetRetryPolicy(self):
         '''
-        Resets all values (but not control fields) in TDSRReq object
+        Resets retry policy to None (default): no retries
         '''
-        # Reset control fields (XSLT transform, PTO format)
-        self.unsetXSLT()
-        self.unsetPTOFormat()
-        # reset data fields
-        self.resetXMLData() # Resetting TSDR data will cascade to CSV and TSDR map, too
+        self.setRetryPolicy(None)
         return
 
-    def setXSLT(self, template):
+    def setRateLimiter(self, rate_limiter):
         '''
-        Specifies text of an XSLT transform to be used to transform the PTO-supplied
-        XML data into key-value pairs.  If not set (default), one of the package-
-        supplied templates will be used.
+        Specifies a TSDRRateLimiter for this request's fetches from the PTO
+        (including retries). If not set (default), the process-wide limiter
+        (see setSharedRateLimiter), if any, applies.
         '''
-        self.XSLT = template
+        self.RateLimiter = rate_limiter
         return
 
-    def unsetXSLT(self):
+    def unsetRateLimiter(self):
         '''
-        Resets self.XSLT to None, causing the package-supplied templates to be used.
+        Resets rate limiter to None (default): the process-wide limiter, if any, applies
         '''
-        self.XSLT = None
+        self.setRateLimiter(None)
         return
 
-    def setPTOFormat(self, PTOFormat):
+    def _rateLimiter(self):
         '''
-        Determines what format file will be fetched from the PTO.
-            "ST66": ST66-format XML
-            "ST96": ST96-format XML
-             "zip": zip file.  The zip file obtained from
-                    the PTO is currently ST66-format XML.
-        If this is unset, "zip" will be assumed.
+        The rate limiter that applies to this request's fetches, if any
         '''
-        valid_formats = ["ST66", "ST96", "zip"]
-        if PTOFormat not in valid_formats:
-            raise ValueError("invalid PTO format '%s'" % PTOFormat)
-        self.PTOFormat = PTOFormat
+        if self.RateLimiter is not None:
+            return self.RateLimiter
+        return sharedRateLimiter()
+
+    def setMapCache(self, map_cache):
+        '''
+        Specifies a TSDRMapCache of finished TSDR maps. When set, getTSDRInfo for
+        a PTO number already in the cache sets only TSDRData (a copy of the cached
+        map), without fetching or transforming anything; XMLData and CSVData
+        remain unset. If not set (default), results are not cached.
+        '''
+        self.MapCache = map_cache
         return
 
-    def unsetPTOFormat(self):
+    def unsetMapCache(self):
         '''
-        Resets PTO format to "zip" (default)
+        Resets TSDR map cache to None (default): no caching
         '''
-        self.setPTOFormat("zip")
+        self.setMapCache(None)
         return
 
     def resetXMLData(self):
@@ -218,15 +2104,181 @@ class TSDRReq(object):
         depends on it
         '''
         self.XMLData = None
-        self.ZipData = None
-        self.ImageFull = None
-        self.ImageThumb = None
+        self.XMLTree = None
+        self.ZipData = None         # (and so ImageFull and ImageThumb, too)
+        self.PayloadDigest = None   # SHA-256 of the data as fetched or read, with "lean" retention
         self.ErrorCode = None
         self.ErrorMessage = None
         self.XMLDataIsValid = False
+        self._substitutions = dict(_TSDR_substitutions)
+        self.FetchAttempts = 0      # requests made to the PTO (including retries) by the last fetch
+        self.FetchSeconds = 0.0     # time taken by them (including waits between retries)
+        self._validator = None      # version of the PTO data fetched; see TSDRCacheEntry.validator
+        self._revalidated = False   # True if the PTO reported the cached copy unchanged
+        self.Timings = collections.OrderedDict()    # see setRecordTimings
         self.resetCSVData()
         return
 
+    @property
+    def XMLData(self):
+        '''
+        XML data, as a string.  getXMLData keeps the data as read (and the tree
+        parsed from it); the string is decoded from that the first time it is
+        asked for.
+        '''
+        if self._xml_data is None and self._xml_bytes is not None:
+            if PYTHON2: #Python2, XML data is already a string
+                self._xml_data = _buffer_bytes(self._xml_bytes)
+            if PYTHON3: #Python3, XML data is bytes; must encode to a (Unicode) string
+                self._xml_data = str(self._xml_bytes, encoding="utf-8")
+            self._xml_bytes = None
+        return self._xml_data
+
+    @XMLData.setter
+    def XMLData(self, xml_data):
+        # Data supplied directly replaces whatever getXMLData read
+        self._xml_data = xml_data
+        self._xml_bytes = None
+
+    @property
+    def ZipData(self):
+        '''
+        The zip file (as bytes) the XML data came from, if it came from one and
+        RetainZipData is set.  If streamed from a local zip file (see
+        iterTSDRInfo), the file is only read when this is first asked for.
+        '''
+        if self._zip_data is None and self._zip_file is not None:
+            with open(self._zip_file, "rb") as f:
+                self._zip_data = f.read()
+        elif self._zip_data is not None and not isinstance(self._zip_data, bytes):
+            # from a buffer (see getXMLDataFromBytes); only copied if asked for
+            self._zip_data = _buffer_bytes(self._zip_data)
+        return self._zip_data
+
+    @ZipData.setter
+    def ZipData(self, zip_data):
+        # the images, if any, are those of this zip file, once asked for
+        self._zip_data = zip_data
+        self._zip_file = None
+        self._images = {}
+
+    @property
+    def ImageFull(self):
+        '''
+        The full-size mark image (as bytes) from ZipData, if any; decompressed
+        when first asked for
+        '''
+        return self._zipImage(_ZIP_IMAGE_FULL)
+
+    @ImageFull.setter
+    def ImageFull(self, image):
+        self._images[_ZIP_IMAGE_FULL] = image
+
+    @property
+    def ImageThumb(self):
+        '''
+        The thumbnail mark image (as bytes) from ZipData, if any; decompressed
+        when first asked for
+        '''
+        return self._zipImage(_ZIP_IMAGE_THUMB)
+
+    @ImageThumb.setter
+    def ImageThumb(self, image):
+        self._images[_ZIP_IMAGE_THUMB] = image
+
+    def writeImage(self, destination, thumbnail=False):
+        '''
+        Write the full-size mark image (or, if thumbnail is True, the thumbnail)
+        from ZipData to destination, a filename or a file object open for writing
+        bytes.  The image is decompressed straight to destination, a piece at a
+        time, rather than into ImageFull or ImageThumb.
+
+        Returns True if the image was written; False if there is none (the XML
+        data did not come from a zip file, RetainZipData is not set, or the zip
+        file has no such image), in which case destination is not touched.
+        '''
+        name = _ZIP_IMAGE_THUMB if thumbnail else _ZIP_IMAGE_FULL
+        if self._images.get(name) is not None:
+            # already asked for, or set directly
+            self._writeImageFrom(bytesio(self._images[name]), destination)
+            return True
+        zipf = self._openRetainedZip()
+        if zipf is None:
+            return False
+        try:
+            if name not in zipf.namelist():
+                return False
+            source = zipf.open(name)
+            try:
+                self._writeImageFrom(source, destination)
+            finally:
+                source.close()
+        finally:
+            zipf.close()
+        return True
+
+    def _writeImageFrom(self, source, destination):
+        '''
+        Copy source, a file object, to destination (as for writeImage)
+        '''
+        if hasattr(destination, "write"):
+            shutil.copyfileobj(source, destination)
+        else:
+            with open(destination, "wb") as f:
+                shutil.copyfileobj(source, f)
+        return
+
+    def _zipImage(self, name):
+        '''
+        Image name from ZipData (as bytes; None if there is none), decompressed the
+        first time it is asked for
+        '''
+        if name not in self._images:
+            image = None
+            zipf = self._openRetainedZip()
+            if zipf is not None:
+                try:
+                    image = zipf.read(name)
+                except KeyError:
+                    pass
+                finally:
+                    zipf.close()
+            self._images[name] = image
+        return self._images[name]
+
+    def _openRetainedZip(self):
+        '''
+        ZipFile of the retained zip file (see ZipData); or None, if none is retained
+        '''
+        if self._zip_file is not None:
+            return zipfile.ZipFile(self._zip_file, "r")
+        if self._zip_data is not None:
+            return zipfile.ZipFile(_buffer_file(self._zip_data), "r")
+        return None
+
+    @property
+    def CSVData(self):
+        '''
+        CSV data: one KEY,"VALUE" line per field.  getCSVData keeps only the lines
+        (or, with the XPath engine, the fields); the string is assembled from them
+        the first time it is asked for.
+        '''
+        if self._csv_data is None:
+            if self._csv_lines is not None:
+                self._csv_data = LINE_SEPARATOR.join(self._csv_lines) + LINE_SEPARATOR
+            elif self._csv_fields is not None:
+                self._csv_data = LINE_SEPARATOR.join(
+                    '%s,"%s"' % field for field in self._csv_fields) + LINE_SEPARATOR
+        return self._csv_data
+
+    @CSVData.setter
+    def CSVData(self, csv_data):
+        # Data supplied directly replaces whatever getCSVData produced
+        self._csv_data = csv_data
+        self._csv_lines = None
+        self._csv_fields = None
+        self._csv_map = None
+
     def resetCSVData(self):
         '''
         Resets CSV data; and TSDR map, which depends on it
@@ -258,17 +2310,109 @@ class TSDRReq(object):
 
         Sets:
             self.XMLData
+            self.XMLTree
             self.ZipData (optional)
             self.ImageThumb (optional)
             self.ImageFull (optional)
             self.CSVData
             self.TSDRData
+        With "lean" retention (see setRetention), only TSDRData (and
+        PayloadDigest) are kept once the TSDR map is built.
+        '''
+        if tmtype is None:
+            self.getXMLData(identifier, tmtype)
+            self._completeTSDRInfo()
+            return
+        if self._lookupMapCache(identifier, tmtype):
+            return
+        self.resetXMLData()
+        filedata = self._fetchFromPTO(identifier, tmtype)
+        if filedata is None:
+            return
+        if self._lookupRevalidatedMap(identifier, tmtype):
+            return
+        self._processFileContents(filedata)
+        self._completeTSDRInfo()
+        self._storeMapCache(identifier, tmtype)
+        return
+
+    def _mapCacheKey(self, number, tmtype):
+        '''
+        Key for the TSDR map of a PTO number: everything the map depends on
+        '''
+        _, xslt_key = self._callerXSLT()
+        return (tmtype, number, self.PTOFormat, xslt_key, self.Projection)
+
+    def _lookupMapCache(self, number, tmtype, validator=None):
+        '''
+        If there is a map cache and it holds the TSDR map for this PTO number,
+        set TSDRData to (a copy of) it and return True; otherwise return False.
+        validator: see TSDRMapCache.get
+        '''
+        tsdrmap = self._cachedMap(number, tmtype, validator)
+        if tsdrmap is None:
+            return False
+        self.resetXMLData()
+        self.TSDRData = tsdrmap
+        self._compactTSDRData()
+        return True
+
+    def _lookupRevalidatedMap(self, number, tmtype):
+        '''
+        After a fetch the PTO answered 304 (not modified): if the map cache holds
+        the TSDR map built from that same data, use it, even if expired, rather
+        than transforming the data again. Unlike _lookupMapCache, nothing else is
+        reset: what the fetch recorded (FetchAttempts, Timings, etc.) is kept.
+        '''
+        if not self._revalidated:
+            return False
+        tsdrmap = self._cachedMap(number, tmtype, self._validator)
+        if tsdrmap is None:
+            return False
+        self.TSDRData = tsdrmap
+        self._compactTSDRData()
+        return True
+
+    def _cachedMap(self, number, tmtype, validator=None):
+        '''
+        The map cache's TSDR map (a copy) for this PTO number, if there is a map
+        cache and it has one; otherwise None. validator: see TSDRMapCache.get
+        '''
+        if self.MapCache is None:
+            return None
+        self._validate_PTO_parameters(number, tmtype)
+        return self.MapCache.get(self._mapCacheKey(number, tmtype), validator)
+
+    def _storeMapCache(self, number, tmtype):
+        '''
+        If there is a map cache, store the (valid) TSDR map for this PTO number in it
+        '''
+        if self.MapCache is not None and self.TSDRData.TSDRMapIsValid:
+            self.MapCache.put(self._mapCacheKey(number, tmtype), self.TSDRData,
+                              validator=self._validator)
+        return
+
+    def _completeTSDRInfo(self):
+        '''
+        Carry already-loaded XML data the rest of the way through to a TSDR map
         '''
-        self.getXMLData(identifier, tmtype)
         if self.XMLDataIsValid:
             self.getCSVData()
             if self.CSVDataIsValid:
                 self.getTSDRData()
+        if self.Retention == "lean":
+            self._dropIntermediates()
+        return
+
+    def _dropIntermediates(self):
+        '''
+        "lean" retention (see setRetention): let go of everything read or produced
+        on the way to the TSDR map; the validity flags are left as they were
+        '''
+        self.XMLData = None
+        self.XMLTree = None
+        self.ZipData = None
+        self.CSVData = None
         return
 
     def getXMLData(self, identifier=None, tmtype=None):
@@ -285,6 +2429,7 @@ class TSDRReq(object):
 
         Sets:
             self.XMLData
+            self.XMLTree
             self.ZipData (optional)
             self.ImageThumb (optional)
             self.ImageFull (optional)
@@ -301,7 +2446,8 @@ class TSDRReq(object):
     def getXMLDataFromFile(self, filename):
         '''
         Load TDSR data from local file (which may be a zip file or text XML file).
-        This method is generally used only for testing.
+        This method is generally used only for testing.  A large file is
+        memory-mapped, rather than read.
 
         Parameters:
 
@@ -309,21 +2455,64 @@ class TSDRReq(object):
 
         Sets:
             self.XMLData
+            self.XMLTree
             self.ZipData (if file is zip file)
             self.ImageThumb (if file is zip file)
             self.ImageFull (if file is zip file)
         '''
 
+        started = self._startTiming()
         with open(filename, "rb") as f:
-            filedata = f.read()
+            filedata = _map_file(f)
+        self._stopTiming("read", started, len(filedata))
 
-        _TSDR_substitutions["$XMLSOURCE$"] = filename
-        now = time.strftime("%Y-%m-%d %H:%M:%S")
-        _TSDR_substitutions["$EXECUTIONDATETIME$"] = now
+        self._set_run_substitutions(filename)
 
         self._processFileContents(filedata)
         return
 
+    def getXMLDataFromBytes(self, data, source_label=None):
+        '''
+        Load TSDR data already in memory (a zip file or text XML file, as read from
+        a cache, object storage or an archive, say), as getXMLDataFromFile loads it
+        from a file; follow with getCSVData and getTSDRData as usual.
+
+        Parameters:
+
+            data: the data, as bytes; or any other buffer (bytearray, memoryview,
+                  mmap): the buffer is read in place, never copied in full (but it
+                  must stay open while ZipData or the images may be asked for)
+            source_label: description of the data's source, reported as
+                  DiagnosticInfoXMLSource; "(bytes)" if None
+
+        Sets: as getXMLDataFromFile
+        '''
+        self._set_run_substitutions(source_label if source_label is not None else "(bytes)")
+        self._processFileContents(data)
+        return
+
+    def getXMLDataFromFileObject(self, f, source_label=None):
+        '''
+        Load TSDR data from f, a file object open for reading bytes (from its
+        current position), as getXMLDataFromBytes loads it: a large regular file
+        is memory-mapped, and an io.BytesIO used in place, rather than read.
+
+        Parameters:
+
+            f: the file object; it may be closed once this returns
+            source_label: description of the data's source, reported as
+                  DiagnosticInfoXMLSource; f's name, if None (or "(file object)",
+                  if it has none)
+
+        Sets: as getXMLDataFromFile
+        '''
+        if source_label is None:
+            source_label = getattr(f, "name", None)
+            if not isinstance(source_label, str):
+                source_label = "(file object)"
+        self.getXMLDataFromBytes(_map_file(f), source_label)
+        return
+
     def getXMLDataFromPTO(self, number, tmtype):
         '''
         Fetch TDSR data from USPTO (either as XML file (ST66 or ST96), or as a
@@ -338,56 +2527,339 @@ class TSDRReq(object):
 
         Sets:
             self.XMLData
+            self.XMLTree
             self.ZipData (for format="zip")
             self.ImageThumb (for format="zip")
             self.ImageFull (for format="zip")
         '''
 
-        self._validate_PTO_parameters(number, tmtype)
+        filedata = self._fetchFromPTO(number, tmtype)
+        if filedata is not None:
+            self._processFileContents(filedata)
+        return
 
-        xml_url_template_st66 = "https://tsdrapi.uspto.gov/ts/cd/status66/"\
-                                "%sn%s/info.xml"
-        xml_url_template_st96 = "https://tsdrapi.uspto.gov/ts/cd/casestatus/"\
-                                "%sn%s/info.xml"
-        zip_url_template      = "https://tsdrapi.uspto.gov/ts/cd/casestatus/"\
-                                "%sn%s/content.zip"
-        pto_url_templates = {
-            "ST66" : xml_url_template_st66,
-            "ST96" : xml_url_template_st96,
-            "zip"  : zip_url_template
-            }
+    def _fetchFromPTO(self, number, tmtype):
+        '''
+        Network half of getXMLDataFromPTO: fetch the raw TSDR data from the PTO,
+        without processing it. Returns the data (as bytes); or None if the PTO
+        has no such mark (ErrorCode and ErrorMessage are set).
+        '''
+        started = self._startTiming()
+        filedata = self._fetchRawFromPTO(number, tmtype)
+        self._stopTiming("fetch", started, None if filedata is None else len(filedata))
+        return filedata
+
+    def _fetchRawFromPTO(self, number, tmtype):
+        '''
+        _fetchFromPTO, untimed
+        '''
+        pto_url, cached = self._startPTOFetch(number, tmtype)
+        if cached is not None and cached.fresh:
+            return cached.data
+        request_headers = None
+        if cached is not None:
+            request_headers = cached.conditionalHeaders()
+        status, reason, headers, filedata = self._fetchURLWithRetry(pto_url, request_headers)
+        return self._finishPTOFetch(number, tmtype, pto_url, cached,
+                                    status, reason, headers, filedata)
+
+    def _startPTOFetch(self, number, tmtype):
+        '''
+        First step of a PTO fetch: validate parameters and consult the response cache.
+        Returns (pto_url, cached): cached is None (nothing cached; fetch in full),
+        a fresh TSDRCacheEntry (use its data; no fetch needed), or an expired one
+        (fetch conditionally, with its conditionalHeaders())
+        '''
+        pto_url = self._PTO_URL(number, tmtype)
+        if self.Cache is None:
+            return pto_url, None
+        cached = self.Cache.get((tmtype, number, self.PTOFormat), include_stale=True)
+        if cached is not None and cached.fresh:
+            fetched = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(cached.stored))
+            self._set_run_substitutions("%s (cached; fetched %s)" % (pto_url, fetched))
+            self._validator = cached.validator()
+        return pto_url, cached
+
+    def _finishPTOFetch(self, number, tmtype, pto_url, cached, status, reason, headers, filedata):
+        '''
+        Last step of a PTO fetch: act on the PTO's response (see _startPTOFetch).
+        Returns the data (as bytes); or None on a 404 (ErrorCode and ErrorMessage are set).
+        '''
+        if status == 404:
+            self._set_fetch_404(pto_url)
+            return None
+        etag = _response_header(headers, "ETag")
+        last_modified = _response_header(headers, "Last-Modified")
+        cache_key = (tmtype, number, self.PTOFormat)
+        if status == 304 and cached is not None:
+            self.Cache.renew(cache_key, cached, etag=etag, last_modified=last_modified)
+            self._set_run_substitutions("%s (revalidated)" % pto_url)
+            self._validator = (etag if etag is not None else cached.etag,
+                               last_modified if last_modified is not None else cached.last_modified)
+            self._revalidated = True
+            return cached.data
+        if status != 200:
+            raise HTTPError(pto_url, status, reason, headers, None)
+        self._set_run_substitutions(pto_url)
+        if etag is not None or last_modified is not None:
+            self._validator = (etag, last_modified)
+        if self.Cache is not None:
+            self.Cache.put(cache_key, pto_url, filedata, etag=etag, last_modified=last_modified)
+        return filedata
+
+    def _fetchURLWithRetry(self, pto_url, request_headers=None):
+        '''
+        _fetchURL, retrying as directed by the retry policy (if any), with each
+        attempt admitted by the rate limiter (if any); sets FetchAttempts and FetchSeconds
+        '''
+        started = time.time()
+        attempt = 0
+        rate_limiter = self._rateLimiter()
+        try:
+            while True:
+                attempt += 1
+                if rate_limiter is not None:
+                    delay = self._rateLimiterDelay(rate_limiter.reserve(), started)
+                    if delay > 0:
+                        time.sleep(delay)
+                try:
+                    response = self._fetchURL(pto_url, request_headers, self._attemptTimeout(started))
+                except Exception as e:
+                    delay = self._retryDelay(attempt, started, exception=e)
+                    if delay is None:
+                        raise
+                else:
+                    delay = self._retryDelay(attempt, started, response=response)
+                    if delay is None:
+                        return response
+                time.sleep(delay)
+        finally:
+            self.FetchAttempts = attempt
+            self.FetchSeconds = time.time() - started
+
+    def _retryDelay(self, attempt, started, response=None, exception=None):
+        '''
+        Seconds to wait before retrying a fetch, or None not to retry; see TSDRRetryPolicy.retryDelay
+        '''
+        if self.RetryPolicy is None:
+            return None
+        status, headers = None, None
+        if response is not None:
+            status, headers = response[0], response[2]
+        return self.RetryPolicy.retryDelay(attempt, time.time() - started,
+                                           status, headers, exception)
+
+    def _attemptTimeout(self, started):
+        '''
+        Timeout for a fetch attempt: the time left before the retry policy's
+        deadline (socket.timeout if none is left); None if there is no deadline
+        '''
+        if self.RetryPolicy is None:
+            return None
+        remaining = self.RetryPolicy.remaining(time.time() - started)
+        if remaining is not None and remaining <= 0:
+            raise socket.timeout("retry deadline passed")
+        return remaining
+
+    def _rateLimiterDelay(self, delay, started):
+        '''
+        The rate limiter's delay (see TSDRRateLimiter.reserve) before a fetch
+        attempt, counted against the retry policy's deadline: socket.timeout if
+        waiting it out would pass the deadline
+        '''
+        if self.RetryPolicy is not None:
+            remaining = self.RetryPolicy.remaining(time.time() - started)
+            if remaining is not None and delay >= remaining:
+                raise socket.timeout("rate limiter wait of %.3f seconds passes the retry deadline" % delay)
+        return delay
+
+    def _fetchURL(self, pto_url, request_headers=None, timeout=None):
+        '''
+        GET pto_url from the PTO, via the connection pool if there is one; request_headers
+        is an optional dictionary of additional request headers; timeout, if given,
+        caps the socket timeout (see _attemptTimeout).
+        Returns (status, reason, headers, body)
+        '''
+        if self.ConnectionPool is not None:
+            return self.ConnectionPool.get(pto_url, request_headers, timeout)
 
-        fetchtype = self.PTOFormat
-        pto_url_template = pto_url_templates[fetchtype]
-        pto_url = pto_url_template % (tmtype, number)
+        # No pool: a one-off connection for this fetch
         ##  with urllib2.urlopen(pto_url) as f:  ## This doesn't work; in Python 2.x,
         ##      filedata = f.read()              ## urlopen() does not support the "with" statement
         ## I'm only leaving this comment here because twice I've forgotten that this won't work
         ## in Python 2.7, and attempt the "with" statement before it bites me and I remember.
+        request = URL_request(pto_url, headers=request_headers or {})
+        open_arguments = {}
+        if timeout is not None:
+            open_arguments["timeout"] = timeout
         try:
             ### PEP 476:
             ### use context parameter if it is supported (TypeError if not)
             try:
-                f = URL_open(pto_url, context=self.UNVERIFIED_CONTEXT)
+                f = URL_open(request, context=self.UNVERIFIED_CONTEXT, **open_arguments)
             except TypeError as e:
-                f = URL_open(pto_url)
+                f = URL_open(request, **open_arguments)
         except HTTPError as e:
-            if e.code == 404:
-                self.ErrorCode = "Fetch-404"
-                self.ErrorMessage = "getXMLDataFromPTO: Error fetching from PTO. "\
-                             "Errorcode: 404 (not found); URL: <%s>" % (pto_url)
-                return
-            else:
-                raise
+            # return the status like any other; the caller decides what is an error
+            return e.code, e.msg, e.hdrs, None
 
         filedata = f.read()
+        status, headers = f.getcode(), f.info()
         f.close()
+        return status, "OK", headers, filedata
 
-        _TSDR_substitutions["$XMLSOURCE$"] = pto_url
-        now = time.strftime("%Y-%m-%d %H:%M:%S")
-        _TSDR_substitutions["$EXECUTIONDATETIME$"] = now
+    def iterTSDRInfo(self, identifier=None, tmtype=None):
+        '''
+        Streaming counterpart of getTSDRInfo, for very large TSDR documents (such as
+        those of long-lived marks, with thousands of mark events and assignments).
+        Rather than holding the XML data, its parsed tree and the CSV data, the XML
+        is parsed incrementally, and each part of it is mapped as soon as it is
+        read, and then discarded (see Plumage.extract.iterFields); peak memory use
+        stays roughly the same however large the document is.
+
+        Parameters: as for getTSDRInfo.
+
+        Returns a generator of (name, value) pairs, in the order they are read:
+          - for each TSDRSingle field, its key and its value (a string); the field
+            is also added to self.TSDRData.TSDRSingle;
+          - for each entry of a repeated field, its TSDRMulti list name (e.g.,
+            "MarkEventList") and the entry (a dictionary); entries are not kept.
+        When the generator is exhausted, self.TSDRData.TSDRMapIsValid is True; or,
+        on error, False, with ErrorCode and ErrorMessage set (pairs yielded before
+        the error was found remain yielded).
+
+        The package-supplied transforms are always used (as by the XPath engine),
+        honoring the projection, if any; a caller-supplied XSLT transform is not
+        supported (ValueError).  XMLData, XMLTree and CSVData are not set; a local
+        zip file is only read for ZipData if that is asked for.  The map cache is
+        not used.
+        '''
+        if self.XSLT is not None or self.XSLTFile is not None:
+            raise ValueError("Streaming is not supported with a caller-supplied XSLT transform")
+        return self._streamTSDRInfo(identifier, tmtype)
 
-        self._processFileContents(filedata)
+    def getTSDRInfoStreamed(self, identifier=None, tmtype=None, callback=None):
+        '''
+        getTSDRInfo, streamed (see iterTSDRInfo): TSDRSingle is built as usual.
+        Each entry of a repeated field is passed, as it is read, to
+        callback(list_name, entry), if callback is given (and is not kept, so that
+        memory use stays flat); otherwise, it is added to TSDRMulti.
+        '''
+        repeated_item_dict = {}
+        for name, value in self.iterTSDRInfo(identifier, tmtype):
+            if not isinstance(value, dict):
+                continue
+            if callback is not None:
+                callback(name, value)
+            else:
+                repeated_item_dict.setdefault(name, []).append(value)
+        if self.TSDRData.TSDRMapIsValid:
+            self.TSDRData.TSDRMulti = repeated_item_dict
+            self._compactTSDRData()
+        return
+
+    def _streamTSDRInfo(self, identifier, tmtype):
+        '''
+        Generator for iterTSDRInfo
+        '''
+        from Plumage import extract
+        self.resetXMLData()
+        if tmtype is None:
+            self._set_run_substitutions(identifier)
+            filedata, source = None, identifier
+        else:
+            filedata = self._fetchFromPTO(identifier, tmtype)
+            if filedata is None:
+                return
+            source = bytesio(filedata)
+        zipf = None
+        if zipfile.is_zipfile(source):
+            zipf, xmlfilename = self._openZip(source, filedata)
+            source = zipf.open(xmlfilename)
+        elif filedata is not None:
+            source = bytesio(filedata)      # (is_zipfile has read from the first one)
+
+        # If XML format was specified in PTOFormat, use that; otherwise go by the root element
+        xml_format = None
+        if self.PTOFormat in ["ST66", "ST96"]:
+            xml_format = self.PTOFormat
+        def started(xml_format):
+            xslt_transform_info = _xslt_table[xml_format]
+            self._substitutions["$XSLTFILENAME$"] = xslt_transform_info.filename
+            self._substitutions["$XSLTLOCATION$"] = xslt_transform_info.location
+
+        tsdrdata = self.TSDRData
+        tsdrdata.TSDRSingle = output_dict = {}
+        field_count = 0
+        try:
+            for fields in extract.iterFields(source, self._substitutions, self.Projection,
+                                             xml_format, started):
+                field_count += len(fields)
+                if fields and fields[0][0] == "BeginRepeatedField":
+                    # one entry: BeginRepeatedField, its fields, EndRepeatedField
+                    yield fields[0][1]+"List", dict(fields[1:-1])
+                    continue
+                for key, data in fields:
+                    output_dict[key] = data
+                    yield key, data
+        except etree.XMLSyntaxError as e:
+            self.ErrorCode = "XML-NoValidXML"
+            self.ErrorMessage = "getXMLData: exception(lxml.etree.XMLSyntaxError) parsing purported XML data.  "\
+                                "Reason: '<%s>'" %  e.msg
+            return
+        except extract.UnexpectedRoot as e:
+            self.XMLDataIsValid = True
+            if xml_format is None:
+                self.ErrorCode = "CSV-UnsupportedXML"
+                self.ErrorMessage = "Unsupported XML format found: %s" % self._xml_format_for_tag(e.tag)
+            else:
+                # as for getCSVData: the transform didn't fit the XML
+                self.ErrorCode = "CSV-ShortCSV"
+                self.ErrorMessage = "getCSVData: XML parsed to fewer than 2 lines of CSV"
+            return
+        finally:
+            if zipf is not None:
+                source.close()
+                zipf.close()
+        self.XMLDataIsValid = True
+        if self.Projection is None and field_count < 2:
+            self.ErrorCode = "CSV-ShortCSV"
+            self.ErrorMessage = "getCSVData: XML parsed to fewer than 2 lines of CSV"
+            return
+        tsdrdata.TSDRMulti = {}
+        tsdrdata.TSDRMapIsValid = True
+        self._compactTSDRData()
+        return
+
+    def getTSDRInfoAsync(self, number, tmtype, executor=None):
+        '''
+        asyncio counterpart of getTSDRInfo(number, tmtype), for PTO fetches only;
+        returns a coroutine, to be awaited:
+            await t.getTSDRInfoAsync("76044902", "s")
+
+        The fetch uses asyncio streams, and so never blocks the event loop;
+        processing (unzip, XSLT, mapping) runs in executor (the loop's default
+        executor, if None). Python 3 only; see Plumage.aio for details.
+        '''
+        from Plumage import aio
+        return aio.getTSDRInfo(self, number, tmtype, executor)
+
+    def _PTO_URL(self, number, tmtype):
+        '''
+        Validate PTO parameters and return the URL to fetch for them, in the
+        format specified by self.PTOFormat
+        '''
+        self._validate_PTO_parameters(number, tmtype)
+        pto_url_template = _pto_url_templates[self.PTOFormat]
+        return pto_url_template % (tmtype, number)
+
+    def _set_fetch_404(self, pto_url):
+        '''
+        Record that the PTO has no data at pto_url
+        '''
+        self.ErrorCode = "Fetch-404"
+        self.ErrorMessage = "getXMLDataFromPTO: Error fetching from PTO. "\
+                     "Errorcode: 404 (not found); URL: <%s>" % (pto_url)
         return
 
     def getCSVData(self):
@@ -404,36 +2876,40 @@ class TSDRReq(object):
         Parameters: none.
 
         Reads:
-            self.XMLData
+            self.XMLTree
         Sets:
             self.CSVData
         '''
         self.resetCSVData()  # Clear out any data from prior use
 
-        # First, make sure there is XML data to process
-        if not self.XMLDataIsValid:
+        # First, make sure there is XML data to process (and that it was not let go)
+        if not self.XMLDataIsValid or (self.XMLTree is None and self.XMLData is None):
             self.CSVDataIsValid = False
             self.ErrorCode = "CSV-NoValidXML"
             self.ErrorMessage = "No valid XML data found"
             return
 
-        # Prep the XML
-        if PYTHON2:
-            f = stringio(self.XMLData)
-        if PYTHON3:
-            f = bytesio(self.XMLData.encode(encoding="utf-8"))
-        parsed_xml = etree.parse(f)
+        # Use the tree parsed when the XML was loaded; only re-parse if a caller
+        # has populated XMLData directly, without going through getXMLData
+        parsed_xml = self.XMLTree
+        if parsed_xml is None:
+            if PYTHON2:
+                f = stringio(self.XMLData)
+            if PYTHON3:
+                f = bytesio(self.XMLData.encode(encoding="utf-8"))
+            parsed_xml = etree.parse(f)
+            self.XMLTree = parsed_xml
         # if a transform template is provided, use it,
         # otherwise figure out which to use...
-        if self.XSLT is not None:
-            if PYTHON2:
-                override_XSLT = self.XSLT
-            if PYTHON3:  # Py3 req's byte-string or string w/o Unicode declaration
-                override_XSLT = self.XSLT.encode(encoding="utf-8")
-            xslt_root = etree.XML(override_XSLT)
-            transform = etree.XSLT(xslt_root)
-            _TSDR_substitutions["$XSLTFILENAME$"] = "CALLER-PROVIDED XSLT"
-            _TSDR_substitutions["$XSLTPATHNAME$"] = "CALLER-PROVIDED XSLT"
+        override_XSLT, digest = self._callerXSLT()
+        if override_XSLT is not None:
+            transform, needs_substitution = _compiled_xslt_cache.compile(override_XSLT, digest)
+            if self.XSLTFile is not None:
+                self._substitutions["$XSLTFILENAME$"] = os.path.basename(self.XSLTFile)
+                self._substitutions["$XSLTLOCATION$"] = os.path.dirname(os.path.abspath(self.XSLTFile))
+            else:
+                self._substitutions["$XSLTFILENAME$"] = "CALLER-PROVIDED XSLT"
+                self._substitutions["$XSLTLOCATION$"] = "CALLER-PROVIDED XSLT"
         else:
             # If XML format was specified in PTOFormat, use that; otherwise try to determine by looking
             supported_xml_formats = ["ST66", "ST96"]
@@ -447,28 +2923,70 @@ class TSDRReq(object):
                     self.ErrorMessage = "Unsupported XML format found: %s" % xml_format
                     return
             xslt_transform_info = _xslt_table[xml_format]
+            self._substitutions["$XSLTFILENAME$"] = xslt_transform_info.filename
+            self._substitutions["$XSLTLOCATION$"] = xslt_transform_info.location
+            if self.Engine == "XPath":
+                self._extractCSVFields(parsed_xml, xml_format)
+                return
             transform = xslt_transform_info.transform
-            _TSDR_substitutions["$XSLTFILENAME$"] = xslt_transform_info.filename
-            _TSDR_substitutions["$XSLTLOCATION$"] = xslt_transform_info.location
+            needs_substitution = xslt_transform_info.needs_substitution
         # Transform
-        transformed_tree = transform(parsed_xml)
-        csv_string = self._perform_substitution(str(transformed_tree))
-        self.CSVData = self._normalize_empty_lines(csv_string)
-
-        csvresults = self._validateCSV()
+        started = self._startTiming()
+        transformed_tree = transform(parsed_xml, **self._transform_parameters())
+        csv_string = str(transformed_tree)
+        self._stopTiming("transform", started, len(csv_string))
+        if needs_substitution:
+            started = self._startTiming()
+            csv_string = self._perform_substitution(csv_string)
+            self._stopTiming("substitute", started, len(csv_string))
+        # Split once; the same lines are validated and mapped in one pass, and
+        # CSVData is only assembled from them if a caller asks for it
+        started = self._startTiming()
+        lines = self._drop_empty_lines(csv_string.split(LINE_SEPARATOR))
+        csvresults, tsdr_single, tsdr_multi = self._parseCSV(lines)
+        self._stopTiming("validate", started)
+        self._csv_lines = lines
         if csvresults.CSV_OK:
             self.CSVDataIsValid = True
+            self._csv_map = (tsdr_single, tsdr_multi)
         else:
             self.CSVDataIsValid = False
             self.ErrorCode = csvresults.error_code
             self.ErrorMessage = csvresults.error_message
         return
 
+    def _extractCSVFields(self, parsed_xml, xml_format):
+        '''
+        getCSVData for the XPath engine: extract the fields the package-supplied
+        transform would write directly from the parsed XML (see Plumage.extract),
+        and map them as _parseCSV maps CSV lines
+        '''
+        from Plumage import extract
+        started = self._startTiming()
+        fields = extract.extractFields(parsed_xml, xml_format, self._substitutions,
+                                       self.Projection)
+        self._stopTiming("transform", started)
+        self._csv_fields = fields or []
+        # as for CSV data, too few fields means the transform didn't fit the XML;
+        # but with a projection, only a root element it doesn't match shows that
+        if fields is None or (self.Projection is None and len(fields) < 2):
+            self.CSVDataIsValid = False
+            self.ErrorCode = "CSV-ShortCSV"
+            self.ErrorMessage = "getCSVData: XML parsed to fewer than 2 lines of CSV"
+            return
+        self.CSVDataIsValid = True
+        started = self._startTiming()
+        self._csv_map = _map_fields(fields, self.Projection)
+        self._stopTiming("validate", started)
+        return
+
     def getTSDRData(self):
         '''
         Refactor key/data pairs to dictionary.
 
         getCSVData must be successfully invoked before using this method.
+        The mapping is normally done by getCSVData as it validates the CSV
+        data; it is only done here if CSVData was set directly.
 
         Parameters: none.
 
@@ -502,51 +3020,60 @@ class TSDRReq(object):
             self.ErrorMessage = "No valid CSV data"
             return
 
-        repeated_item_dict = {}
-        output_dict = {}
-
-        current_dict = output_dict
-        lines = self.CSVData.split("\n")
-        lines = self._drop_empty_lines(lines)
-        for line in lines:
-            [key, data] = line.split(COMMA, 1)
-            # normally, there will be quote marks; strip them off
-            if data[0] == data[-1] == '"':
-                data = data[1:-1]
-            if key == "BeginRepeatedField":
-                temp_dict = dict()
-                current_dict = temp_dict
-            elif key == "EndRepeatedField":
-                # first time, allocate an empty list to be added to;
-                # else re-use existing list
-                if data+"List" not in repeated_item_dict:
-                    repeated_item_dict[data+"List"] = []
-                repeated_item_dict[data+"List"].append(current_dict)
-                # done processing list, resume regular output
-                current_dict = output_dict
-            else:
-                current_dict[key] = data
+        started = self._startTiming()
+
+        if self._csv_map is not None:
+            # mapped by getCSVData while validating; hand it over only once, so that
+            # each TSDRData gets dictionaries of its own
+            output_dict, repeated_item_dict = self._csv_map
+            self._csv_map = None
+        elif self._csv_fields is not None:
+            # extracted by the XPath engine; the map was already handed over
+            output_dict, repeated_item_dict = _map_fields(self._csv_fields, self.Projection)
+        else:
+            # CSVData was supplied directly, or the map was already handed over
+            csvresults, output_dict, repeated_item_dict = self._parseCSV(self._csvLines())
+            if not csvresults.CSV_OK:
+                self.ErrorCode = csvresults.error_code
+                self.ErrorMessage = csvresults.error_message
+                return
         tsdrdata = self.TSDRData
         tsdrdata.TSDRSingle = output_dict
         tsdrdata.TSDRMulti = repeated_item_dict
         tsdrdata.TSDRMapIsValid = True
+        self._compactTSDRData()
+        self._stopTiming("map", started)
+        return
+
+    def _compactTSDRData(self):
+        '''
+        If compact maps are wanted (see setCompactMaps), make the TSDR map compact
+        '''
+        if self.CompactMaps and self.TSDRData.TSDRMapIsValid:
+            self.TSDRData = self.TSDRData.compact()
         return
 
     def _processFileContents(self, filedata):
         # At this point, we've read data (as binary), but don't know whether its XML or zip
-        in_memory_file = bytesio(filedata)
+        in_memory_file = _buffer_file(filedata)
         if zipfile.is_zipfile(in_memory_file):
             # it's a zip file, process it as a zip file, pulling XML data, and other stuff, from the zip
-            self._processZip(in_memory_file, filedata)
+            started = self._startTiming()
+            xml_bytes = self._processZip(in_memory_file, filedata)
+            self._stopTiming("unzip", started, len(xml_bytes))
         else:
-            # it's not a zip, it's assumed XML-only;
-            # store to XMLData (other fields will remain None)
-            if PYTHON2: #Python2, filedata is already a string
-                self.XMLData = filedata
-            if PYTHON3: #Python3, filedata is bytes; must encode to a (Unicode) string
-                self.XMLData = filedata.decode(encoding="utf-8")
-
-        error_reason = self._xml_sanity_check(self.XMLData)
+            # it's not a zip, it's assumed XML-only (other fields will remain None)
+            xml_bytes = filedata
+        # kept as read; only decoded if XMLData is asked for
+        self.XMLData = None
+        self._xml_bytes = xml_bytes
+        if self.Retention == "lean":
+            self.PayloadDigest = hashlib.sha256(filedata).hexdigest()
+
+        # Parse once, from the original bytes; the tree is kept for getCSVData
+        started = self._startTiming()
+        error_reason, self.XMLTree = self._xml_sanity_check(xml_bytes)
+        self._stopTiming("parse", started, None if xml_bytes is None else len(xml_bytes))
         if error_reason != "":
             self.XMLDataIsValid = False
             self.ErrorCode = "XML-NoValidXML"
@@ -555,28 +3082,27 @@ class TSDRReq(object):
             self.XMLDataIsValid = True
         return
 
-    def _xml_sanity_check(self, text):
+    def _xml_sanity_check(self, xml_bytes):
         '''
-        Quick check to see if text is valid XML; not comprehensive, just a sanity check.
-        Returns string with an error reason if XML fails; or "" if XML passes
+        Quick check to see if XML data (as bytes) is valid XML; not comprehensive, just a sanity check.
+        Returns a tuple (error_reason, tree):
+          error_reason: string with an error reason if XML fails; or "" if XML passes
+          tree: parsed lxml ElementTree if XML passes; or None if XML fails
         '''
 
         error_reason = ""
-        if (text is None) or (text == ""):
+        tree = None
+        if (xml_bytes is None) or (len(xml_bytes) == 0):
             error_reason = "getXMLData: XML data is null or empty"
         else:
             try:
                 # see if this triggers an exception
-                if PYTHON2:
-                    f = stringio(text)
-                if PYTHON3:
-                    f = bytesio(text.encode(encoding="utf-8"))
-                etree.parse(f)
+                tree = etree.parse(_buffer_file(xml_bytes))
                 # no exception; passes sanity check
             except etree.XMLSyntaxError as e:
                 error_reason = "getXMLData: exception(lxml.etree.XMLSyntaxError) parsing purported XML data.  "\
-                                 "Reason: '<%s>'" %  e.message
-        return error_reason
+                                 "Reason: '<%s>'" %  e.msg
+        return error_reason, tree
 
 
     def _validate_PTO_parameters(self, number, tmtype):
@@ -608,44 +3134,48 @@ class TSDRReq(object):
 
     def _processZip(self, in_memory_file, zipdata):
         '''
-        process a zip file, completing appropriate fields of the TSDRReq
+        process a zip file, completing appropriate fields of the TSDRReq;
+        returns the (undecoded) XML data found in the zip file
+        '''
+        zipf, xmlfilename = self._openZip(in_memory_file, zipdata)
+        return zipf.read(xmlfilename)
+
+    def _openZip(self, zip_file, zipdata):
+        '''
+        open a zip file (a file object or filename), retaining it for ZipData and the
+        images, if RetainZipData is set: as zipdata (the zip file as bytes), or else
+        as the file named zip_file, if any.  Returns (zipf, xmlfilename): the open
+        ZipFile, and the name of the XML file in it
         '''
-        # basic task, getting the xml data:
-        zipf = zipfile.ZipFile(in_memory_file, "r")
+        # basic task, finding the xml data:
+        zipf = zipfile.ZipFile(zip_file, "r")
         xmlfiles = [name for name in zipf.namelist()
                     if name.lower().endswith(".xml")]
         assert len(xmlfiles) == 1
         xmlfilename = xmlfiles[0]
-        xml_data_from_zipfile = zipf.read(xmlfilename)
-        if PYTHON2:
-            # In Python2, ZipFile.read() returns a string; just use it
-            self.XMLData = xml_data_from_zipfile
-        if PYTHON3:
-            # In Python3, ZipFile.read() returns bytes; must encode into a string
-            self.XMLData = xml_data_from_zipfile.decode(encoding="utf-8")
-        
-        # bells & whistles:
-        self.ImageFull  = None
-        self.ImageThumb = None
-        self.ZipData    = None
-        # save the images, if there are any
-        try:
-            self.ImageFull = zipf.read("markImage.jpg")
-        except KeyError:
-            pass
-        try:
-            self.ImageThumb = zipf.read("markThumbnailImage.jpg")
-        except KeyError:
-            pass
-        self.ZipData = zipdata
 
-        return
+        # bells & whistles (the images are only read if asked for; see ImageFull, writeImage):
+        self.ZipData = None
+        if self.RetainZipData:
+            if zipdata is not None:
+                self.ZipData = zipdata
+            elif not hasattr(zip_file, "read"):
+                self._zip_file = zip_file
+
+        return zipf, xmlfilename
 
     def _determine_xml_format(self, tree):
         '''
         Given a parsed XML tree, determine its format ("ST66" or "ST96";
         or None, if not determinable)
         '''
+        return self._xml_format_for_tag(tree.getroot().tag)
+
+    def _xml_format_for_tag(self, tag):
+        '''
+        Given the tag of an XML document's root element, determine its format
+        ("ST66" or "ST96"; or None, if not determinable)
+        '''
 
         ST66_root_tag = \
             "{http://www.wipo.int/standards/XMLSchema/trademarks}Transaction"
@@ -661,26 +3191,11 @@ class TSDRReq(object):
             ST96_root_tag : "ST96"
             }
 
-        root = tree.getroot()
-        tag = root.tag
         result = None   #default answer if not in the map
         if tag in tag_map:
             result = tag_map[tag]
         return result
 
-    def _normalize_empty_lines(self, string_of_lines):
-        '''
-        This method takes a string of lines, separated by the system line separator
-        characteor (e.g. \n), and eliminates lines that are empty or consisting entirely of
-        whitespace. Its purpose is to relax what input is accepted from the the XSLT process,
-        so that including empty lines is permitted and whether the final line ends with a
-        newline is immaterial.
-        '''
-        lines = string_of_lines.split(LINE_SEPARATOR)
-        lines = self._drop_empty_lines(lines)
-        reassembled_string_of_lines = LINE_SEPARATOR.join(lines) + LINE_SEPARATOR
-        return reassembled_string_of_lines
-
     def _drop_empty_lines(self, lines):
         '''
         This method takes a list of lines and drops those that are empty, where "empty"
@@ -712,7 +3227,28 @@ class TSDRReq(object):
 
     def _validateCSV(self):
         '''
-        validateCSV performs a naive sanity-check of the CSV for obvious errors.
+        Sanity-check self.CSVData for obvious errors; see _parseCSV for the checks made.
+
+        Returns _validateCSVResponse object
+        '''
+        result, _, _ = self._parseCSV(self._csvLines())
+        return result
+
+    def _csvLines(self):
+        '''
+        Non-empty lines of the CSV data: those kept by getCSVData, or else
+        those of CSVData as supplied directly
+        '''
+        if self._csv_lines is not None:
+            return self._csv_lines
+        return self._drop_empty_lines(self.CSVData.split(LINE_SEPARATOR))
+
+    def _parseCSV(self, lines):
+        '''
+        _parseCSV validates the (non-empty) lines of CSV data and, in the same pass,
+        maps them into the dictionaries used for the TSDR map.
+
+        The validation is a naive sanity-check of the CSV for obvious errors.
         It's not bullet-proof, but catches some of the more likely problems that would
         survive the XSLT transform without errors, but potentially produce erroneous
         data that might cause hard-to-find problems downstream.
@@ -728,55 +3264,85 @@ class TSDRReq(object):
               - No spaces or other whitespace anywhere except in VALUE, inside the
                 quotes; not even before/after the comma or after "VALUE".
 
-        Returns _validateCSVResponse object
+        The mapping is as described in getTSDRData.
+
+        Returns a tuple (result, tsdr_single, tsdr_multi):
+          result: _validateCSVResponse object
+          tsdr_single, tsdr_multi: dictionaries for TSDRSingle and TSDRMulti;
+            or None, if the CSV data fails validation
         '''
         result = self._validateCSVResponse()
-        valid_key_chars = set(string.ascii_letters + string.digits)
         try:
-            lines = self.CSVData.split(LINE_SEPARATOR)
-            lines = self._drop_empty_lines(lines)
             if len(lines) < 2:
                 result.error_code = "CSV-ShortCSV"
                 result.error_message = "getCSVData: XML parsed to fewer than 2 lines of CSV"
                 raise ValueError
-            for line_number_offset in range(0, len(lines)):
-                line = lines[line_number_offset]
-                comma_position = line.find(COMMA)
-                if comma_position == -1:
-                    result.error_code = "CSV-InvalidKeyValuePair"
-                    result.error_message = "getCSVData [line %s]: " \
-                        "no key-value pair found in line <%s> (missing comma)" \
-                        % (line_number_offset+1, line)
-                    raise ValueError
-                k, v = line.split(COMMA, 1)
-                if not set(k).issubset(valid_key_chars):
-                    result.error_code = "CSV-InvalidKey"
-                    result.error_message = "getCSVData [line %s]: " \
-                        "invalid key <%s> found (invalid characters in key)" \
-                        % (line_number_offset+1, k)
-                    raise ValueError
-                stripped_v = v[1:-1]
-                if '"' + stripped_v + '"' != v:
-                    result.error_code = "CSV-InvalidValue"
-                    result.error_message = "getCSVData [line %s]: " \
-                        "invalid value <%s> found for key <%s> " \
-                        "(does not begin and end with double-quote character)" \
-                        % (line_number_offset+1, v, k)
-                    raise ValueError
+            tsdr_single, tsdr_multi = _map_fields(self._validated_fields(lines, result),
+                                                  self.Projection)
         except ValueError:
             if result.error_code is None:   # Not good, something we didn't count on went wrong
                 result.error_code = "CSV-UnknownError"
                 result.error_message = "getCSVData: unknown error validating CSV data"
             result.CSV_OK = False
-        return result
+            return result, None, None
+        return result, tsdr_single, tsdr_multi
+
+    def _validated_fields(self, lines, result):
+        '''
+        Generator for _parseCSV: checks each line, yielding its (key, value) pair;
+        on the first bad line, records the error in result and raises ValueError
+        '''
+        key_ok = _csv_key_pattern.match
+        for line_number_offset, line in enumerate(lines):
+            comma_position = line.find(COMMA)
+            if comma_position == -1:
+                result.error_code = "CSV-InvalidKeyValuePair"
+                result.error_message = "getCSVData [line %s]: " \
+                    "no key-value pair found in line <%s> (missing comma)" \
+                    % (line_number_offset+1, line)
+                raise ValueError
+            k = line[:comma_position]
+            v = line[comma_position+1:]
+            if key_ok(k) is None:
+                result.error_code = "CSV-InvalidKey"
+                result.error_message = "getCSVData [line %s]: " \
+                    "invalid key <%s> found (invalid characters in key)" \
+                    % (line_number_offset+1, k)
+                raise ValueError
+            if len(v) < 2 or v[0] != '"' or v[-1] != '"':
+                result.error_code = "CSV-InvalidValue"
+                result.error_message = "getCSVData [line %s]: " \
+                    "invalid value <%s> found for key <%s> " \
+                    "(does not begin and end with double-quote character)" \
+                    % (line_number_offset+1, v, k)
+                raise ValueError
+            yield k, v[1:-1]
+
+    def _set_run_substitutions(self, xml_source):
+        '''
+        Record the run-time substitution values (XML source and execution time)
+        in this request's own substitution context
+        '''
+        self._substitutions["$XMLSOURCE$"] = xml_source
+        now = time.strftime("%Y-%m-%d %H:%M:%S")
+        self._substitutions["$EXECUTIONDATETIME$"] = now
+        return
+
+    def _transform_parameters(self):
+        '''
+        Values of this request's $placeholders, as XSLT parameters (see _compile_stylesheet)
+        '''
+        return dict((_placeholder_parameter(placeholder), etree.XSLT.strparam(value))
+                    for placeholder, value in self._substitutions.items())
 
     def _perform_substitution(self, s):
         '''
-        Substitute run-time data for $placeholders from XSLT
+        Substitute run-time data for $placeholders from XSLT that could not be
+        passed as parameters (see _compile_stylesheet), in a single pass
         '''
-        for variable in _TSDR_substitutions:
-            s = s.replace(variable, _TSDR_substitutions[variable])
-        return s
+        substitutions = self._substitutions
+        return _placeholder_pattern.sub(
+            lambda match: substitutions.get(match.group(0), match.group(0)), s)
 
 if __name__ == "__main__":
     # if run as command, print short documentation and exit
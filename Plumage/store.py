@@ -0,0 +1,322 @@
+'''
+Plumage store:
+    Keep TSDR maps in a SQLite database, indexed for querying large portfolios
+    without fetching or transforming the XML again
+
+Each mark is one row of the Marks table, keyed by ApplicationNumber, with a
+column for each TSDRSingle key; each TSDRMulti list (MarkEventList,
+ApplicantList, AssignmentList, ...) is a child table of the same name, with a
+row for each entry (ApplicationNumber, Position, and a column for each of the
+entry's keys). Columns are added as new keys are seen, so maps from a
+caller-supplied XSLT are stored as readily as those from the standard ones.
+Indexed: application number, registration number, current status date
+(MarkCurrentStatusDateTruncated) and mark event date (MarkEventDateTruncated).
+Any other tables in the database (a caller's own, say) are left alone.
+
+To use:
+    from Plumage import plumage, store
+    s = store.TSDRStore("portfolio.db")
+    t = plumage.TSDRReq()
+    t.getTSDRInfo("76044902", "s")
+    s.store(t)
+    for application_number in s.marksWithEventsSince("2018-03-01"):
+        print(s.getTSDRMap(application_number).TSDRSingle["MarkVerbalElementText"])
+
+For details, see https://github.com/codingatty/Plumage/wiki
+'''
+
+# Copyright 2014-2018 Terry Carroll
+# carroll@tjc.com
+#
+# License information:
+#
+# This program is licensed under Apache License, version 2.0 (January 2004);
+# see http://www.apache.org/licenses/LICENSE-2.0
+# SPX-License-Identifier: Apache-2.0
+#
+# Anyone who makes use of, or who modifies, this code is encouraged
+# (but not required) to notify the author.
+
+import collections
+import datetime
+import itertools
+import re
+import sqlite3
+
+from Plumage import plumage
+
+MARKS_TABLE = "Marks"
+_KEY = "ApplicationNumber"
+_POSITION = "Position"
+
+# Columns created, and indexed, with each table (beyond its key)
+_INDEXED_COLUMNS = {
+    MARKS_TABLE : ["RegistrationNumber", "MarkCurrentStatusDateTruncated"],
+    "MarkEventList" : ["MarkEventDateTruncated"],
+    }
+
+_name_pattern = re.compile(r"[A-Za-z0-9]+\Z")   # table and column names: as CSV keys
+
+class TSDRStore(object):
+    '''
+    SQLite store of TSDR maps; see the module documentation for its tables.
+
+    Storing a map for an application number already in the store replaces it
+    (its Marks row and all its child rows). Maps are written executemany()
+    batch_size at a time, each batch in a single transaction; the database is
+    in WAL mode, so that it can be queried (by other connections, too) while a
+    large portfolio is being written.
+
+    A TSDRStore is also a sink for batch.TSDRReprocessor.reprocessTo.
+    '''
+
+    def __init__(self, database, batch_size=500):
+        '''
+        Open (creating, if need be) a store
+
+        Parameters:
+            database: pathname of the SQLite database; or ":memory:"
+            batch_size: number of maps written per transaction by storeMany
+        '''
+        if batch_size < 1:
+            raise ValueError("batch_size must be at least 1")
+        self.batch_size = batch_size
+        self.connection = sqlite3.connect(database)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self._columns = {}  # table name: set of its column names (only the store's own tables)
+        for (table,) in self.connection.execute(
+                "SELECT name FROM sqlite_master WHERE type='table' AND name NOT LIKE 'sqlite%'"):
+            columns = set(row[1] for row in
+                          self.connection.execute("PRAGMA table_info(%s)" % _quote(table)))
+            if _isStoreTable(table, columns):
+                self._columns[table] = columns
+        with self.connection:
+            self._ensureTable(MARKS_TABLE, [])
+
+    def close(self):
+        '''
+        Close the database
+        '''
+        self.connection.close()
+        return
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+    def store(self, tsdrmap):
+        '''
+        Store one TSDR map; see storeMany
+        '''
+        return self.storeMany([tsdrmap])
+
+    def storeMany(self, tsdrmaps):
+        '''
+        Store TSDR maps, replacing any already stored for the same application
+        numbers. Returns the number stored.
+
+        Parameters:
+            tsdrmaps: iterable of TSDRMap; or of anything with TSDRSingle and
+                TSDRMulti (a batch.TSDRArchiveResult) or TSDRData (a TSDRReq).
+                Those that are not valid are skipped; a valid map must have an
+                ApplicationNumber (ValueError, if not: a projection that leaves
+                it out, say).
+        '''
+        count = 0
+        tsdrmaps = iter(tsdrmaps)
+        while True:
+            items = list(itertools.islice(tsdrmaps, self.batch_size))
+            if not items:
+                break
+            maps = [tsdrmap for tsdrmap in (_tsdrMap(item) for item in items)
+                    if tsdrmap is not None]
+            if maps:
+                with self.connection:
+                    self._storeBatch(maps)
+                count += len(maps)
+        return count
+
+    def __call__(self, chunk):
+        '''
+        As a sink for batch.TSDRReprocessor.reprocessTo: store a chunk of results
+        '''
+        self.storeMany(chunk)
+        return
+
+    def getTSDRMap(self, application_number):
+        '''
+        The stored TSDR map for an application number, as a TSDRMap; None if
+        there is none. Fields absent from the map as stored are absent from the
+        copy returned; the order of each TSDRMulti list is kept.
+        '''
+        cursor = self.connection.execute(
+            "SELECT * FROM %s WHERE %s = ?" % (_quote(MARKS_TABLE), _KEY), (application_number,))
+        row = cursor.fetchone()
+        if row is None:
+            return None
+        tsdrmap = plumage.TSDRMap()
+        tsdrmap.TSDRSingle = _rowDict(cursor.description, row)
+        tsdrmap.TSDRMulti = {}
+        for table in sorted(self._columns):
+            if table == MARKS_TABLE:
+                continue
+            cursor = self.connection.execute(
+                "SELECT * FROM %s WHERE %s = ? ORDER BY %s" % (_quote(table), _KEY, _POSITION),
+                (application_number,))
+            entries = [_rowDict(cursor.description, row, child=True) for row in cursor]
+            if entries:
+                tsdrmap.TSDRMulti[table] = entries
+        tsdrmap.TSDRMapIsValid = True
+        return tsdrmap
+
+    def marksWithEventsSince(self, since):
+        '''
+        Application numbers (sorted) of the marks with a mark event dated on or
+        after since (a datetime.date, or "YYYY-MM-DD"); answered from the index
+        on MarkEventDateTruncated
+        '''
+        if "MarkEventList" not in self._columns:
+            return []   # no events stored yet
+        # (sorted here, not by the query: ORDER BY would have SQLite scan the
+        # table in key order rather than search the date index; so, too, below)
+        return sorted(set(row[0] for row in self.connection.execute(
+            "SELECT %s FROM MarkEventList WHERE MarkEventDateTruncated >= ?" % _KEY,
+            (_isoDate(since),))))
+
+    def marksWithStatusSince(self, since):
+        '''
+        Application numbers (sorted) of the marks whose current status is dated
+        on or after since (a datetime.date, or "YYYY-MM-DD"); answered from the
+        index on MarkCurrentStatusDateTruncated
+        '''
+        return sorted(row[0] for row in self.connection.execute(
+            "SELECT %s FROM %s WHERE MarkCurrentStatusDateTruncated >= ?" % (_KEY, _quote(MARKS_TABLE)),
+            (_isoDate(since),)))
+
+    def query(self, sql, parameters=()):
+        '''
+        Run any other query against the store; returns a list of rows (tuples)
+        '''
+        return self.connection.execute(sql, parameters).fetchall()
+
+    def _storeBatch(self, maps):
+        '''
+        Write a batch of TSDR maps (within the caller's transaction)
+        '''
+        latest = collections.OrderedDict()     # application number: its last map in the batch
+        for tsdrmap in maps:
+            if not tsdrmap.TSDRSingle.get(_KEY):
+                raise ValueError("TSDR map has no %s; cannot be stored" % _KEY)
+            latest[tsdrmap.TSDRSingle[_KEY]] = tsdrmap
+        rows = collections.defaultdict(list)   # (table, columns): rows, for executemany
+        application_numbers = [(application_number,) for application_number in latest]
+        for tsdrmap in latest.values():
+            single = tsdrmap.TSDRSingle
+            columns = tuple(sorted(single))
+            rows[(MARKS_TABLE, columns)].append(tuple(single[column] for column in columns))
+            for list_name, entries in tsdrmap.TSDRMulti.items():
+                for position, entry in enumerate(entries):
+                    columns = (_KEY, _POSITION) + tuple(sorted(entry))
+                    rows[(list_name, columns)].append(
+                        (single[_KEY], position) + tuple(entry[column] for column in columns[2:]))
+        # replacing: first clear out each mark's child rows (lists may have shrunk or gone)
+        for table in self._columns:
+            if table != MARKS_TABLE:
+                self.connection.executemany(
+                    "DELETE FROM %s WHERE %s = ?" % (_quote(table), _KEY), application_numbers)
+        for (table, columns), table_rows in sorted(rows.items()):
+            self._ensureTable(table, columns)
+            verb = "INSERT OR REPLACE" if table == MARKS_TABLE else "INSERT"
+            self.connection.executemany(
+                "%s INTO %s (%s) VALUES (%s)" % (verb, _quote(table),
+                                                 ", ".join(_quote(column) for column in columns),
+                                                 ", ".join("?" * len(columns))),
+                table_rows)
+        return
+
+    def _ensureTable(self, table, columns):
+        '''
+        Create table (with its key, and its indexed columns, indexed), if it does
+        not exist; and add any of columns it does not yet have
+        '''
+        if table not in self._columns:
+            _checkName(table)
+            indexed = _INDEXED_COLUMNS.get(table, [])
+            if table == MARKS_TABLE:
+                key = ["%s TEXT PRIMARY KEY" % _KEY]
+            else:
+                key = ["%s TEXT NOT NULL" % _KEY, "%s INTEGER NOT NULL" % _POSITION,
+                       "PRIMARY KEY (%s, %s)" % (_KEY, _POSITION)]
+            self.connection.execute("CREATE TABLE %s (%s)" % (
+                _quote(table), ", ".join(["%s TEXT" % _quote(column) for column in indexed] + key)))
+            for column in indexed:
+                self.connection.execute("CREATE INDEX %s ON %s (%s)" % (
+                    _quote("%s_%s" % (table, column)), _quote(table), _quote(column)))
+            self._columns[table] = set(indexed) | set([_KEY]) | \
+                                   (set() if table == MARKS_TABLE else set([_POSITION]))
+        for column in columns:
+            if column not in self._columns[table]:
+                _checkName(column)
+                self.connection.execute("ALTER TABLE %s ADD COLUMN %s TEXT" % (
+                    _quote(table), _quote(column)))
+                self._columns[table].add(column)
+        return
+
+def _isStoreTable(table, columns):
+    '''
+    True if a table already in the database is one of the store's own (the
+    Marks table, or a child table, as _ensureTable creates them); any other
+    table (one a caller added, say) is left alone
+    '''
+    if not _name_pattern.match(table) or _KEY not in columns:
+        return False
+    return table == MARKS_TABLE or _POSITION in columns
+
+def _quote(name):
+    '''
+    SQL identifier for a table or column name
+    '''
+    return '"%s"' % name
+
+def _checkName(name):
+    '''
+    Table and column names come from TSDRMulti list names and TSDR map keys;
+    accept only the letters and digits a transform's CSV keys are made of
+    '''
+    if not _name_pattern.match(name):
+        raise ValueError("cannot store TSDR field %r: not a valid key" % (name,))
+    return
+
+def _tsdrMap(item):
+    '''
+    The TSDRMap in (or equivalent to) item, if valid; else None
+    '''
+    tsdrmap = getattr(item, "TSDRData", item)    # (a TSDRReq)
+    if not tsdrmap.TSDRMapIsValid:
+        return None
+    return tsdrmap
+
+def _rowDict(description, row, child=False):
+    '''
+    Dictionary of a row's columns that have values; a child table's key
+    columns are left out
+    '''
+    result = {}
+    for column, value in zip(description, row):
+        name = column[0]
+        if value is None or (child and name in (_KEY, _POSITION)):
+            continue
+        result[str(name)] = value
+    return result
+
+def _isoDate(date):
+    '''
+    "YYYY-MM-DD", from a datetime.date or the same string
+    '''
+    if isinstance(date, datetime.date):
+        return date.isoformat()
+    return date
@@ -0,0 +1,79 @@
+'''
+Benchmark: a portfolio report (filing-date histogram by year, marks filed in a
+one-year window, and a status breakdown) over many TSDR maps, computed map by
+map in Python, and from columns (Plumage.columns, NumPy).
+
+Not a unit test (needs NumPy). Run from the tests directory:
+    $ python bench_columns.py [maps]
+
+The portfolio is the ST.66 sample's map, repeated (default 100,000 times)
+with application dates one day apart. Timed for the columns: collecting the
+maps, and then the report itself.
+'''
+
+from __future__ import print_function
+import collections
+import datetime
+import os
+import sys
+import time
+
+import numpy
+
+from testing_context import plumage
+from Plumage import columns
+
+def portfolio(count):
+    t = plumage.TSDRReq()
+    t.getTSDRInfo(os.path.join("testfiles", "sn76044902.zip"))
+    start = datetime.date(1990, 1, 1)
+    maps = []
+    for n in range(count):
+        tsdrmap = t.TSDRData.copy()
+        tsdrmap.TSDRSingle["ApplicationDate"] = (start + datetime.timedelta(days=n)).isoformat() + "-05:00"
+        maps.append(tsdrmap)
+    return maps
+
+def loop_report(maps):
+    by_year = collections.Counter()
+    in_window = 0
+    statuses = collections.Counter()
+    window_start, window_end = datetime.date(2003, 1, 1), datetime.date(2004, 1, 1)
+    for tsdrmap in maps:
+        single = tsdrmap.TSDRSingle
+        filed = datetime.datetime.strptime(single["ApplicationDate"][:10], "%Y-%m-%d").date()
+        by_year[filed.year] += 1
+        if window_start <= filed < window_end:
+            in_window += 1
+        statuses[single["MarkCurrentStatusExternalDescriptionText"]] += 1
+    return dict(by_year), in_window, dict(statuses)
+
+def column_report(c):
+    filed = c.column("ApplicationDate")
+    years, counts = numpy.unique(filed.astype("datetime64[Y]").astype(int) + 1970, return_counts=True)
+    in_window = int(((filed >= numpy.datetime64("2003-01-01")) &
+                     (filed < numpy.datetime64("2004-01-01"))).sum())
+    statuses = c.valueCounts("MarkCurrentStatusExternalDescriptionText")
+    return dict(zip(years.tolist(), counts.tolist())), in_window, statuses
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    maps = portfolio(count)
+    start = time.time()
+    loop_result = loop_report(maps)
+    loop_seconds = time.time() - start
+    start = time.time()
+    c = columns.TSDRColumns()
+    c.addMany(maps)
+    collect_seconds = time.time() - start
+    start = time.time()
+    column_result = column_report(c)
+    report_seconds = time.time() - start
+    assert column_result == loop_result
+    print("Portfolio report over %d TSDR maps (seconds):" % count)
+    print("  map by map:  %7.3f" % loop_seconds)
+    print("  columns:     %7.3f  (collecting: %.3f; report: %.3f)"
+          % (collect_seconds + report_seconds, collect_seconds, report_seconds))
+
+if __name__ == '__main__':
+    main()
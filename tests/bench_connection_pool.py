@@ -0,0 +1,67 @@
+'''
+Benchmark: PTO fetches per second with and without the keep-alive connection
+pool, against a local HTTPS stand-in for the PTO server.
+
+Not a unit test. Requires the openssl command-line tool (to make a throwaway
+self-signed certificate). Run from the tests directory:
+    $ python bench_connection_pool.py [fetch-count]
+'''
+
+from __future__ import print_function
+import os
+import shutil
+import ssl
+import subprocess
+import sys
+import tempfile
+import time
+
+from testing_context import plumage
+from pto_standin import PTOStandIn
+
+def make_server_context(workdir):
+    certfile = os.path.join(workdir, "cert.pem")
+    keyfile = os.path.join(workdir, "key.pem")
+    subprocess.check_call(
+        ["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-days", "1",
+         "-subj", "/CN=127.0.0.1", "-keyout", keyfile, "-out", certfile],
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.load_cert_chain(certfile, keyfile)
+    return context
+
+def run(pool, count):
+    t = plumage.TSDRReq()
+    t.setConnectionPool(pool)
+    start = time.time()
+    for _ in range(count):
+        t.getXMLData("76044902", "s")
+        assert t.XMLDataIsValid, t.ErrorMessage
+    return count / (time.time() - start)
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    workdir = tempfile.mkdtemp()
+    try:
+        standin = PTOStandIn(ssl_context=make_server_context(workdir)).start()
+    finally:
+        shutil.rmtree(workdir)
+    saved_url_templates = plumage._pto_url_templates
+    plumage._pto_url_templates = standin.url_templates()
+    try:
+        pool = plumage.TSDRConnectionPool(ssl_context=plumage._unverified_ssl_context())
+        run(pool, 5)    # warm up
+        unpooled = run(None, count)
+        pooled = run(pool, count)
+        pool.close()
+    finally:
+        plumage._pto_url_templates = saved_url_templates
+        standin.stop()
+    print("%d HTTPS fetches from %s" % (count, standin.base_url))
+    print("  without pool: %8.1f fetches/second" % unpooled)
+    print("  with pool:    %8.1f fetches/second  (%.1fx)" % (pooled, pooled / unpooled))
+    print("  pool: %d connections opened, %d reused, %d stale" %
+          (pool.connections_opened, pool.connections_reused, pool.stale_connections))
+
+if __name__ == '__main__':
+    main()
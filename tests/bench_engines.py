@@ -0,0 +1,52 @@
+'''
+Benchmark: XML to TSDR map (getCSVData plus getTSDRData) with the XSLT engine
+and with the XPath engine (Plumage.extract), on the ST.66 and ST.96 samples;
+and with each, projected to a typical five fields (see TSDRReq.setProjection).
+
+Not a unit test. Run from the tests directory:
+    $ python bench_engines.py [repetitions]
+
+The XML is parsed once, beforehand; only the extraction and mapping are timed.
+'''
+
+from __future__ import print_function
+import os
+import sys
+import timeit
+
+from testing_context import plumage
+
+PROJECTION = ["MarkCurrentStatusExternalDescriptionText", "MarkCurrentStatusDate",
+              "RegistrationNumber", "ApplicantList", "MarkEventList"]
+
+TESTFILES = [
+    ("ST.66", os.path.join("testfiles", "sn76044902.xml")),
+    ("ST.96", os.path.join("testfiles", "rn2178784-ST-962.2.1.xml")),
+    ]
+
+def rate(t, engine, projection, repetitions):
+    t.setEngine(engine)
+    t.setProjection(projection)
+    def extract():
+        t.getCSVData()
+        t.getTSDRData()
+    extract()   # warm up (compiles the transform or the XPath expressions)
+    assert t.TSDRData.TSDRMapIsValid, t.ErrorMessage
+    seconds = min(timeit.repeat(extract, number=repetitions, repeat=5))
+    return repetitions / seconds, (t.TSDRData.TSDRSingle, t.TSDRData.TSDRMulti)
+
+def main():
+    repetitions = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    print("XML to TSDR map (marks per second):")
+    for label, testfile in TESTFILES:
+        t = plumage.TSDRReq()
+        t.getXMLData(testfile)
+        for projection, description in [(None, "all fields"), (PROJECTION, "projected")]:
+            xslt_rate, xslt_map = rate(t, "XSLT", projection, repetitions)
+            xpath_rate, xpath_map = rate(t, "XPath", projection, repetitions)
+            assert xslt_map == xpath_map
+            print("  %s %-11s XSLT: %8.0f   XPath: %8.0f  (%.2fx)"
+                  % (label, description, xslt_rate, xpath_rate, xpath_rate / xslt_rate))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,75 @@
+'''
+Benchmark: time to import Plumage.plumage, as measured by "python -X importtime",
+with a regression check.
+
+Not a unit test. Run from the tests directory:
+    $ python bench_import_time.py [runs] [max-self-ms]
+
+Reports the median, over runs (default 10) fresh interpreters, of the time
+spent in Plumage.plumage's own module code ("self") and in total, including
+the modules it imports ("cumulative"). Exits with status 1 if:
+  - the self time exceeds max-self-ms (default 10), or
+  - importing compiled any of the built-in XSLT transforms (they are compiled
+    on first use), or
+  - importing pulled in a module on the list of heavy modules Plumage does
+    not need (e.g. unittest)
+'''
+
+from __future__ import print_function
+import os
+import subprocess
+import sys
+
+PACKAGE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+UNNEEDED_MODULES = ["unittest", "doctest", "pdb"]
+PROBE = ("import sys; import Plumage.plumage as p; "
+         "print(','.join(name for name, d in sorted(p._xslt_table.items()) if d._compiled is not None)); "
+         "print(','.join(m for m in %r if m in sys.modules))" % UNNEEDED_MODULES)
+
+def median(values):
+    values = sorted(values)
+    return values[len(values) // 2]
+
+def import_times():
+    '''
+    One fresh interpreter's -X importtime figures for Plumage.plumage: (self, cumulative), in ms
+    '''
+    output = subprocess.check_output(
+        [sys.executable, "-X", "importtime", "-c", "import Plumage.plumage"],
+        cwd=PACKAGE_DIR, stderr=subprocess.STDOUT, universal_newlines=True)
+    for line in output.splitlines():
+        fields = [field.strip() for field in line.split("|")]
+        if len(fields) == 3 and fields[2] == "Plumage.plumage":
+            self_us = int(fields[0].split(":")[1])
+            return self_us / 1000.0, int(fields[1]) / 1000.0
+    raise RuntimeError("Plumage.plumage not found in -X importtime output:\n" + output)
+
+def main():
+    if sys.version_info < (3, 7):
+        sys.exit("-X importtime requires Python 3.7 or later")
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+    max_self_ms = float(sys.argv[2]) if len(sys.argv) > 2 else 10.0
+    import_times()      # warm up: write bytecode, fill the OS file cache
+    times = [import_times() for _ in range(runs)]
+    self_ms = median([t[0] for t in times])
+    cumulative_ms = median([t[1] for t in times])
+    compiled, unneeded = subprocess.check_output(
+        [sys.executable, "-c", PROBE], cwd=PACKAGE_DIR,
+        universal_newlines=True).splitlines()
+
+    print("import Plumage.plumage, median of %d runs:" % runs)
+    print("  self:       %7.1f ms  (limit %.1f ms)" % (self_ms, max_self_ms))
+    print("  cumulative: %7.1f ms  (including lxml, http.client, ...)" % cumulative_ms)
+    failures = []
+    if self_ms > max_self_ms:
+        failures.append("self time %.1f ms exceeds %.1f ms" % (self_ms, max_self_ms))
+    if compiled:
+        failures.append("XSLT transforms compiled at import: %s" % compiled)
+    if unneeded:
+        failures.append("unneeded modules imported: %s" % unneeded)
+    for failure in failures:
+        print("REGRESSION: " + failure)
+    sys.exit(1 if failures else 0)
+
+if __name__ == '__main__':
+    main()
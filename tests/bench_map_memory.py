@@ -0,0 +1,62 @@
+'''
+Benchmark: memory held per TSDR map, as ordinary dictionaries and lists and
+as compact maps (see TSDRReq.setCompactMaps), on the ST.66 and ST.96 samples;
+and the time taken to make each map compact.
+
+Not a unit test (Python 3 only, for tracemalloc). Run from the tests directory:
+    $ python bench_map_memory.py [maps]
+
+Each sample is parsed once; then maps (default 2,000) TSDR maps are built
+from it, each with dictionaries (and key strings) of its own, as they would
+be from that many different marks, and kept. Bytes per mark counts only the
+maps kept (TSDRData), not the XML.
+'''
+
+from __future__ import print_function
+import gc
+import os
+import sys
+import time
+import tracemalloc
+
+from testing_context import plumage
+
+TESTFILES = [
+    ("ST.66", os.path.join("testfiles", "sn76044902.xml")),
+    ("ST.96", os.path.join("testfiles", "rn2178784-ST-962.2.1.xml")),
+    ]
+
+def bytes_per_mark(testfile, compact, count):
+    t = plumage.TSDRReq()
+    t.setCompactMaps(compact)
+    t.getXMLData(testfile)
+    t.getCSVData()
+    gc.collect()
+    tracemalloc.start()
+    start = tracemalloc.get_traced_memory()[0]
+    began = time.time()
+    maps = []
+    for _ in range(count):
+        t.getTSDRData()
+        assert t.TSDRData.TSDRMapIsValid, t.ErrorMessage
+        maps.append(t.TSDRData)
+    elapsed = time.time() - began
+    t.resetTSDRData()
+    gc.collect()
+    held = tracemalloc.get_traced_memory()[0] - start
+    tracemalloc.stop()
+    return held / count, elapsed / count
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    print("Memory held per TSDR map (%d maps kept):" % count)
+    for label, testfile in TESTFILES:
+        dict_bytes, dict_seconds = bytes_per_mark(testfile, False, count)
+        compact_bytes, compact_seconds = bytes_per_mark(testfile, True, count)
+        print("  %s  dictionaries: %7.0f bytes   compact: %7.0f bytes  (%.2fx);"
+              "  compacting: %.0f microseconds per map"
+              % (label, dict_bytes, compact_bytes, compact_bytes / dict_bytes,
+                 (compact_seconds - dict_seconds) * 1e6))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,74 @@
+'''
+Benchmark: offline bulk reprocessing (batch.TSDRReprocessor) of a tar bundle of
+the supplied test files, against a one-core loop calling getTSDRInfo on each,
+with 1, 2, 4 ... workers up to the number of CPUs.
+
+Not a unit test. Run from the tests directory:
+    $ python bench_reprocess.py [copies]
+
+The bundle holds copies copies (default 200) of each of the ST.66 zip and
+ST.96 XML test files.
+'''
+
+from __future__ import print_function
+import multiprocessing
+import os
+import shutil
+import sys
+import tarfile
+import tempfile
+import time
+
+from testing_context import plumage
+from Plumage import batch
+
+TESTFILES = [os.path.join("testfiles", "sn76044902.zip"),
+             os.path.join("testfiles", "rn2178784-ST-962.2.1.xml")]
+
+def make_bundle(directory, copies):
+    bundle = os.path.join(directory, "bundle.tar")
+    with tarfile.open(bundle, "w") as tar:
+        for n in range(copies):
+            for testfile in TESTFILES:
+                tar.add(testfile, arcname="%05d/%s" % (n, os.path.basename(testfile)))
+    return bundle
+
+def serial(bundle):
+    t = plumage.TSDRReq()
+    for label, pathname, data in batch.iterPayloads(bundle):
+        t.getXMLDataFromBytes(data, source_label=label)
+        t._completeTSDRInfo()
+        assert t.TSDRData.TSDRMapIsValid, t.ErrorMessage
+
+def reprocessed(bundle, workers):
+    count = 0
+    for chunk in batch.TSDRReprocessor(workers=workers).reprocessMany(bundle):
+        assert all(result.TSDRMapIsValid for result in chunk)
+        count += len(chunk)
+    return count
+
+def main():
+    copies = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    directory = tempfile.mkdtemp()
+    try:
+        bundle = make_bundle(directory, copies)
+        entries = copies * len(TESTFILES)
+        start = time.time()
+        serial(bundle)
+        serial_rate = entries / (time.time() - start)
+        print("Reprocessing %d entries (marks per second):" % entries)
+        print("  one-core loop: %8.0f" % serial_rate)
+        workers = 1
+        while True:
+            start = time.time()
+            assert reprocessed(bundle, workers) == entries
+            rate = entries / (time.time() - start)
+            print("  %2d worker(s):  %8.0f  (%.2fx)" % (workers, rate, rate / serial_rate))
+            if workers >= multiprocessing.cpu_count():
+                break
+            workers = min(2 * workers, multiprocessing.cpu_count())
+    finally:
+        shutil.rmtree(directory)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,70 @@
+'''
+Benchmark: the $placeholder$ substitution stage, on the ST.96 sample
+(testfiles/rn2178784-ST-962.2.1.xml).
+
+Not a unit test. Run from the tests directory:
+    $ python bench_substitution.py [repetitions]
+
+Compares, per mark:
+  replace loop: the stylesheet compiled as written, and str.replace run on the
+      whole output once per placeholder (Plumage 1.3.0 and earlier)
+  regex pass:   the stylesheet compiled as written, and one regular-expression
+      pass over the output (still used for caller XSLT with placeholders
+      that can't be passed as parameters)
+  parameters:   placeholders rewritten as xsl:params at compile time, with
+      their values passed to the transform (current, for built-in XSLT)
+'''
+
+from __future__ import print_function
+import os
+import sys
+import timeit
+
+from lxml import etree
+from testing_context import plumage
+
+TESTFILE = os.path.join("testfiles", "rn2178784-ST-962.2.1.xml")
+
+def replace_loop(s, substitutions):
+    for variable in substitutions:
+        s = s.replace(variable, substitutions[variable])
+    return s
+
+def main():
+    repetitions = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    t = plumage.TSDRReq()
+    t.getXMLData(TESTFILE)
+    parsed_xml = t.XMLTree
+    substitutions = dict(t._substitutions)
+    descriptor = plumage._xslt_table["ST96"]
+    with open(descriptor.pathname, "rb") as f:
+        plain_transform = etree.XSLT(etree.XML(f.read()))
+    parameter_transform = descriptor.transform
+    assert not descriptor.needs_substitution
+
+    output = str(plain_transform(parsed_xml))
+    print("ST.96 sample: %d characters of transform output, %d placeholders"
+          % (len(output), len(substitutions)))
+    # same results all three ways
+    expected = replace_loop(output, substitutions)
+    assert t._perform_substitution(output) == expected
+    assert str(parameter_transform(parsed_xml, **t._transform_parameters())) == expected
+
+    def per_mark(statement):
+        seconds = min(timeit.repeat(statement, number=repetitions, repeat=3))
+        return seconds / repetitions * 1e6
+
+    print("substitution stage only (microseconds per mark):")
+    print("  replace loop: %8.1f" % per_mark(lambda: replace_loop(output, substitutions)))
+    print("  regex pass:   %8.1f" % per_mark(lambda: t._perform_substitution(output)))
+    print("  parameters:   %8.1f  (building the parameters)" % per_mark(t._transform_parameters))
+    print("transform plus substitution (microseconds per mark):")
+    print("  replace loop: %8.1f" % per_mark(
+        lambda: replace_loop(str(plain_transform(parsed_xml)), substitutions)))
+    print("  regex pass:   %8.1f" % per_mark(
+        lambda: t._perform_substitution(str(plain_transform(parsed_xml)))))
+    print("  parameters:   %8.1f" % per_mark(
+        lambda: str(parameter_transform(parsed_xml, **t._transform_parameters()))))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,61 @@
+'''
+Benchmark: the cost of stage timing (TSDRReq.setRecordTimings, and a
+process-wide TSDRTimingAggregator); then, the stage timings themselves.
+
+Not a unit test. Run from the tests directory:
+    $ python bench_timings.py [iterations]
+
+Each configuration processes the ST.66 sample (sn76044902.zip) from memory,
+unzip through TSDR map, many times (default 300): with timing off (the
+default), with timings recorded, and with an aggregator as well. The best
+of five runs of each is reported, per TSDRReq; then the aggregator's
+summary of every stage.
+'''
+
+from __future__ import print_function
+import os
+import sys
+import time
+
+from testing_context import plumage
+
+def run(filedata, iterations, record_timings):
+    t = plumage.TSDRReq()
+    t.setRecordTimings(record_timings)
+    start = time.time()
+    for _ in range(iterations):
+        t.getXMLDataFromBytes(filedata)
+        t.getCSVData()
+        t.getTSDRData()
+    return (time.time() - start) / iterations
+
+def best(filedata, iterations, record_timings, runs=5):
+    return min(run(filedata, iterations, record_timings) for _ in range(runs))
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 300
+    with open(os.path.join("testfiles", "sn76044902.zip"), "rb") as f:
+        filedata = f.read()
+    run(filedata, 10, False)    # warm up (compiles the XSLT)
+    off = best(filedata, iterations, False)
+    recorded = best(filedata, iterations, True)
+    aggregator = plumage.TSDRTimingAggregator()
+    plumage.setTimingAggregator(aggregator)
+    try:
+        aggregated = best(filedata, iterations, True)
+    finally:
+        plumage.setTimingAggregator(None)
+    print("Per TSDRReq, unzip through TSDR map (milliseconds; best of 5 runs of %d):" % iterations)
+    print("  timing off:            %7.3f" % (off * 1000))
+    print("  timings recorded:      %7.3f  (%+.1f%%)" % (recorded * 1000, 100 * (recorded / off - 1)))
+    print("  and aggregated:        %7.3f  (%+.1f%%)" % (aggregated * 1000, 100 * (aggregated / off - 1)))
+    print()
+    print("Stages (milliseconds):")
+    print("  %-10s %8s %8s %8s %8s %12s" % ("stage", "mean", "p50", "p90", "p99", "bytes/call"))
+    for stage, statistics in aggregator.summary().items():
+        print("  %-10s %8.3f %8.3f %8.3f %8.3f %12d" % (
+            stage, statistics["mean"] * 1000, statistics["p50"] * 1000, statistics["p90"] * 1000,
+            statistics["p99"] * 1000, statistics["bytes"] // statistics["count"]))
+
+if __name__ == '__main__':
+    main()
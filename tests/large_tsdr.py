@@ -0,0 +1,65 @@
+'''
+Synthetic large TSDR documents, for testing and measuring streaming (see
+TSDRReq.iterTSDRInfo): the supplied ST.96 test file, with its mark events
+and assignments repeated to any number.
+
+Not a test itself. Used by test_stream.py; or, from the command line, writes
+a document to a file:
+    $ python large_tsdr.py OUTFILE MARK-EVENTS [ASSIGNMENTS]
+'''
+
+from __future__ import print_function
+import os
+import re
+import sys
+
+SAMPLE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                      "testfiles", "rn2178784-ST-962.2.1.xml")
+
+_entry_number = re.compile(br"<ns2:MarkEventEntryNumber>\d+</ns2:MarkEventEntryNumber>")
+
+def _split(text, bag):
+    '''
+    (before, items, after): text split around the contents of the bag element,
+    and the items (as bytes) in it
+    '''
+    start_tag, end_tag = b"<ns2:" + bag + b"Bag>", b"</ns2:" + bag + b"Bag>"
+    start = text.index(start_tag) + len(start_tag)
+    end = text.index(end_tag)
+    item_end = b"</ns2:" + bag + b">"
+    items = [item + item_end for item in text[start:end].split(item_end)[:-1]]
+    return text[:start], items, text[end:]
+
+def writeLargeTSDR(f, mark_events, assignments=None):
+    '''
+    Write to f (a file object open for writing bytes) an ST.96 document with
+    mark_events mark events and assignments assignments (the sample's own
+    number, if None), cycling through the sample's; mark event entry numbers
+    run from 1 to mark_events.  Written a piece at a time, so that documents
+    of any size can be made.
+    '''
+    with open(SAMPLE, "rb") as sample:
+        text = sample.read()
+    head, events, rest = _split(text, b"MarkEvent")
+    middle, assignment_items, tail = _split(rest, b"Assignment")
+    if assignments is None:
+        assignments = len(assignment_items)
+    f.write(head)
+    for n in range(mark_events):
+        entry_number = ("<ns2:MarkEventEntryNumber>%d</ns2:MarkEventEntryNumber>" % (n+1)).encode("ascii")
+        f.write(_entry_number.sub(entry_number, events[n % len(events)]))
+    f.write(middle)
+    for n in range(assignments):
+        f.write(assignment_items[n % len(assignment_items)])
+    f.write(tail)
+
+def main():
+    if len(sys.argv) not in [3, 4]:
+        print(__doc__)
+        sys.exit(1)
+    assignments = int(sys.argv[3]) if len(sys.argv) == 4 else None
+    with open(sys.argv[1], "wb") as f:
+        writeLargeTSDR(f, int(sys.argv[2]), assignments)
+
+if __name__ == '__main__':
+    main()
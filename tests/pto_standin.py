@@ -0,0 +1,205 @@
+'''
+Local stand-in for the PTO TSDR server, used by tests that exercise the fetch
+path without network contact with the USPTO.
+
+Serves the files in testfiles/ at the PTO's URL paths:
+    /ts/cd/casestatus/{s|r}n<number>/content.zip -> sn76044902.zip
+    /ts/cd/casestatus/{s|r}n<number>/info.xml    -> rn2178784-ST-962.2.1.xml
+    /ts/cd/status66/{s|r}n<number>/info.xml      -> sn76044902.xml
+for any number, except that numbers beginning with "9999" get a 404.
+Responses carry an ETag (derived from the content) and a Last-Modified date,
+and conditional requests are answered 304 (not modified) when they match.
+'''
+
+import hashlib
+import os
+import re
+import socket
+import sys
+import threading
+import time
+PYTHON2 = sys.version_info.major == 2
+PYTHON3 = sys.version_info.major == 3
+
+if PYTHON2:
+    import BaseHTTPServer
+    import SocketServer
+    BaseHTTPRequestHandler = BaseHTTPServer.BaseHTTPRequestHandler
+    HTTPServer = BaseHTTPServer.HTTPServer
+    ThreadingMixIn = SocketServer.ThreadingMixIn
+if PYTHON3:
+    import http.server
+    import socketserver
+    BaseHTTPRequestHandler = http.server.BaseHTTPRequestHandler
+    HTTPServer = http.server.HTTPServer
+    ThreadingMixIn = socketserver.ThreadingMixIn
+
+TESTFILES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "testfiles")
+
+_files = {
+    ("casestatus", "content.zip") : "sn76044902.zip",
+    ("casestatus", "info.xml")    : "rn2178784-ST-962.2.1.xml",
+    ("status66", "info.xml")      : "sn76044902.xml",
+    }
+
+_path_pattern = re.compile(r"^/ts/cd/(casestatus|status66)/([sr])n(\d+)/(content\.zip|info\.xml)$")
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+class _StandInHandler(BaseHTTPRequestHandler):
+
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True  # headers and body are separate writes
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        standin = self.server.standin
+        with standin.lock:
+            standin.connections += 1
+            standin.open_sockets.add(self.connection)
+
+    def finish(self):
+        standin = self.server.standin
+        with standin.lock:
+            standin.open_sockets.discard(self.connection)
+        BaseHTTPRequestHandler.finish(self)
+
+    def do_GET(self):
+        standin = self.server.standin
+        with standin.lock:
+            standin.requests.append(self.path)
+            drop = standin.drop_next > 0
+            if drop:
+                standin.drop_next -= 1
+            failure = None
+            if not drop and standin.fail_next:
+                failure = standin.fail_next.pop(0)
+        if drop:
+            # simulate a keep-alive connection the server has already closed
+            self.close_connection = True
+            return
+        if standin.delay:
+            time.sleep(standin.delay)
+        if failure is not None:
+            code, headers = failure
+            self._respond(code, b"", headers)
+            return
+        match = _path_pattern.match(self.path)
+        if match is None:
+            self._respond(404, b"")
+            return
+        service, tmtype, number, filename = match.groups()
+        if number.startswith("9999"):
+            self._respond(404, b"")
+            return
+        body = standin.content[(service, filename)]
+        validators = {}
+        if standin.validators:
+            validators["ETag"] = '"%s"' % hashlib.sha1(body).hexdigest()[:16]
+            validators["Last-Modified"] = standin.last_modified
+            if_none_match = self.headers.get("If-None-Match")
+            if if_none_match is not None:
+                not_modified = if_none_match == validators["ETag"]
+            else:
+                not_modified = self.headers.get("If-Modified-Since") == standin.last_modified
+            if not_modified:
+                with standin.lock:
+                    standin.not_modified += 1
+                self._respond(304, None, validators)
+                return
+        self._respond(200, body, validators)
+
+    def _respond(self, code, body, extra_headers=None):
+        self.send_response(code)
+        for name, value in sorted((extra_headers or {}).items()):
+            self.send_header(name, value)
+        if body is None:    # 304: no body
+            self.end_headers()
+            return
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+class PTOStandIn(object):
+    '''
+    Threaded local HTTP server standing in for tsdrapi.uspto.gov
+
+      delay: seconds to wait before answering each request (simulated network latency)
+      drop_next: number of upcoming requests to answer by closing the connection
+      fail_next: list of (status, headers) responses with which to answer upcoming
+        requests, in order (e.g., [(503, {}), (429, {"Retry-After" : "1"})])
+      requests: paths requested so far, in order received
+      connections: number of client connections accepted so far
+      validators: True (default) to send ETag and Last-Modified, and honor
+        conditional requests; False to send neither
+      last_modified: Last-Modified date sent
+      not_modified: number of 304 (not modified) responses sent so far
+    Changing content (keyed by (service, filename)) changes its ETag.
+    If ssl_context (a server-side SSL context) is given, serves HTTPS instead of HTTP.
+    '''
+
+    def __init__(self, delay=0, ssl_context=None):
+        self.delay = delay
+        self.drop_next = 0
+        self.fail_next = []
+        self.requests = []
+        self.connections = 0
+        self.validators = True
+        self.last_modified = "Thu, 22 Mar 2018 00:00:00 GMT"
+        self.not_modified = 0
+        self.open_sockets = set()
+        self.lock = threading.Lock()
+        self.content = {}
+        for key, filename in _files.items():
+            with open(os.path.join(TESTFILES_DIR, filename), "rb") as f:
+                self.content[key] = f.read()
+        self._server = _ThreadingHTTPServer(("127.0.0.1", 0), _StandInHandler)
+        self._server.standin = self
+        self.scheme = "http"
+        if ssl_context is not None:
+            self._server.socket = ssl_context.wrap_socket(self._server.socket, server_side=True)
+            self.scheme = "https"
+        self._thread = None
+
+    @property
+    def base_url(self):
+        host, port = self._server.server_address[:2]
+        return "%s://%s:%s" % (self.scheme, host, port)
+
+    def close_idle_connections(self):
+        '''
+        Close every open client connection from the server side, as a server
+        does when its keep-alive timeout expires
+        '''
+        with self.lock:
+            sockets = list(self.open_sockets)
+        for sock in sockets:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+
+    def url_templates(self):
+        '''
+        PTO URL templates (in the form of plumage._pto_url_templates) pointing at this server
+        '''
+        return {
+            "ST66" : self.base_url + "/ts/cd/status66/%sn%s/info.xml",
+            "ST96" : self.base_url + "/ts/cd/casestatus/%sn%s/info.xml",
+            "zip"  : self.base_url + "/ts/cd/casestatus/%sn%s/content.zip"
+            }
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
@@ -0,0 +1,207 @@
+import asyncio
+import shutil
+import socket
+import tempfile
+import time
+import unittest
+
+from testing_context import plumage
+from Plumage import aio
+from pto_standin import PTOStandIn
+
+class TestUM(unittest.TestCase):
+
+    # Group AS: asyncio interface (against a local stand-in for the PTO server)
+
+    def setUp(self):
+        self.standin = PTOStandIn().start()
+        self.saved_url_templates = plumage._pto_url_templates
+        plumage._pto_url_templates = self.standin.url_templates()
+        self.tempdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        plumage._pto_url_templates = self.saved_url_templates
+        self.standin.stop()
+        shutil.rmtree(self.tempdir)
+
+    def _collect(self, async_iterable):
+        async def collect():
+            return [item async for item in async_iterable]
+        return asyncio.run(collect())
+
+    def test_AS001_get_tsdr_info_async(self):
+        t = plumage.TSDRReq()
+        result = asyncio.run(t.getTSDRInfoAsync("76044902", "s"))
+        self.assertTrue(result is t)
+        self.assertTrue(t.XMLDataIsValid)
+        self.assertTrue(t.CSVDataIsValid)
+        self.assertTrue(t.TSDRData.TSDRMapIsValid)
+        self.assertEqual(t.TSDRData.TSDRSingle["ApplicationNumber"], "76044902")
+        self.assertEqual(t.TSDRData.TSDRSingle["DiagnosticInfoXMLSource"],
+                         plumage._pto_url_templates["zip"] % ("s", "76044902"))
+
+    def test_AS002_matches_synchronous_result(self):
+        t_sync = plumage.TSDRReq()
+        t_sync.setPTOFormat("ST96")
+        t_sync.getTSDRInfo("2178784", "r")
+        t_async = plumage.TSDRReq()
+        t_async.setPTOFormat("ST96")
+        asyncio.run(t_async.getTSDRInfoAsync("2178784", "r"))
+        self.assertEqual(t_async.XMLData, t_sync.XMLData)
+        self.assertEqual(t_async.TSDRData.TSDRMulti, t_sync.TSDRData.TSDRMulti)
+
+    def test_AS003_not_found_and_bad_parameters(self):
+        t = plumage.TSDRReq()
+        asyncio.run(t.getTSDRInfoAsync("99999999", "s"))
+        self.assertFalse(t.XMLDataIsValid)
+        self.assertEqual(t.ErrorCode, "Fetch-404")
+        self.assertRaises(ValueError, asyncio.run, t.getTSDRInfoAsync("1234", "s"))
+
+    def test_AS004_event_loop_not_blocked(self):
+        '''
+        Other tasks keep running while a fetch waits on the network
+        '''
+        self.standin.delay = 0.3
+        async def main():
+            ticks = []
+            async def ticker():
+                while True:
+                    ticks.append(time.time())
+                    await asyncio.sleep(0.02)
+            ticking = asyncio.ensure_future(ticker())
+            t = plumage.TSDRReq()
+            await t.getTSDRInfoAsync("76044902", "s")
+            ticking.cancel()
+            return t, ticks
+        t, ticks = asyncio.run(main())
+        self.assertTrue(t.TSDRData.TSDRMapIsValid)
+        self.assertTrue(len(ticks) >= 5, len(ticks))
+
+    def test_AS005_fetch_many(self):
+        self.standin.delay = 0.2
+        identifiers = [("%08d" % (76000000 + n), "s") for n in range(12)]
+        identifiers.append(("99999999", "s"))
+        identifiers.append(("123", "s"))
+        start = time.time()
+        results = self._collect(aio.fetchMany(identifiers, concurrency=16))
+        elapsed = time.time() - start
+        self.assertEqual(len(results), len(identifiers))
+        valid = [t for t in results if t.TSDRData.TSDRMapIsValid]
+        self.assertEqual(len(valid), 12)
+        error_codes = sorted(t.ErrorCode for t in results if not t.TSDRData.TSDRMapIsValid)
+        self.assertEqual(error_codes, ["Batch-Exception", "Fetch-404"])
+        # one at a time would take 14 * 0.2 = 2.8 seconds
+        self.assertTrue(elapsed < 1.4, elapsed)
+
+    def test_AS006_fetch_many_concurrency_limit(self):
+        self.standin.delay = 0.1
+        identifiers = [("%08d" % (76000000 + n), "s") for n in range(8)]
+        start = time.time()
+        results = self._collect(aio.fetchMany(identifiers, concurrency=2))
+        elapsed = time.time() - start
+        self.assertTrue(all(t.TSDRData.TSDRMapIsValid for t in results))
+        # 8 fetches, 2 at a time: at least 4 rounds of 0.1 seconds
+        self.assertTrue(elapsed >= 0.4, elapsed)
+
+    def test_AS007_chunked_body(self):
+        async def read_chunked():
+            reader = asyncio.StreamReader()
+            reader.feed_data(b"5;ext=1\r\nhello\r\n7\r\n, world\r\n0\r\nX-Trailer: 1\r\n\r\n")
+            reader.feed_eof()
+            return await aio._read_body(reader, {"transfer-encoding" : "chunked"})
+        self.assertEqual(asyncio.run(read_chunked()), (b"hello, world", True))
+
+    def test_AS008_fetch_many_response_cache(self):
+        cache = plumage.TSDRResponseCache(self.tempdir, ttl=0.2)
+        identifiers = [("76044902", "s"), ("76044903", "s")]
+        results = self._collect(aio.fetchMany(identifiers, cache=cache))
+        self.assertTrue(all(t.TSDRData.TSDRMapIsValid for t in results))
+        self.assertEqual(cache.full_fetches, 2)
+        # fresh: served from the cache
+        results = self._collect(aio.fetchMany(identifiers, cache=cache))
+        self.assertTrue(all(t.TSDRData.TSDRMapIsValid for t in results))
+        self.assertEqual(len(self.standin.requests), 2)
+        # expired: revalidated (304)
+        time.sleep(0.3)
+        results = self._collect(aio.fetchMany(identifiers, cache=cache))
+        self.assertTrue(all(t.TSDRData.TSDRMapIsValid for t in results))
+        self.assertEqual(self.standin.not_modified, 2)
+        self.assertEqual((cache.full_fetches, cache.revalidations), (2, 2))
+
+    def test_AS009_closed_loops_dropped_from_pool(self):
+        '''
+        Idle connections of an event loop that has closed are dropped from
+        the pool, rather than kept (with the loop) until they expire
+        '''
+        pool = plumage.TSDRConnectionPool()
+        t = plumage.TSDRReq()
+        t.setConnectionPool(pool)
+        for _ in range(2):
+            asyncio.run(t.getTSDRInfoAsync("76044902", "s"))
+            self.assertTrue(t.TSDRData.TSDRMapIsValid)
+            self.assertEqual(len(pool._idle), 1)
+        t.getTSDRInfo("76044902", "s")
+        self.assertEqual([key[0] for key in pool._idle], ["http.client"])
+        pool.close()
+
+    def test_AS010_stalled_server_times_out(self):
+        '''
+        A server that accepts the connection but never answers: the fetch
+        gives up after the pool's timeout (or the default, without a pool),
+        rather than waiting forever
+        '''
+        silent = socket.socket()
+        silent.bind(("127.0.0.1", 0))
+        silent.listen(8)     # connections complete, but are never accepted or answered
+        try:
+            plumage._pto_url_templates = {"zip" : "http://127.0.0.1:%s/%%sn%%s/content.zip"
+                                          % silent.getsockname()[1]}
+            for pool in [plumage.TSDRConnectionPool(timeout=0.3), None]:
+                t = plumage.TSDRReq()
+                t.setConnectionPool(pool)
+                saved_timeout = aio._DEFAULT_TIMEOUT
+                aio._DEFAULT_TIMEOUT = 0.3
+                try:
+                    start = time.time()
+                    self.assertRaises(asyncio.TimeoutError, asyncio.run,
+                                      t.getTSDRInfoAsync("76044902", "s"))
+                finally:
+                    aio._DEFAULT_TIMEOUT = saved_timeout
+                self.assertTrue(time.time() - start < 1, time.time() - start)
+            # nor does a stalled entry hold up fetchMany
+            results = self._collect(aio.fetchMany([("76044902", "s")] * 3, concurrency=1,
+                                                  retry_policy=plumage.TSDRRetryPolicy(deadline=0.2)))
+            self.assertEqual([t.ErrorCode for t in results], ["Batch-Exception"] * 3)
+        finally:
+            silent.close()
+
+    def test_AS011_response_cache_off_event_loop(self):
+        '''
+        Response cache reads and writes (file I/O) do not block other tasks
+        '''
+        class SlowCache(plumage.TSDRResponseCache):
+            def get(self, *arguments, **keywords):
+                time.sleep(0.2)
+                return plumage.TSDRResponseCache.get(self, *arguments, **keywords)
+            def put(self, *arguments, **keywords):
+                time.sleep(0.2)
+                return plumage.TSDRResponseCache.put(self, *arguments, **keywords)
+        ticks = []
+        async def main():
+            async def ticker():
+                while True:
+                    ticks.append(time.time())
+                    await asyncio.sleep(0.02)
+            task = asyncio.ensure_future(ticker())
+            t = plumage.TSDRReq()
+            t.setCache(SlowCache(self.tempdir))
+            await t.getTSDRInfoAsync("76044902", "s")
+            task.cancel()
+            return t
+        t = asyncio.run(main())
+        self.assertTrue(t.TSDRData.TSDRMapIsValid)
+        # no gap of anywhere near the 0.2 seconds each cache access takes
+        self.assertTrue(max(b - a for a, b in zip(ticks, ticks[1:])) < 0.15, ticks)
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
@@ -0,0 +1,241 @@
+import json
+import os
+import shutil
+import sys
+import tarfile
+import tempfile
+import time
+import unittest
+import zipfile
+PYTHON2 = sys.version_info.major == 2
+PYTHON3 = sys.version_info.major == 3
+
+from testing_context import plumage
+from Plumage import batch
+from pto_standin import PTOStandIn
+
+class TestUM(unittest.TestCase):
+
+    # Group BA: Batch retrieval (against a local stand-in for the PTO server),
+    #   and offline bulk reprocessing of archives (BA010 on)
+
+    TESTFILES_DIR = "testfiles"
+    ARCHIVE_TESTFILES = ["sn76044902.zip", "sn76044902.xml", "rn2178784-ST-962.2.1.xml"]
+
+    def setUp(self):
+        self.standin = PTOStandIn().start()
+        self.saved_url_templates = plumage._pto_url_templates
+        plumage._pto_url_templates = self.standin.url_templates()
+
+    def tearDown(self):
+        plumage._pto_url_templates = self.saved_url_templates
+        self.standin.stop()
+
+    def _serial_numbers(self, count):
+        return [("%08d" % (76000000 + n), "s") for n in range(count)]
+
+    def test_BA001_fetch_many_in_order(self):
+        identifiers = self._serial_numbers(20)
+        b = batch.TSDRBatch(fetch_workers=4, process_workers=2)
+        results = list(b.fetchMany(identifiers))
+        self.assertEqual(len(results), len(identifiers))
+        for (number, tmtype), t in zip(identifiers, results):
+            self.assertTrue(t.TSDRData.TSDRMapIsValid)
+            self.assertEqual(t.TSDRData.TSDRSingle["ApplicationNumber"], "76044902")
+            self.assertTrue(t.TSDRData.TSDRSingle["DiagnosticInfoXMLSource"].endswith(
+                "/casestatus/sn%s/content.zip" % number))
+
+    def test_BA002_fetch_many_completion_order(self):
+        identifiers = self._serial_numbers(20)
+        b = batch.TSDRBatch(fetch_workers=4, process_workers=2)
+        results = list(b.fetchMany(identifiers, ordered=False))
+        self.assertEqual(len(results), len(identifiers))
+        sources = sorted(t.TSDRData.TSDRSingle["DiagnosticInfoXMLSource"] for t in results)
+        expected = sorted(plumage._pto_url_templates["zip"] % (tmtype, number)
+                          for number, tmtype in identifiers)
+        self.assertEqual(sources, expected)
+
+    def test_BA003_errors_reported_per_entry(self):
+        identifiers = [("76044902", "s"), ("99999999", "s"), ("1234", "s"), ("2824281", "r")]
+        b = batch.TSDRBatch(fetch_workers=2, process_workers=1)
+        results = list(b.fetchMany(identifiers))
+        self.assertTrue(results[0].TSDRData.TSDRMapIsValid)
+        self.assertFalse(results[1].XMLDataIsValid)
+        self.assertEqual(results[1].ErrorCode, "Fetch-404")
+        self.assertFalse(results[2].XMLDataIsValid)
+        self.assertEqual(results[2].ErrorCode, "Batch-Exception")
+        self.assertTrue("ValueError" in results[2].ErrorMessage)
+        self.assertTrue(results[3].TSDRData.TSDRMapIsValid)
+
+    def test_BA004_pto_format(self):
+        b = batch.TSDRBatch(fetch_workers=2, process_workers=1, PTOFormat="ST96")
+        results = list(b.fetchMany([("2178784", "r")]))
+        self.assertTrue(results[0].TSDRData.TSDRMapIsValid)
+        self.assertEqual(results[0].TSDRData.TSDRSingle["DiagnosticInfoXSLTFormat"], "ST.96")
+        self.assertRaises(ValueError, batch.TSDRBatch, PTOFormat="ST99")
+
+    def test_BA005_fetches_overlap(self):
+        '''
+        With simulated latency, wall-clock time scales with concurrency, not count
+        '''
+        self.standin.delay = 0.2
+        identifiers = self._serial_numbers(16)
+        b = batch.TSDRBatch(fetch_workers=16, process_workers=2)
+        start = time.time()
+        results = list(b.fetchMany(identifiers))
+        elapsed = time.time() - start
+        self.assertTrue(all(t.TSDRData.TSDRMapIsValid for t in results))
+        # one at a time would take 16 * 0.2 = 3.2 seconds
+        self.assertTrue(elapsed < 1.6, elapsed)
+
+    def test_BA006_bounded_window(self):
+        '''
+        Identifiers are consumed lazily, no more than max_pending ahead of the caller
+        '''
+        consumed = []
+        def identifiers():
+            for identifier in self._serial_numbers(30):
+                consumed.append(identifier)
+                yield identifier
+        b = batch.TSDRBatch(fetch_workers=2, process_workers=1)
+        results = b.fetchMany(identifiers(), max_pending=5)
+        next(results)
+        self.assertTrue(len(consumed) <= 6, len(consumed))
+        results.close()
+
+    def test_BA007_engine(self):
+        b = batch.TSDRBatch(fetch_workers=2, process_workers=1, PTOFormat="ST96")
+        xslt_results = list(b.fetchMany([("2178784", "r")]))
+        b = batch.TSDRBatch(fetch_workers=2, process_workers=1, PTOFormat="ST96", engine="XPath")
+        xpath_results = list(b.fetchMany([("2178784", "r")]))
+        self.assertTrue(xpath_results[0].TSDRData.TSDRMapIsValid)
+        self.assertEqual(xpath_results[0].Engine, "XPath")
+        self.assertEqual(xpath_results[0].TSDRData.TSDRMulti, xslt_results[0].TSDRData.TSDRMulti)
+        self.assertRaises(ValueError, batch.TSDRBatch, engine="XQuery")
+
+    def test_BA008_zip_data_not_retained(self):
+        b = batch.TSDRBatch(fetch_workers=2, process_workers=1, retain_zip_data=False)
+        results = list(b.fetchMany(self._serial_numbers(2)))
+        self.assertTrue(all(t.TSDRData.TSDRMapIsValid for t in results))
+        self.assertTrue(all(t.ZipData is None and t.ImageFull is None for t in results))
+        self.assertRaises(ValueError, batch.TSDRBatch, retain_zip_data=None)
+
+    def test_BA009_lean_retention(self):
+        b = batch.TSDRBatch(fetch_workers=2, process_workers=1, retention="lean")
+        results = list(b.fetchMany(self._serial_numbers(2)))
+        self.assertTrue(all(t.TSDRData.TSDRMapIsValid for t in results))
+        self.assertTrue(all(t.XMLData is None and t.CSVData is None for t in results))
+        self.assertTrue(all(t.PayloadDigest is not None for t in results))
+        self.assertRaises(ValueError, batch.TSDRBatch, retention="thin")
+
+    def test_BA013_compact_maps(self):
+        b = batch.TSDRBatch(fetch_workers=2, process_workers=1, compact_maps=True)
+        results = list(b.fetchMany(self._serial_numbers(2)))
+        self.assertTrue(all(t.TSDRData.TSDRMapIsValid for t in results))
+        self.assertTrue(all(isinstance(t.TSDRData.TSDRSingle, plumage.TSDRRecord) for t in results))
+        self.assertEqual(results[0].TSDRData.TSDRSingle["ApplicationNumber"], "76044902")
+        self.assertRaises(ValueError, batch.TSDRBatch, compact_maps="yes")
+
+    def _archive_maps(self, testfile):
+        t = plumage.TSDRReq()
+        t.getTSDRInfo(os.path.join(self.TESTFILES_DIR, testfile))
+        return t.TSDRData.TSDRMulti
+
+    def _make_bundles(self, tempdir, copies):
+        '''
+        A directory, a tar bundle and a zip bundle, each holding copies copies
+        of each archive test file; returns the three, and the test files in order
+        '''
+        directory = os.path.join(tempdir, "downloads")
+        expected = []
+        for n in range(copies):
+            os.makedirs(os.path.join(directory, "%02d" % n))
+            for testfile in self.ARCHIVE_TESTFILES:
+                shutil.copy(os.path.join(self.TESTFILES_DIR, testfile),
+                            os.path.join(directory, "%02d" % n))
+            expected.extend(sorted(self.ARCHIVE_TESTFILES))
+        tar_bundle = os.path.join(tempdir, "downloads.tar.gz")
+        zip_bundle = os.path.join(tempdir, "downloads.zip")
+        with tarfile.open(tar_bundle, "w:gz") as tar:
+            tar.add(directory, arcname="downloads")
+        with zipfile.ZipFile(zip_bundle, "w") as bundle:
+            for n in range(copies):
+                for testfile in sorted(self.ARCHIVE_TESTFILES):
+                    bundle.write(os.path.join(directory, "%02d" % n, testfile),
+                                 "%02d/%s" % (n, testfile))
+        return (directory, tar_bundle, zip_bundle), expected
+
+    def test_BA010_reprocess_archives(self):
+        tempdir = tempfile.mkdtemp()
+        try:
+            sources, expected = self._make_bundles(tempdir, 4)
+            maps = dict((testfile, self._archive_maps(testfile)) for testfile in self.ARCHIVE_TESTFILES)
+            r = batch.TSDRReprocessor(workers=2)
+            for source in sources:
+                chunks = list(r.reprocessMany(source, chunk_size=5))
+                self.assertEqual([len(chunk) for chunk in chunks], [5, 5, 2])
+                results = [result for chunk in chunks for result in chunk]
+                self.assertEqual([os.path.basename(result.source) for result in results], expected)
+                for testfile, result in zip(expected, results):
+                    self.assertTrue(result.TSDRMapIsValid, result.ErrorMessage)
+                    self.assertEqual(result.TSDRMulti, maps[testfile])
+                    self.assertEqual(result.TSDRSingle["DiagnosticInfoXMLSource"], result.source)
+                    self.assertEqual(len(result.PayloadDigest), 64)
+            self.assertTrue(results[0].source.startswith(sources[2] + "!"))
+            # in completion order, projected, on the XPath engine
+            r = batch.TSDRReprocessor(workers=2, engine="XPath", projection=["ApplicationNumber"])
+            results = [result for chunk in r.reprocessMany(sources[1], chunk_size=2, ordered=False)
+                       for result in chunk]
+            self.assertEqual(sorted(result.TSDRSingle["ApplicationNumber"] for result in results),
+                             ["74631225"] * 4 + ["76044902"] * 8)
+        finally:
+            shutil.rmtree(tempdir)
+
+    def test_BA011_reprocess_errors_and_sink(self):
+        tempdir = tempfile.mkdtemp()
+        try:
+            directory = os.path.join(tempdir, "downloads")
+            os.makedirs(directory)
+            for testfile in ["rn2178784-ST-961_D3.xml", "sn76044902.zip"]:
+                shutil.copy(os.path.join(self.TESTFILES_DIR, testfile), directory)
+            with open(os.path.join(directory, "truncated.xml"), "wb") as f:
+                f.write(b"<?xml version='1.0'?><Transaction>")
+            with open(os.path.join(directory, "notes.txt"), "wb") as f:
+                f.write(b"not TSDR data")
+            output = os.path.join(tempdir, "maps.jsonl")
+            r = batch.TSDRReprocessor(workers=1)
+            with open(output, "w") as f:
+                count = r.reprocessTo(directory, batch.TSDRJSONLinesSink(f), chunk_size=2)
+            self.assertEqual(count, 3)
+            with open(output) as f:
+                lines = [json.loads(line) for line in f]
+            self.assertEqual([line["ErrorCode"] for line in lines],
+                             ["CSV-UnsupportedXML", None, "XML-NoValidXML"])
+            self.assertTrue(lines[1]["TSDRMapIsValid"])
+            self.assertEqual(lines[1]["TSDRSingle"]["ApplicationNumber"], "76044902")
+            self.assertEqual(lines[2]["TSDRMulti"], None)
+            self.assertRaises(ValueError, list, r.reprocessMany(os.path.join(directory, "notes.txt")))
+            self.assertRaises(ValueError, list, r.reprocessMany(directory, chunk_size=0))
+            self.assertRaises(ValueError, batch.TSDRReprocessor, workers=0)
+            self.assertRaises(ValueError, batch.TSDRReprocessor, engine="XQuery")
+        finally:
+            shutil.rmtree(tempdir)
+
+    def test_BA012_reprocess_worker_request_reused(self):
+        '''
+        A worker keeps one TSDRReq (and its compiled transforms) across chunks
+        '''
+        settings = (None, "XSLT", None)
+        chunk = [(os.path.join(self.TESTFILES_DIR, testfile), os.path.join(self.TESTFILES_DIR, testfile), None)
+                 for testfile in self.ARCHIVE_TESTFILES]
+        first = batch._reprocessChunk(settings, chunk)
+        t = batch._worker_request
+        self.assertTrue(all(plumage._xslt_table[f]._compiled is not None for f in plumage._xslt_table))
+        second = batch._reprocessChunk(settings, chunk)
+        self.assertTrue(batch._worker_request is t)
+        self.assertEqual([result.TSDRMulti for result in first], [result.TSDRMulti for result in second])
+        batch._reprocessChunk((None, "XPath", None), chunk)
+        self.assertFalse(batch._worker_request is t)
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
@@ -0,0 +1,156 @@
+import collections
+import datetime
+import os
+import sys
+import unittest
+PYTHON2 = sys.version_info.major == 2
+PYTHON3 = sys.version_info.major == 3
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from testing_context import plumage
+from Plumage import batch
+from Plumage import columns
+
+TESTFILE_DIR = "testfiles"
+ST66_TESTFILE = os.path.join(TESTFILE_DIR, "sn76044902.zip")
+ST96_TESTFILE = os.path.join(TESTFILE_DIR, "rn2178784-ST-962.2.1.xml")
+ST96_1_D3_TESTFILE = os.path.join(TESTFILE_DIR, "rn2178784-ST-961_D3.xml")
+
+@unittest.skipIf(numpy is None, "needs NumPy")
+class TestUM(unittest.TestCase):
+
+    # Group CO: Columnar export (NumPy)
+
+    def _requests(self, testfiles):
+        requests = []
+        for testfile in testfiles:
+            t = plumage.TSDRReq()
+            t.getTSDRInfo(testfile)
+            requests.append(t)
+        return requests
+
+    def _portfolio(self, count):
+        '''
+        count TSDR maps: the ST.66 sample's, with application dates one week
+        apart, and every third one registered on the Supplemental Register
+        '''
+        t = plumage.TSDRReq()
+        t.getTSDRInfo(ST66_TESTFILE)
+        start = datetime.date(2000, 1, 3)
+        portfolio = []
+        for n in range(count):
+            tsdrmap = t.TSDRData.copy()
+            filed = start + datetime.timedelta(weeks=n)
+            tsdrmap.TSDRSingle["ApplicationNumber"] = "%08d" % (76000000 + n)
+            tsdrmap.TSDRSingle["ApplicationDate"] = filed.isoformat() + "-05:00"
+            if n % 3 == 0:
+                tsdrmap.TSDRSingle["RegisterCategory"] = "Supplemental"
+            portfolio.append(tsdrmap)
+        return portfolio
+
+    def test_CO001_columns(self):
+        c = columns.TSDRColumns()
+        self.assertEqual(c.addMany(self._requests([ST66_TESTFILE, ST96_TESTFILE, ST96_1_D3_TESTFILE])), 2)
+        self.assertEqual(len(c), 2)
+        filed = c.column("ApplicationDate")
+        self.assertEqual(filed.dtype, numpy.dtype("datetime64[D]"))
+        self.assertEqual(filed.tolist(), [datetime.date(2000, 5, 9), datetime.date(1995, 2, 7)])
+        self.assertEqual(c.column("ApplicationDateTruncated").tolist(), filed.tolist())
+        # an empty date (the ST.66 sample was never renewed) is NaT
+        renewed = c.column("RenewalDate")
+        self.assertTrue(numpy.isnat(renewed[0]))
+        self.assertEqual(renewed[1], numpy.datetime64("2008-08-04"))
+        # a field only one map has
+        self.assertEqual(c.column("StaffName").tolist(), ["", None])
+        self.assertEqual(c.column("ApplicationNumber").tolist(), ["76044902", "74631225"])
+        # encoded fields
+        codes, categories = c.codes("DiagnosticInfoXSLTFormat")
+        self.assertEqual(codes.tolist(), [0, 1])
+        self.assertEqual(categories.tolist(), ["ST.66", "ST.96"])
+        self.assertEqual(c.column("DiagnosticInfoXSLTFormat").tolist(), ["ST.66", "ST.96"])
+        self.assertEqual(c.valueCounts("RegisterCategory"), {"Principal" : 2})
+        self.assertRaises(KeyError, c.column, "NoSuchField")
+        self.assertRaises(KeyError, c.codes, "ApplicationNumber")
+        self.assertEqual(sorted(c.columns()), c.names())
+
+    def test_CO002_selected_fields(self):
+        c = columns.TSDRColumns(fields=["ApplicationNumber", "RegistrationDate", "RegisterCategory"],
+                                encoded=["RegisterCategory"])
+        c.addMany(self._requests([ST66_TESTFILE, ST96_TESTFILE]))
+        self.assertEqual(c.names(), ["ApplicationNumber", "RegisterCategory", "RegistrationDate"])
+        # a map without an encoded field
+        tsdrmap = plumage.TSDRMap()
+        tsdrmap.TSDRSingle, tsdrmap.TSDRMulti, tsdrmap.TSDRMapIsValid = {"ApplicationNumber" : "1"}, {}, True
+        c.add(tsdrmap)
+        self.assertEqual(c.codes("RegisterCategory")[0].tolist(), [0, 0, -1])
+        self.assertEqual(c.column("RegisterCategory").tolist(), ["Principal", "Principal", None])
+        self.assertTrue(numpy.isnat(c.column("RegistrationDate")[2]))
+        self.assertEqual(c.valueCounts("RegisterCategory"), {"Principal" : 2})
+
+    def test_CO003_portfolio_aggregations(self):
+        '''
+        Vectorized aggregations over a portfolio give what a loop over the maps does
+        '''
+        portfolio = self._portfolio(500)
+        c = columns.TSDRColumns()
+        c.addMany(portfolio)
+        filed = c.column("ApplicationDate")
+        # filing-date histogram, by year
+        years = filed.astype("datetime64[Y]").astype(int) + 1970
+        by_year = dict(zip(*[array.tolist() for array in numpy.unique(years, return_counts=True)]))
+        expected = collections.Counter(int(tsdrmap.TSDRSingle["ApplicationDate"][:4])
+                                       for tsdrmap in portfolio)
+        self.assertEqual(by_year, dict(expected))
+        # filed within a window
+        window = (filed >= numpy.datetime64("2003-01-01")) & (filed < numpy.datetime64("2004-01-01"))
+        self.assertEqual(int(window.sum()), expected[2003])
+        # status breakdown
+        self.assertEqual(c.valueCounts("RegisterCategory"),
+                         dict(collections.Counter(tsdrmap.TSDRSingle["RegisterCategory"]
+                                                  for tsdrmap in portfolio)))
+
+    def test_CO004_sink_and_compact_maps(self):
+        c = columns.TSDRColumns()
+        r = batch.TSDRReprocessor(workers=1)
+        self.assertEqual(r.reprocessTo(TESTFILE_DIR, c), 4)
+        self.assertEqual(sorted(c.column("ApplicationNumber").tolist()),
+                         ["74631225", "76044902", "76044902"])
+        t = plumage.TSDRReq()
+        t.setCompactMaps(True)
+        t.getTSDRInfo(ST66_TESTFILE)
+        c = columns.TSDRColumns()
+        c.add(t)
+        self.assertEqual(c.column("RegistrationDate").tolist(), [datetime.date(2004, 3, 23)])
+
+    def test_CO005_numpy_required(self):
+        saved_numpy = columns.numpy
+        columns.numpy = None
+        try:
+            self.assertRaises(ImportError, columns.TSDRColumns)
+        finally:
+            columns.numpy = saved_numpy
+
+    def test_CO006_malformed_dates(self):
+        c = columns.TSDRColumns(fields=["ApplicationNumber", "FooDate", "BarDateTruncated"])
+        for number, foo, bar in [("1", "2001-02-03-05:00", "N/A"), ("2", "N/A", "2004-05-06"),
+                                 ("3", "", "2004-13-45")]:
+            tsdrmap = plumage.TSDRMap()
+            tsdrmap.TSDRSingle = {"ApplicationNumber" : number, "FooDate" : foo,
+                                  "BarDateTruncated" : bar}
+            tsdrmap.TSDRMulti, tsdrmap.TSDRMapIsValid = {}, True
+            c.add(tsdrmap)
+        foo = c.column("FooDate")
+        self.assertEqual(foo[0], numpy.datetime64("2001-02-03"))
+        self.assertTrue(numpy.isnat(foo[1]) and numpy.isnat(foo[2]))
+        bar = c.column("BarDateTruncated")
+        self.assertEqual(bar.dtype, numpy.dtype("datetime64[D]"))
+        self.assertEqual(bar[1], numpy.datetime64("2004-05-06"))
+        self.assertTrue(numpy.isnat(bar[0]) and numpy.isnat(bar[2]))
+        self.assertEqual(len(c.columns()), 3)
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
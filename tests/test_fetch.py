@@ -0,0 +1,774 @@
+import email.utils
+import multiprocessing
+import os
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import time
+import unittest
+PYTHON2 = sys.version_info.major == 2
+PYTHON3 = sys.version_info.major == 3
+
+from testing_context import plumage
+from pto_standin import PTOStandIn
+
+class TestUM(unittest.TestCase):
+
+    # Fetch layer, tested against a local stand-in for the PTO server
+    # Group P: Connection pool
+    # Group Q: Response cache
+    # Group M: TSDR map cache
+    # Group R: Conditional revalidation of cached responses
+    # Group T: Retries
+    # Group L: Rate limiter
+
+    def setUp(self):
+        self.standin = PTOStandIn().start()
+        self.saved_url_templates = plumage._pto_url_templates
+        plumage._pto_url_templates = self.standin.url_templates()
+        self.tempdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        plumage.setSharedRateLimiter(None)
+        plumage._pto_url_templates = self.saved_url_templates
+        self.standin.stop()
+        shutil.rmtree(self.tempdir)
+
+    # Group P
+    # Connection pool
+
+    def test_P001_connection_reused(self):
+        pool = plumage.TSDRConnectionPool()
+        t = plumage.TSDRReq()
+        t.setConnectionPool(pool)
+        for _ in range(5):
+            t.getTSDRInfo("76044902", "s")
+            self.assertTrue(t.TSDRData.TSDRMapIsValid)
+        self.assertEqual(self.standin.connections, 1)
+        self.assertEqual(pool.connections_opened, 1)
+        self.assertEqual(pool.connections_reused, 4)
+        pool.close()
+
+    def test_P002_no_pool(self):
+        t = plumage.TSDRReq()
+        t.setConnectionPool(None)
+        for _ in range(3):
+            t.getTSDRInfo("76044902", "s")
+            self.assertTrue(t.TSDRData.TSDRMapIsValid)
+        self.assertEqual(self.standin.connections, 3)
+
+    def test_P003_shared_pool_is_default(self):
+        t1 = plumage.TSDRReq()
+        t2 = plumage.TSDRReq()
+        self.assertTrue(t1.ConnectionPool is plumage.sharedConnectionPool())
+        self.assertTrue(t2.ConnectionPool is t1.ConnectionPool)
+        t1.setConnectionPool(None)
+        t1.reset()
+        self.assertTrue(t1.ConnectionPool is plumage.sharedConnectionPool())
+
+    def test_P004_stale_connection_detected_before_reuse(self):
+        pool = plumage.TSDRConnectionPool()
+        t = plumage.TSDRReq()
+        t.setConnectionPool(pool)
+        t.getTSDRInfo("76044902", "s")
+        self.standin.close_idle_connections()
+        time.sleep(0.1)
+        t.getTSDRInfo("76044902", "s")
+        self.assertTrue(t.TSDRData.TSDRMapIsValid)
+        self.assertEqual(pool.connections_opened, 2)
+        self.assertEqual(pool.stale_connections, 1)
+        pool.close()
+
+    def test_P005_stale_connection_retried(self):
+        '''
+        Connection closed by the server only once the request arrives: retried on a new connection
+        '''
+        pool = plumage.TSDRConnectionPool()
+        t = plumage.TSDRReq()
+        t.setConnectionPool(pool)
+        t.getTSDRInfo("76044902", "s")
+        self.standin.drop_next = 1
+        t.getTSDRInfo("76044902", "s")
+        self.assertTrue(t.TSDRData.TSDRMapIsValid)
+        self.assertEqual(pool.stale_connections, 1)
+        self.assertEqual(len(self.standin.requests), 3)
+        pool.close()
+
+    def test_P006_fresh_connection_failure_not_retried(self):
+        pool = plumage.TSDRConnectionPool()
+        t = plumage.TSDRReq()
+        t.setConnectionPool(pool)
+        self.standin.drop_next = 1
+        self.assertRaises(Exception, t.getTSDRInfo, "76044902", "s")
+        self.assertEqual(len(self.standin.requests), 1)
+        pool.close()
+
+    def test_P007_idle_timeout(self):
+        pool = plumage.TSDRConnectionPool(idle_timeout=0.1)
+        t = plumage.TSDRReq()
+        t.setConnectionPool(pool)
+        t.getTSDRInfo("76044902", "s")
+        time.sleep(0.2)
+        t.getTSDRInfo("76044902", "s")
+        self.assertEqual(pool.connections_opened, 2)
+        self.assertEqual(pool.connections_reused, 0)
+        pool.close()
+
+    def test_P008_pool_size_capped(self):
+        '''
+        Concurrent threads each use their own connection; only max_connections are kept
+        '''
+        self.standin.delay = 0.1
+        pool = plumage.TSDRConnectionPool(max_connections=2)
+        def fetch():
+            t = plumage.TSDRReq()
+            t.setConnectionPool(pool)
+            t.getXMLData("76044902", "s")
+        threads = [threading.Thread(target=fetch) for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(pool.connections_opened, 5)
+        self.assertEqual(sum(len(entries) for entries in pool._idle.values()), 2)
+        pool.close()
+        self.assertEqual(pool._idle, {})
+
+    def test_P009_not_found(self):
+        pool = plumage.TSDRConnectionPool()
+        t = plumage.TSDRReq()
+        t.setConnectionPool(pool)
+        t.getTSDRInfo("99999999", "s")
+        self.assertEqual(t.ErrorCode, "Fetch-404")
+        t.getTSDRInfo("76044902", "s")
+        self.assertTrue(t.TSDRData.TSDRMapIsValid)
+        self.assertEqual(pool.connections_opened, 1)
+        pool.close()
+
+    def test_P010_async_path_shares_pool(self):
+        if PYTHON2:
+            return
+        import asyncio
+        pool = plumage.TSDRConnectionPool()
+        async def main():
+            for _ in range(3):
+                t = plumage.TSDRReq()
+                t.setConnectionPool(pool)
+                await t.getTSDRInfoAsync("76044902", "s")
+                self.assertTrue(t.TSDRData.TSDRMapIsValid)
+        asyncio.run(main())
+        self.assertEqual(pool.connections_opened, 1)
+        self.assertEqual(pool.connections_reused, 2)
+        self.assertEqual(self.standin.connections, 1)
+        pool.close()
+
+    # Group Q
+    # Response cache
+
+    def test_Q001_cache_hit(self):
+        cache = plumage.TSDRResponseCache(self.tempdir)
+        t = plumage.TSDRReq()
+        t.setCache(cache)
+        t.getTSDRInfo("76044902", "s")
+        self.assertTrue(t.TSDRData.TSDRMapIsValid)
+        first_xml = t.XMLData
+        source = t.TSDRData.TSDRSingle["DiagnosticInfoXMLSource"]
+        self.assertFalse("cached" in source)
+        t.getTSDRInfo("76044902", "s")
+        self.assertTrue(t.TSDRData.TSDRMapIsValid)
+        self.assertEqual(t.XMLData, first_xml)
+        self.assertTrue(t.TSDRData.TSDRSingle["DiagnosticInfoXMLSource"].startswith(source + " (cached; fetched "))
+        self.assertEqual(len(self.standin.requests), 1)
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+    def test_Q002_keyed_by_number_type_and_format(self):
+        cache = plumage.TSDRResponseCache(self.tempdir)
+        t = plumage.TSDRReq()
+        t.setCache(cache)
+        t.getXMLData("76044902", "s")
+        t.getXMLData("76044903", "s")
+        t.setPTOFormat("ST66")
+        t.getXMLData("76044902", "s")
+        self.assertEqual(len(self.standin.requests), 3)
+        self.assertEqual(cache.hits, 0)
+        t.getXMLData("76044902", "s")
+        self.assertEqual(len(self.standin.requests), 3)
+        self.assertEqual(cache.hits, 1)
+
+    def test_Q003_ttl(self):
+        cache = plumage.TSDRResponseCache(self.tempdir, ttl=0.2)
+        t = plumage.TSDRReq()
+        t.setCache(cache)
+        t.getXMLData("76044902", "s")
+        t.getXMLData("76044902", "s")
+        self.assertEqual(len(self.standin.requests), 1)
+        time.sleep(0.3)
+        t.getXMLData("76044902", "s")
+        self.assertTrue(t.XMLDataIsValid)
+        self.assertEqual(len(self.standin.requests), 2)
+        # per-entry TTL overrides the default
+        cache.put(("s", "11111111", "zip"), "url", b"data", ttl=60)
+        time.sleep(0.3)
+        self.assertEqual(cache.get(("s", "11111111", "zip")).data, b"data")
+
+    def test_Q004_not_found_not_cached(self):
+        cache = plumage.TSDRResponseCache(self.tempdir)
+        t = plumage.TSDRReq()
+        t.setCache(cache)
+        t.getXMLData("99999999", "s")
+        t.getXMLData("99999999", "s")
+        self.assertEqual(t.ErrorCode, "Fetch-404")
+        self.assertEqual(len(self.standin.requests), 2)
+        self.assertEqual(cache.misses, 2)
+
+    def test_Q005_lru_eviction(self):
+        payload = b"x" * 1000
+        cache = plumage.TSDRResponseCache(self.tempdir, max_bytes=3500, rescan_interval=1)
+        keys = [("s", "7000000%d" % n, "zip") for n in range(3)]
+        for key in keys:
+            cache.put(key, "url", payload)
+            time.sleep(0.05)    # distinct modification times
+        cache.get(keys[0])      # now most recently used
+        time.sleep(0.05)
+        cache.put(("s", "70000009", "zip"), "url", payload)
+        self.assertEqual(cache.evictions, 1)
+        self.assertTrue(cache.get(keys[0]) is not None)
+        self.assertTrue(cache.get(keys[1]) is None)
+        self.assertTrue(cache.get(keys[2]) is not None)
+        total = sum(os.path.getsize(os.path.join(self.tempdir, name)) for name in os.listdir(self.tempdir))
+        self.assertTrue(total <= 3500)
+
+    def test_Q006_shared_by_processes(self):
+        '''
+        Several processes writing and reading the same entries never see a partial entry
+        '''
+        processes = [multiprocessing.Process(target=_cache_worker, args=(self.tempdir, n))
+                     for n in range(4)]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+        self.assertEqual([process.exitcode for process in processes], [0, 0, 0, 0])
+        leftovers = [name for name in os.listdir(self.tempdir) if name.startswith(".tmp-")]
+        self.assertEqual(leftovers, [])
+
+    def test_Q007_invalidate_and_clear(self):
+        cache = plumage.TSDRResponseCache(self.tempdir)
+        cache.put(("s", "11111111", "zip"), "url", b"one")
+        cache.put(("s", "22222222", "zip"), "url", b"two")
+        cache.invalidate(("s", "11111111", "zip"))
+        self.assertTrue(cache.get(("s", "11111111", "zip")) is None)
+        self.assertEqual(cache.get(("s", "22222222", "zip")).data, b"two")
+        cache.clear()
+        self.assertTrue(cache.get(("s", "22222222", "zip")) is None)
+
+    # Group M
+    # TSDR map cache
+
+    def test_M001_map_cache_hit(self):
+        map_cache = plumage.TSDRMapCache()
+        t = plumage.TSDRReq()
+        t.setMapCache(map_cache)
+        t.getTSDRInfo("76044902", "s")
+        self.assertTrue(t.TSDRData.TSDRMapIsValid)
+        first = t.TSDRData
+        t.getTSDRInfo("76044902", "s")
+        self.assertTrue(t.TSDRData.TSDRMapIsValid)
+        self.assertEqual(t.TSDRData.TSDRSingle, first.TSDRSingle)
+        self.assertEqual(t.TSDRData.TSDRMulti, first.TSDRMulti)
+        # answered without a fetch; no XML or CSV data on a cache hit
+        self.assertEqual(len(self.standin.requests), 1)
+        self.assertFalse(t.XMLDataIsValid)
+        self.assertTrue(t.XMLData is None)
+        self.assertTrue(t.CSVData is None)
+        self.assertEqual((map_cache.hits, map_cache.misses), (1, 1))
+
+    def test_M002_copies_isolated(self):
+        map_cache = plumage.TSDRMapCache()
+        t1 = plumage.TSDRReq()
+        t1.setMapCache(map_cache)
+        t1.getTSDRInfo("76044902", "s")
+        applicant_count = len(t1.TSDRData.TSDRMulti["ApplicantList"])
+        t1.TSDRData.TSDRSingle["ApplicationNumber"] = "corrupted"
+        t1.TSDRData.TSDRMulti["ApplicantList"][0]["ApplicantName"] = "corrupted"
+        t1.TSDRData.TSDRMulti["ApplicantList"].append({})
+        t2 = plumage.TSDRReq()
+        t2.setMapCache(map_cache)
+        t2.getTSDRInfo("76044902", "s")
+        self.assertEqual(t2.TSDRData.TSDRSingle["ApplicationNumber"], "76044902")
+        self.assertEqual(len(t2.TSDRData.TSDRMulti["ApplicantList"]), applicant_count)
+        self.assertNotEqual(t2.TSDRData.TSDRMulti["ApplicantList"][0]["ApplicantName"], "corrupted")
+        self.assertEqual(len(self.standin.requests), 1)
+
+    def test_M003_keyed_by_format_and_xslt(self):
+        map_cache = plumage.TSDRMapCache()
+        t = plumage.TSDRReq()
+        t.setMapCache(map_cache)
+        t.getTSDRInfo("76044902", "s")
+        t.setPTOFormat("ST66")
+        t.getTSDRInfo("76044902", "s")
+        self.assertEqual(len(self.standin.requests), 2)
+        self.assertEqual(map_cache.hits, 0)
+        t.reset()
+        t.setMapCache(map_cache)
+        t.getTSDRInfo("76044902", "s")
+        self.assertEqual(len(self.standin.requests), 2)
+        self.assertEqual(map_cache.hits, 1)
+
+    def test_M004_ttl_and_invalidate(self):
+        map_cache = plumage.TSDRMapCache(ttl=0.2)
+        t = plumage.TSDRReq()
+        t.setMapCache(map_cache)
+        t.getTSDRInfo("76044902", "s")
+        time.sleep(0.3)
+        t.getTSDRInfo("76044902", "s")
+        self.assertEqual(len(self.standin.requests), 2)
+        t.getTSDRInfo("76044902", "s")
+        self.assertEqual(len(self.standin.requests), 2)
+        map_cache.invalidate(t._mapCacheKey("76044902", "s"))
+        t.getTSDRInfo("76044902", "s")
+        self.assertEqual(len(self.standin.requests), 3)
+        self.assertEqual(len(map_cache), 1)
+        map_cache.clear()
+        self.assertEqual((len(map_cache), map_cache.size), (0, 0))
+
+    def test_M005_lru_bounds(self):
+        t = plumage.TSDRReq()
+        t.getTSDRInfo("76044902", "s")
+        tsdrmap = t.TSDRData
+        map_cache = plumage.TSDRMapCache(max_entries=2)
+        map_cache.put("a", tsdrmap)
+        map_cache.put("b", tsdrmap)
+        map_cache.get("a")          # now most recently used
+        map_cache.put("c", tsdrmap)
+        self.assertEqual(map_cache.evictions, 1)
+        self.assertTrue(map_cache.get("a") is not None)
+        self.assertTrue(map_cache.get("b") is None)
+        self.assertTrue(map_cache.get("c") is not None)
+        # bounded by size: room for two maps, not three
+        one_map = map_cache.size // 2
+        map_cache = plumage.TSDRMapCache(max_bytes=one_map * 2 + one_map // 2)
+        for key in "abc":
+            map_cache.put(key, tsdrmap)
+        self.assertEqual(len(map_cache), 2)
+        self.assertTrue(map_cache.get("a") is None)
+        self.assertTrue(map_cache.size <= map_cache.max_bytes)
+        # invalid maps are not cached
+        map_cache.put("d", plumage.TSDRMap())
+        self.assertTrue(map_cache.get("d") is None)
+
+    def test_M006_batch_and_async_use_map_cache(self):
+        from Plumage import batch
+        map_cache = plumage.TSDRMapCache()
+        identifiers = [("76044902", "s"), ("76044903", "s")]
+        b = batch.TSDRBatch(fetch_workers=2, process_workers=2, map_cache=map_cache)
+        results = list(b.fetchMany(identifiers))
+        results.extend(b.fetchMany(identifiers))
+        self.assertTrue(all(t.TSDRData.TSDRMapIsValid for t in results))
+        self.assertEqual(len(self.standin.requests), 2)
+        self.assertEqual(map_cache.hits, 2)
+        if PYTHON2:
+            return
+        import asyncio
+        t = plumage.TSDRReq()
+        t.setMapCache(map_cache)
+        asyncio.run(t.getTSDRInfoAsync("76044902", "s"))
+        self.assertTrue(t.TSDRData.TSDRMapIsValid)
+        self.assertEqual(len(self.standin.requests), 2)
+
+    # Group R
+    # Conditional revalidation of cached responses
+
+    def test_R001_revalidated(self):
+        cache = plumage.TSDRResponseCache(self.tempdir, ttl=0.2)
+        t = plumage.TSDRReq()
+        t.setCache(cache)
+        t.getTSDRInfo("76044902", "s")
+        first_xml = t.XMLData
+        time.sleep(0.3)
+        t.getTSDRInfo("76044902", "s")
+        self.assertTrue(t.TSDRData.TSDRMapIsValid)
+        self.assertEqual(t.XMLData, first_xml)
+        self.assertTrue(t.TSDRData.TSDRSingle["DiagnosticInfoXMLSource"].endswith(" (revalidated)"))
+        self.assertEqual(len(self.standin.requests), 2)
+        self.assertEqual(self.standin.not_modified, 1)
+        self.assertEqual((cache.full_fetches, cache.revalidations), (1, 1))
+        self.assertEqual(cache.bytes_saved, len(self.standin.content[("casestatus", "content.zip")]))
+        # renewed: fresh again
+        t.getTSDRInfo("76044902", "s")
+        self.assertEqual(len(self.standin.requests), 2)
+
+    def test_R002_changed_data_fetched_in_full(self):
+        cache = plumage.TSDRResponseCache(self.tempdir, ttl=0.2)
+        t = plumage.TSDRReq()
+        t.setPTOFormat("ST66")
+        t.setCache(cache)
+        t.getXMLData("76044902", "s")
+        time.sleep(0.3)
+        key = ("status66", "info.xml")
+        self.standin.content[key] = self.standin.content[key].replace(b"</", b"\n</", 1)
+        t.getXMLData("76044902", "s")
+        self.assertEqual(t.XMLData.encode("utf-8"), self.standin.content[key])
+        self.assertEqual(self.standin.not_modified, 0)
+        self.assertEqual((cache.full_fetches, cache.revalidations), (2, 0))
+
+    def test_R003_no_validators(self):
+        self.standin.validators = False
+        cache = plumage.TSDRResponseCache(self.tempdir, ttl=0.2)
+        t = plumage.TSDRReq()
+        t.setCache(cache)
+        t.getXMLData("76044902", "s")
+        time.sleep(0.3)
+        t.getXMLData("76044902", "s")
+        self.assertTrue(t.XMLDataIsValid)
+        self.assertEqual((cache.full_fetches, cache.revalidations), (2, 0))
+
+    def test_R004_revalidated_without_pool_and_async(self):
+        cache = plumage.TSDRResponseCache(self.tempdir, ttl=0.2)
+        t = plumage.TSDRReq()
+        t.setConnectionPool(None)
+        t.setCache(cache)
+        t.getTSDRInfo("76044902", "s")
+        time.sleep(0.3)
+        t.getTSDRInfo("76044902", "s")
+        self.assertTrue(t.TSDRData.TSDRMapIsValid)
+        self.assertEqual(cache.revalidations, 1)
+        if PYTHON2:
+            return
+        import asyncio
+        time.sleep(0.3)
+        t = plumage.TSDRReq()
+        t.setCache(cache)
+        asyncio.run(t.getTSDRInfoAsync("76044902", "s"))
+        self.assertTrue(t.TSDRData.TSDRMapIsValid)
+        self.assertEqual(cache.revalidations, 2)
+        self.assertEqual(self.standin.not_modified, 2)
+
+    def test_R005_map_reused_after_revalidation(self):
+        cache = plumage.TSDRResponseCache(self.tempdir, ttl=0.2)
+        map_cache = plumage.TSDRMapCache(ttl=0.2)
+        t = plumage.TSDRReq()
+        t.setCache(cache)
+        t.setMapCache(map_cache)
+        t.getTSDRInfo("76044902", "s")
+        first = t.TSDRData
+        time.sleep(0.3)
+        t.getTSDRInfo("76044902", "s")
+        self.assertEqual(self.standin.not_modified, 1)
+        self.assertEqual(map_cache.hits, 1)
+        self.assertTrue(t.XMLData is None)     # not transformed again
+        self.assertEqual(t.TSDRData.TSDRSingle, first.TSDRSingle)
+        # renewed: fresh again
+        t.getTSDRInfo("76044902", "s")
+        self.assertEqual(len(self.standin.requests), 2)
+        self.assertEqual(map_cache.hits, 2)
+
+    def test_R007_revalidated_map_keeps_fetch_details(self):
+        '''
+        A map reused after a 304 keeps what the conditional request recorded
+        '''
+        cache = plumage.TSDRResponseCache(self.tempdir, ttl=0.2)
+        map_cache = plumage.TSDRMapCache(ttl=0.2)
+        t = plumage.TSDRReq()
+        t.setCache(cache)
+        t.setMapCache(map_cache)
+        t.setRecordTimings(True)
+        t.getTSDRInfo("76044902", "s")
+        time.sleep(0.3)
+        t.getTSDRInfo("76044902", "s")
+        self.assertEqual(self.standin.not_modified, 1)
+        self.assertEqual(map_cache.hits, 1)
+        self.assertTrue(t.TSDRData.TSDRMapIsValid)
+        self.assertEqual(t.FetchAttempts, 1)
+        self.assertTrue("fetch" in t.Timings)
+        self.assertTrue(t._revalidated)
+        self.assertTrue(t._validator is not None)
+        self.assertTrue(t._substitutions["$XMLSOURCE$"].endswith(" (revalidated)"))
+
+    def test_R006_map_not_reused_for_other_version(self):
+        '''
+        An expired map built from older data is not reused when a newer cached
+        response (e.g., stored by another process) is revalidated
+        '''
+        cache = plumage.TSDRResponseCache(self.tempdir, ttl=0.2)
+        map_cache = plumage.TSDRMapCache(ttl=0.2)
+        t = plumage.TSDRReq()
+        t.setPTOFormat("ST66")
+        t.setCache(cache)
+        t.setMapCache(map_cache)
+        t.getTSDRInfo("76044902", "s")
+        key = ("status66", "info.xml")
+        self.standin.content[key] = self.standin.content[key].replace(b"</", b"\n</", 1)
+        cache.invalidate(("s", "76044902", "ST66"))
+        other = plumage.TSDRReq()
+        other.setPTOFormat("ST66")
+        other.setCache(cache)
+        other.getXMLData("76044902", "s")
+        time.sleep(0.3)
+        t.getTSDRInfo("76044902", "s")
+        self.assertEqual(self.standin.not_modified, 1)
+        self.assertEqual(map_cache.hits, 0)
+        self.assertTrue(t.TSDRData.TSDRMapIsValid)
+        self.assertEqual(t.XMLData.encode("utf-8"), self.standin.content[key])
+
+    # Group T
+    # Retries
+
+    def test_T001_transient_failures_retried(self):
+        self.standin.fail_next = [(503, {}), (429, {}), (500, {})]
+        t = plumage.TSDRReq()
+        t.setRetryPolicy(plumage.TSDRRetryPolicy(backoff=0.01))
+        t.getTSDRInfo("76044902", "s")
+        self.assertTrue(t.TSDRData.TSDRMapIsValid)
+        self.assertEqual(t.FetchAttempts, 4)
+        self.assertEqual(len(self.standin.requests), 4)
+        self.assertTrue(t.FetchSeconds > 0)
+
+    def test_T002_attempts_exhausted(self):
+        self.standin.fail_next = [(503, {})] * 5
+        t = plumage.TSDRReq()
+        t.setRetryPolicy(plumage.TSDRRetryPolicy(max_attempts=3, backoff=0.01))
+        try:
+            t.getXMLData("76044902", "s")
+            self.fail("HTTPError not raised")
+        except plumage.HTTPError as e:
+            self.assertEqual(e.code, 503)
+        self.assertEqual(t.FetchAttempts, 3)
+        self.assertEqual(len(self.standin.requests), 3)
+
+    def test_T003_no_retry_by_default_or_for_other_errors(self):
+        self.standin.fail_next = [(503, {})]
+        t = plumage.TSDRReq()
+        self.assertRaises(plumage.HTTPError, t.getXMLData, "76044902", "s")
+        self.assertEqual(t.FetchAttempts, 1)
+        t.setRetryPolicy(plumage.TSDRRetryPolicy(backoff=0.01))
+        self.standin.fail_next = [(403, {})]
+        self.assertRaises(plumage.HTTPError, t.getXMLData, "76044902", "s")
+        t.getXMLData("99999999", "s")
+        self.assertEqual(t.ErrorCode, "Fetch-404")
+        self.assertEqual(t.FetchAttempts, 1)
+        self.assertEqual(len(self.standin.requests), 3)
+
+    def test_T004_retry_after(self):
+        self.standin.fail_next = [(429, {"Retry-After" : "1"})]
+        t = plumage.TSDRReq()
+        t.setRetryPolicy(plumage.TSDRRetryPolicy(backoff=0.01))
+        t.getXMLData("76044902", "s")
+        self.assertTrue(t.XMLDataIsValid)
+        self.assertEqual(t.FetchAttempts, 2)
+        self.assertTrue(t.FetchSeconds >= 1, t.FetchSeconds)
+        policy = plumage.TSDRRetryPolicy(backoff=0.01, jitter=0)
+        http_date = email.utils.formatdate(time.time() + 30, usegmt=True)
+        delay = policy.retryDelay(1, 0, 503, {"Retry-After" : http_date})
+        self.assertTrue(28 < delay <= 30, delay)
+        self.assertEqual(policy.retryDelay(1, 0, 503, {"Retry-After" : "soon"}), 0.01)
+
+    def test_T005_deadline(self):
+        self.standin.fail_next = [(503, {})] * 20
+        t = plumage.TSDRReq()
+        t.setRetryPolicy(plumage.TSDRRetryPolicy(max_attempts=20, backoff=0.1, jitter=0,
+                                                 deadline=0.5))
+        self.assertRaises(plumage.HTTPError, t.getXMLData, "76044902", "s")
+        # waits of 0.1, 0.2; a third (0.4) would pass the deadline
+        self.assertEqual(t.FetchAttempts, 3)
+        self.assertTrue(t.FetchSeconds < 0.5, t.FetchSeconds)
+        # Retry-After beyond the deadline: give up now, rather than wait
+        policy = plumage.TSDRRetryPolicy(deadline=10)
+        self.assertTrue(policy.retryDelay(1, 0, 429, {"Retry-After" : "60"}) is None)
+
+    def test_T006_network_error_retried(self):
+        self.standin.drop_next = 2
+        t = plumage.TSDRReq()
+        t.setConnectionPool(None)
+        t.setRetryPolicy(plumage.TSDRRetryPolicy(backoff=0.01))
+        t.getXMLData("76044902", "s")
+        self.assertTrue(t.XMLDataIsValid)
+        self.assertEqual(t.FetchAttempts, 3)
+
+    def test_T007_batch_and_async_retry(self):
+        from Plumage import batch
+        policy = plumage.TSDRRetryPolicy(backoff=0.01)
+        self.standin.fail_next = [(503, {})] * 2
+        b = batch.TSDRBatch(fetch_workers=2, process_workers=2, retry_policy=policy)
+        results = list(b.fetchMany([("76044902", "s"), ("76044903", "s")]))
+        self.assertTrue(all(t.TSDRData.TSDRMapIsValid for t in results))
+        self.assertEqual(len(self.standin.requests), 4)
+        if PYTHON2:
+            return
+        import asyncio
+        self.standin.fail_next = [(502, {})]
+        t = plumage.TSDRReq()
+        t.setRetryPolicy(policy)
+        asyncio.run(t.getTSDRInfoAsync("76044902", "s"))
+        self.assertTrue(t.TSDRData.TSDRMapIsValid)
+        self.assertEqual(t.FetchAttempts, 2)
+
+    def test_T008_deadline_bounds_attempts_and_rate_limiter_wait(self):
+        '''
+        A deadline bounds the whole fetch: an attempt slower than the deadline
+        is cut short, pooled or not, and so is a rate limiter wait
+        '''
+        self.standin.delay = 2
+        policy = plumage.TSDRRetryPolicy(backoff=0.01, deadline=0.5)
+        for pool in [plumage.TSDRConnectionPool(), None]:
+            t = plumage.TSDRReq()
+            t.setConnectionPool(pool)
+            t.setRetryPolicy(policy)
+            started = time.time()
+            self.assertRaises((socket.timeout, plumage.URLError), t.getXMLData, "76044902", "s")
+            elapsed = time.time() - started
+            self.assertTrue(0.4 < elapsed < 1, elapsed)
+            self.assertEqual(t.FetchAttempts, 1)
+        self.standin.delay = 0
+        t = plumage.TSDRReq()
+        t.setRetryPolicy(policy)
+        t.setRateLimiter(plumage.TSDRRateLimiter(rate=0.2))
+        t.getXMLData("76044902", "s")
+        started = time.time()
+        self.assertRaises(socket.timeout, t.getXMLData, "76044902", "s")
+        self.assertTrue(time.time() - started < 0.1)
+        if PYTHON2:
+            return
+        import asyncio
+        self.standin.delay = 2
+        t = plumage.TSDRReq()
+        t.setRetryPolicy(policy)
+        started = time.time()
+        self.assertRaises((asyncio.TimeoutError, socket.timeout), asyncio.run,
+                          t.getTSDRInfoAsync("76044902", "s"))
+        elapsed = time.time() - started
+        self.assertTrue(0.4 < elapsed < 1, elapsed)
+
+    # Group L
+    # Rate limiter
+
+    def test_L001_rate(self):
+        limiter = plumage.TSDRRateLimiter(rate=20)
+        t = plumage.TSDRReq()
+        t.setRateLimiter(limiter)
+        start = time.time()
+        for _ in range(10):
+            t.getXMLData("76044902", "s")
+        elapsed = time.time() - start
+        # first request at once, then one every 0.05 seconds
+        self.assertTrue(elapsed >= 0.45, elapsed)
+        self.assertEqual((limiter.requests, limiter.delayed), (10, 9))
+
+    def test_L002_burst(self):
+        limiter = plumage.TSDRRateLimiter(rate=5, burst=3)
+        delays = [limiter.reserve() for _ in range(5)]
+        self.assertEqual(delays[:3], [0, 0, 0])
+        self.assertTrue(0.15 < delays[3] <= 0.2, delays)
+        self.assertTrue(0.35 < delays[4] <= 0.4, delays)
+
+    def test_L003_shared_by_threads(self):
+        limiter = plumage.TSDRRateLimiter(rate=50)
+        plumage.setSharedRateLimiter(limiter)
+        send_times = []
+        def reserve():
+            for _ in range(10):
+                send_times.append(time.time() + limiter.reserve())
+        threads = [threading.Thread(target=reserve) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        send_times.sort()
+        # rate 50: 40 requests scheduled over at least 39 * 0.02 seconds
+        self.assertTrue(send_times[-1] - send_times[0] > 0.77, send_times[-1] - send_times[0])
+        # TSDRReqs without a limiter of their own use the shared one
+        t = plumage.TSDRReq()
+        t.getXMLData("76044902", "s")
+        self.assertEqual(limiter.requests, 41)
+
+    def test_L004_shared_by_processes(self):
+        path = os.path.join(self.tempdir, "rate")
+        queue = multiprocessing.Queue()
+        processes = [multiprocessing.Process(target=_rate_worker, args=(path, queue))
+                     for n in range(3)]
+        for process in processes:
+            process.start()
+        send_times = sorted(queue.get(timeout=30) for _ in range(3 * 10))
+        for process in processes:
+            process.join()
+        # rate 50, across all processes: 30 requests take at least 29 * 0.02 seconds,
+        # and no 0.1-second window has more than 5 (allowing 1 for scheduling jitter)
+        self.assertTrue(send_times[-1] - send_times[0] > 0.55, send_times[-1] - send_times[0])
+        busiest = max(len([t for t in send_times if start <= t < start + 0.1])
+                      for start in send_times)
+        self.assertTrue(busiest <= 6, busiest)
+
+    def test_L005_batch_and_async(self):
+        from Plumage import batch
+        limiter = plumage.TSDRRateLimiter(rate=20)
+        b = batch.TSDRBatch(fetch_workers=4, process_workers=2, rate_limiter=limiter)
+        start = time.time()
+        results = list(b.fetchMany([("%08d" % (76000000 + n), "s") for n in range(6)]))
+        self.assertTrue(all(t.TSDRData.TSDRMapIsValid for t in results))
+        self.assertTrue(time.time() - start >= 0.25)
+        self.assertEqual(limiter.requests, 6)
+        if PYTHON2:
+            return
+        import asyncio
+        from Plumage import aio
+        async def collect():
+            return [t async for t in aio.fetchMany([("%08d" % (76000000 + n), "s") for n in range(6)],
+                                                   rate_limiter=limiter)]
+        start = time.time()
+        results = asyncio.run(collect())
+        self.assertTrue(all(t.TSDRData.TSDRMapIsValid for t in results))
+        self.assertTrue(time.time() - start >= 0.25)
+        self.assertEqual(limiter.requests, 12)
+
+    @unittest.skipIf(PYTHON2 or plumage.fcntl is None, "needs asyncio and fcntl")
+    def test_L006_shared_limiter_does_not_block_event_loop(self):
+        '''
+        While another process holds the shared limiter's file lock, other
+        tasks on the event loop keep running
+        '''
+        import asyncio
+        path = os.path.join(self.tempdir, "rate")
+        limiter = plumage.TSDRRateLimiter(rate=100, path=path)
+        fd = os.open(path, os.O_RDWR | os.O_CREAT)
+        plumage.fcntl.flock(fd, plumage.fcntl.LOCK_EX)     # as if held by another process
+        releaser = threading.Timer(0.4, lambda: (plumage.fcntl.flock(fd, plumage.fcntl.LOCK_UN),
+                                                 os.close(fd)))
+        releaser.start()
+        ticks = []
+        async def main():
+            async def ticker():
+                while True:
+                    ticks.append(time.time())
+                    await asyncio.sleep(0.05)
+
+            task = asyncio.ensure_future(ticker())
+            t = plumage.TSDRReq()
+            t.setRateLimiter(limiter)
+            await t.getTSDRInfoAsync("76044902", "s")
+            task.cancel()
+            return t
+        t = asyncio.run(main())
+        releaser.join()
+        self.assertTrue(t.TSDRData.TSDRMapIsValid)
+        self.assertTrue(len(ticks) >= 5, len(ticks))
+
+def _rate_worker(path, queue):
+    limiter = plumage.TSDRRateLimiter(rate=50, path=path)
+    for _ in range(10):
+        limiter.acquire()
+        queue.put(time.time())
+
+def _cache_worker(directory, worker_number):
+    cache = plumage.TSDRResponseCache(directory, rescan_interval=10)
+    payloads = [bytes(bytearray([n]) * (20000 + n)) for n in range(4)]
+    for i in range(50):
+        key = ("s", "1000000%d" % (i % 3), "zip")
+        cache.put(key, "url", payloads[worker_number])
+        entry = cache.get(key)
+        if entry is not None and entry.data not in payloads:
+            sys.exit(1)
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
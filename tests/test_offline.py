@@ -1,9 +1,22 @@
+import copy
+import hashlib
+import io
+import mmap
 import os
+import pickle
+import shutil
 import sys
+import tempfile
+import threading
 import unittest
 PYTHON2 = sys.version_info.major == 2
 PYTHON3 = sys.version_info.major == 3
 
+try:
+    import tracemalloc
+except ImportError:     # Python 2
+    tracemalloc = None
+
 from testing_context import plumage
 
 class TestUM(unittest.TestCase):
@@ -15,6 +28,12 @@ class TestUM(unittest.TestCase):
     # Group E: Parameter validations
     # Group F: XML/XSL variations
     # Group G: CSV/XSL validations
+    # Group H: Concurrency
+    # Group I: XPath engine (differential tests against the XSLT engine)
+    # Group J: Field projection
+    # Group K: Retention
+    # Group L: Compact maps
+    # Group M: Stage timings
 
     # Group O (in test_online.py): Online tests that actually hit the PTO TSDR system
 
@@ -151,7 +170,135 @@ class TestUM(unittest.TestCase):
         self.assertTrue(t.XMLDataIsValid)
         self.assertFalse(t.CSVDataIsValid)
         self.assertFalse(t.TSDRData.TSDRMapIsValid)
-        
+
+    # Parsed tree is kept from XML fetch, reused for CSV, and dropped on reset
+    def test_B003_parsed_tree_retained(self):
+        t = plumage.TSDRReq()
+        self.assertIsNone(t.XMLTree)
+        testfile = os.path.join(self.TESTFILES_DIR, "sn76044902.zip")
+        t.getXMLData(testfile)
+        self.assertTrue(t.XMLDataIsValid)
+        tree = t.XMLTree
+        self.assertIsNotNone(tree)
+        t.getCSVData()
+        self.assertTrue(t.CSVDataIsValid)
+        self.assertTrue(t.XMLTree is tree)
+        t.resetXMLData()
+        self.assertIsNone(t.XMLTree)
+
+    # Invalid XML leaves no tree behind
+    def test_B004_invalid_xml_no_tree(self):
+        t = plumage.TSDRReq()
+        fd, testfile = tempfile.mkstemp(suffix=".xml")
+        with os.fdopen(fd, "wb") as f:
+            f.write(b"<Transaction><unclosed></Transaction>")
+        try:
+            t.getXMLData(testfile)
+        finally:
+            os.remove(testfile)
+        self.assertFalse(t.XMLDataIsValid)
+        self.assertEqual(t.ErrorCode, "XML-NoValidXML")
+        self.assertIsNone(t.XMLTree)
+
+    # Images are decompressed only when asked for, or written straight out
+    def test_B005_lazy_images(self):
+        t = plumage.TSDRReq()
+        testfile = os.path.join(self.TESTFILES_DIR, "sn76044902.zip")
+        t.getXMLData(testfile)
+        self.assertEqual(t._images, {})
+        with open(testfile, "rb") as f:
+            self.assertEqual(t.ZipData, f.read())
+        thumbnail = t.ImageThumb
+        self.assertEqual(thumbnail[6:10], b"JFIF")
+        self.assertEqual(list(t._images), ["markThumbnailImage.jpg"])
+        written = io.BytesIO()
+        self.assertTrue(t.writeImage(written))
+        self.assertEqual(written.getvalue()[0:4], b"\x89PNG")
+        self.assertEqual(list(t._images), ["markThumbnailImage.jpg"])
+        self.assertEqual(written.getvalue(), t.ImageFull)
+        fd, imagefile = tempfile.mkstemp(suffix=".jpg")
+        os.close(fd)
+        try:
+            self.assertTrue(t.writeImage(imagefile, thumbnail=True))
+            with open(imagefile, "rb") as f:
+                self.assertEqual(f.read(), thumbnail)
+        finally:
+            os.remove(imagefile)
+        # nothing to write for XML not from a zip file
+        t.getXMLData(os.path.join(self.TESTFILES_DIR, "sn76044902.xml"))
+        self.assertIsNone(t.ZipData)
+        self.assertIsNone(t.ImageFull)
+        self.assertFalse(t.writeImage(io.BytesIO()))
+
+    # Zip file let go once its XML has been read
+    def test_B006_zip_data_not_retained(self):
+        t = plumage.TSDRReq()
+        t.setRetainZipData(False)
+        t.getTSDRInfo(os.path.join(self.TESTFILES_DIR, "sn76044902.zip"))
+        self.assertTrue(t.TSDRData.TSDRMapIsValid)
+        self.assertIsNone(t.ZipData)
+        self.assertIsNone(t.ImageFull)
+        self.assertIsNone(t.ImageThumb)
+        self.assertFalse(t.writeImage(io.BytesIO(), thumbnail=True))
+        self.assertRaises(ValueError, t.setRetainZipData, "no")
+        t.reset()
+        self.assertTrue(t.RetainZipData)
+
+    # Data already in memory, as bytes or another buffer, is used in place
+    def test_B007_xml_from_bytes(self):
+        reference = plumage.TSDRReq()
+        for testfile in ["sn76044902.xml", "sn76044902.zip"]:
+            reference.getTSDRInfo(os.path.join(self.TESTFILES_DIR, testfile))
+            with open(os.path.join(self.TESTFILES_DIR, testfile), "rb") as f:
+                data = f.read()
+            for buffer in [data, bytearray(data), memoryview(data)]:
+                t = plumage.TSDRReq()
+                t.getXMLDataFromBytes(buffer, source_label="archive member %s" % testfile)
+                self.assertTrue(t.XMLDataIsValid)
+                if testfile.endswith(".xml"):
+                    self.assertTrue(t._xml_bytes is buffer)     # not copied
+                t.getCSVData()
+                t.getTSDRData()
+                self.assertEqual(t.TSDRData.TSDRMulti, reference.TSDRData.TSDRMulti)
+                self.assertEqual(t.TSDRData.TSDRSingle["DiagnosticInfoXMLSource"],
+                                 "archive member %s" % testfile)
+                self.assertEqual(t.XMLData, reference.XMLData)
+        self.assertEqual(t.ZipData, data)
+        self.assertEqual(t.ImageThumb, reference.ImageThumb)
+        t.getXMLDataFromBytes(b"")
+        self.assertFalse(t.XMLDataIsValid)
+        self.assertEqual(t.ErrorCode, "XML-NoValidXML")
+
+    # File objects: large regular files are memory-mapped, io.BytesIO used in place
+    def test_B008_xml_from_file_object(self):
+        testfile = os.path.join(self.TESTFILES_DIR, "sn76044902.xml")
+        reference = plumage.TSDRReq()
+        reference.getTSDRInfo(testfile)
+        saved_mmap_min_size = plumage._MMAP_MIN_SIZE
+        plumage._MMAP_MIN_SIZE = 0
+        try:
+            t = plumage.TSDRReq()
+            with open(testfile, "rb") as f:
+                t.getXMLDataFromFileObject(f)
+            self.assertTrue(isinstance(t._xml_bytes, mmap.mmap))
+            t.getCSVData()
+            t.getTSDRData()
+            self.assertEqual(t.TSDRData.TSDRMulti, reference.TSDRData.TSDRMulti)
+            self.assertEqual(t.TSDRData.TSDRSingle["DiagnosticInfoXMLSource"], testfile)
+            self.assertEqual(t.XMLData, reference.XMLData)
+            # getXMLDataFromFile maps large files, too
+            t.getTSDRInfo(testfile)
+            self.assertEqual(t.TSDRData.TSDRMulti, reference.TSDRData.TSDRMulti)
+        finally:
+            plumage._MMAP_MIN_SIZE = saved_mmap_min_size
+        with open(testfile, "rb") as f:
+            data = f.read()
+        t = plumage.TSDRReq()
+        t.getXMLDataFromFileObject(io.BytesIO(data))
+        self.assertTrue(t.XMLDataIsValid)
+        self.assertEqual(t._substitutions["$XMLSOURCE$"], "(file object)")
+        self.assertEqual(t.XMLData, reference.XMLData)
+
     # Group C
     # Test through CSV creation, unzipped XML
     def test_C001_step_by_step_thru_csv_unzipped(self):
@@ -206,6 +353,41 @@ class TestUM(unittest.TestCase):
         self.assertTrue(t.CSVDataIsValid)
         self.assertTrue(t.TSDRData.TSDRMapIsValid)
 
+    def test_D002_CSV_string_assembled_only_on_request(self):
+        t = plumage.TSDRReq()
+        testfile = os.path.join(self.TESTFILES_DIR, "sn76044902.zip")
+        t.getTSDRInfo(testfile)
+        self.assertTrue(t.TSDRData.TSDRMapIsValid)
+        self.assertTrue(t._csv_data is None)
+        csv_data = t.CSVData
+        self.assertEqual(len(csv_data.split("\n")), 291)
+        self.assertTrue(csv_data.endswith('"\n'))
+        self.assertTrue(t.CSVData is csv_data)
+        # each map gets its own dictionaries
+        first_map = t.TSDRData
+        t.getTSDRData()
+        self.assertEqual(t.TSDRData.TSDRSingle, first_map.TSDRSingle)
+        self.assertFalse(t.TSDRData.TSDRSingle is first_map.TSDRSingle)
+
+    def test_D003_map_from_CSV_set_directly(self):
+        t = plumage.TSDRReq()
+        t.CSVData = 'ApplicationNumber,"76044902"\n\n' \
+                    'BeginRepeatedField,"Applicant"\nApplicantName,"Joe"\nEndRepeatedField,"Applicant"\n' \
+                    'BeginRepeatedField,"Applicant"\nApplicantName,"Jane"\nEndRepeatedField,"Applicant"\n'
+        self.assertTrue(t._validateCSV().CSV_OK)
+        t.CSVDataIsValid = True
+        t.getTSDRData()
+        self.assertTrue(t.TSDRData.TSDRMapIsValid)
+        self.assertEqual(t.TSDRData.TSDRSingle["ApplicationNumber"], "76044902")
+        self.assertEqual(t.TSDRData.TSDRMulti["ApplicantList"],
+                         [{"ApplicantName" : "Joe"}, {"ApplicantName" : "Jane"}])
+        t.CSVData = 'ApplicationNumber,"76044902"\nApplicantName,Joe\n'
+        t.getTSDRData()
+        self.assertFalse(t.TSDRData.TSDRMapIsValid)
+        self.assertEqual(t.ErrorCode, "CSV-InvalidValue")
+        self.assertEqual(t.ErrorMessage, "getCSVData [line 2]: invalid value <Joe> found "
+                         "for key <ApplicantName> (does not begin and end with double-quote character)")
+
     # Group E
     # Test parameter validations
     def test_E001_no_such_file(self):
@@ -337,6 +519,65 @@ PublicationDate,"<xsl:value-of select="tm:PublicationDetails/tm:Publication/tm:P
         self.assertTrue(t.CSVDataIsValid)
         self.assertTrue(t.TSDRData.TSDRMapIsValid)
 
+    def test_F006_caller_XSLT_compiled_once(self):
+        '''
+        The same caller-supplied XSLT text, in many requests, is compiled only once
+        '''
+        testxsl = os.path.join(self.TESTFILES_DIR, "appno+pubdate.xsl")
+        with open(testxsl) as f:
+            altXSL = f.read()
+        altXSL = altXSL.replace("</xsl:stylesheet>", "<!-- F006 --></xsl:stylesheet>")
+        before = plumage._compiled_xslt_cache.compilations
+        testfile = os.path.join(self.TESTFILES_DIR, "sn76044902.zip")
+        for _ in range(3):
+            t = plumage.TSDRReq()
+            t.setXSLT(altXSL)
+            t.getTSDRInfo(testfile)
+            self.assertTrue(t.TSDRData.TSDRMapIsValid)
+        self.assertEqual(plumage._compiled_xslt_cache.compilations, before + 1)
+        # the cache is bounded
+        cache = plumage._CompiledXSLTCache(max_entries=2)
+        for n in range(3):
+            cache.compile(altXSL.replace("F006", "F006-%d" % n).encode("utf-8"))
+        self.assertEqual(len(cache._transforms), 2)
+        self.assertEqual(cache.compilations, 3)
+
+    def test_F007_XSLT_file(self):
+        '''
+        setXSLTFile: the file is recompiled only when it changes
+        '''
+        testxsl = os.path.join(self.TESTFILES_DIR, "appno+pubdate.xsl")
+        with open(testxsl) as f:
+            altXSL = f.read()
+        tempdir = tempfile.mkdtemp()
+        try:
+            xsl_pathname = os.path.join(tempdir, "custom.xsl")
+            with open(xsl_pathname, "w") as f:
+                f.write(altXSL.replace("</xsl:stylesheet>", "<!-- F007 --></xsl:stylesheet>"))
+            testfile = os.path.join(self.TESTFILES_DIR, "sn76044902.zip")
+            before = plumage._compiled_xslt_cache.compilations
+            t = plumage.TSDRReq()
+            t.setXSLTFile(xsl_pathname)
+            t.getTSDRInfo(testfile)
+            self.assertTrue(t.TSDRData.TSDRMapIsValid)
+            self.assertEqual(t._substitutions["$XSLTFILENAME$"], "custom.xsl")
+            t.getTSDRInfo(testfile)
+            self.assertEqual(plumage._compiled_xslt_cache.compilations, before + 1)
+            # changed file: recompiled
+            with open(xsl_pathname, "w") as f:
+                f.write(altXSL.replace("</xsl:stylesheet>", "<!-- F007 changed --></xsl:stylesheet>"))
+            os.utime(xsl_pathname, (0, 1))
+            t.getTSDRInfo(testfile)
+            self.assertTrue(t.TSDRData.TSDRMapIsValid)
+            self.assertEqual(plumage._compiled_xslt_cache.compilations, before + 2)
+            # setXSLT and setXSLTFile replace each other
+            t.setXSLT(altXSL)
+            self.assertTrue(t.XSLTFile is None)
+            t.unsetXSLT()
+            self.assertTrue(t.XSLT is None and t.XSLTFile is None)
+        finally:
+            shutil.rmtree(tempdir)
+
     # Group G
     # XSL/CSV validations
     
@@ -515,5 +756,533 @@ PublicationDate,"<xsl:value-of select="tm:PublicationDetails/tm:Publication/tm:P
         t = self._interior_test_with_XSLT_override(altXSL, success_expected=False)
         self.assertEqual(t.ErrorCode, "CSV-InvalidValue")
 
+    def test_G004_placeholder_text_in_data_not_substituted(self):
+        '''
+        Data from the PTO that happens to look like a $placeholder$ is left alone
+        '''
+        with open(os.path.join(self.TESTFILES_DIR, "sn76044902.xml"), "rb") as f:
+            xml_data = f.read()
+        xml_data = xml_data.replace(b"<MarkVerbalElementText>PYTHON<",
+                                    b"<MarkVerbalElementText>PYTHON $XMLSOURCE$ $IMPLEMENTATIONNAME$<")
+        tempdir = tempfile.mkdtemp()
+        try:
+            testfile = os.path.join(tempdir, "sn76044902.xml")
+            with open(testfile, "wb") as f:
+                f.write(xml_data)
+            t = plumage.TSDRReq()
+            t.getTSDRInfo(testfile)
+        finally:
+            shutil.rmtree(tempdir)
+        self.assertTrue(t.TSDRData.TSDRMapIsValid)
+        self.assertEqual(t.TSDRData.TSDRSingle["MarkVerbalElementText"],
+                         "PYTHON $XMLSOURCE$ $IMPLEMENTATIONNAME$")
+        self.assertEqual(t.TSDRData.TSDRSingle["DiagnosticInfoXMLSource"], testfile)
+        self.assertEqual(t.TSDRData.TSDRSingle["DiagnosticInfoImplementationName"], "Plumage-py")
+
+    def test_G005_placeholders_in_caller_XSLT(self):
+        '''
+        $placeholders$ are still supported in caller-provided XSLT: in literal text,
+        in xsl:text, and (substituted after the transform) in attributes
+        '''
+        testxsl = os.path.join(self.TESTFILES_DIR, "appno+pubdate.xsl")
+        with open(testxsl) as f:
+            altXSL = f.read()
+        extra_lines = (
+            '\nDiagnosticInfoXMLSource,"$XMLSOURCE$"<xsl:text/>'
+            '\nDiagnosticInfoImplementationName,<xsl:text>"$IMPLEMENTATIONNAME$"</xsl:text>'
+            '\nUnknownPlaceholder,"$NOSUCHTHING$"<xsl:text/>'
+            '</xsl:template>')
+        altXSL_text = altXSL.replace("</xsl:template>\n</xsl:stylesheet>",
+                                     extra_lines + "\n</xsl:stylesheet>")
+        testfile = os.path.join(self.TESTFILES_DIR, "sn76044902.zip")
+        t = plumage.TSDRReq()
+        t.setXSLT(altXSL_text)
+        t.getTSDRInfo(testfile)
+        self.assertTrue(t.TSDRData.TSDRMapIsValid)
+        self.assertEqual(t.TSDRData.TSDRSingle["DiagnosticInfoXMLSource"], testfile)
+        self.assertEqual(t.TSDRData.TSDRSingle["DiagnosticInfoImplementationName"], "Plumage-py")
+        self.assertEqual(t.TSDRData.TSDRSingle["UnknownPlaceholder"], "$NOSUCHTHING$")
+        _, needs_substitution = plumage._compiled_xslt_cache.compile(altXSL_text.encode("utf-8"))
+        self.assertFalse(needs_substitution)
+
+        extra_lines = '\nDiagnosticInfoXMLSource,"<xsl:value-of select="\'$XMLSOURCE$\'"/>"<xsl:text/></xsl:template>'
+        altXSL_attribute = altXSL.replace("</xsl:template>\n</xsl:stylesheet>",
+                                          extra_lines + "\n</xsl:stylesheet>")
+        t.setXSLT(altXSL_attribute)
+        t.getTSDRInfo(testfile)
+        self.assertTrue(t.TSDRData.TSDRMapIsValid)
+        self.assertEqual(t.TSDRData.TSDRSingle["DiagnosticInfoXMLSource"], testfile)
+        _, needs_substitution = plumage._compiled_xslt_cache.compile(altXSL_attribute.encode("utf-8"))
+        self.assertTrue(needs_substitution)
+
+    # Group H
+    # Concurrency
+
+    def test_H001_concurrent_requests_keep_own_diagnostics(self):
+        '''
+        Many TSDRReq objects run in parallel threads; each one's DiagnosticInfoXMLSource
+        must name its own input file, never another thread's
+        '''
+        source_files = ["sn76044902.zip", "sn76044902.xml", "rn2178784-ST-962.2.1.xml"]
+        thread_count = 8
+        files_per_thread = 12
+        tempdir = tempfile.mkdtemp()
+        try:
+            # give every request a distinct input filename
+            work = []
+            for thread_number in range(thread_count):
+                filenames = []
+                for file_number in range(files_per_thread):
+                    source = source_files[file_number % len(source_files)]
+                    filename = os.path.join(tempdir, "t%02d-f%02d-%s" % (thread_number, file_number, source))
+                    shutil.copyfile(os.path.join(self.TESTFILES_DIR, source), filename)
+                    filenames.append(filename)
+                work.append(filenames)
+
+            mismatches = []
+            failures = []
+            def worker(filenames):
+                for filename in filenames:
+                    t = plumage.TSDRReq()
+                    t.getTSDRInfo(filename)
+                    if not t.TSDRData.TSDRMapIsValid:
+                        failures.append((filename, t.ErrorCode))
+                        continue
+                    xml_source = t.TSDRData.TSDRSingle["DiagnosticInfoXMLSource"]
+                    if xml_source != filename:
+                        mismatches.append((filename, xml_source))
+
+            threads = [threading.Thread(target=worker, args=(filenames,)) for filenames in work]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        finally:
+            shutil.rmtree(tempdir)
+        self.assertEqual(failures, [])
+        self.assertEqual(mismatches, [])
+
+    def test_H002_builtin_XSLT_compiled_once_on_first_use(self):
+        '''
+        A built-in transform is compiled only when first needed, and only once,
+        even when many threads need it at the same moment
+        '''
+        descriptor = plumage._XSLTDescriptor("ST66")
+        self.assertTrue(descriptor._compiled is None)
+        compilations = []
+        original_compile = descriptor._compile
+        def counting_compile():
+            compilations.append(1)
+            return original_compile()
+        descriptor._compile = counting_compile
+        transforms = []
+        threads = [threading.Thread(target=lambda: transforms.append(descriptor.transform))
+                   for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(compilations), 1)
+        self.assertEqual(len(transforms), 8)
+        self.assertTrue(all(transform is transforms[0] for transform in transforms))
+
+    # Group I
+    # XPath engine: must produce the same results as the XSLT engine
+
+    def _results_by_engine(self, t):
+        '''
+        Run getCSVData and getTSDRData on t's XML with each engine in turn; the
+        same TSDRReq is used, so the run-time $placeholder$ values are the same
+        '''
+        results = {}
+        for engine in ["XSLT", "XPath"]:
+            t.setEngine(engine)
+            t.getCSVData()
+            t.getTSDRData()
+            results[engine] = (t.CSVDataIsValid, t.ErrorCode, t.TSDRData.TSDRMapIsValid,
+                               t.TSDRData.TSDRSingle, t.TSDRData.TSDRMulti, t.CSVData)
+        return results
+
+    def test_I001_engines_agree_on_test_files(self):
+        testfiles = sorted(name for name in os.listdir(self.TESTFILES_DIR)
+                           if name.endswith((".xml", ".zip")))
+        self.assertTrue(len(testfiles) >= 4)
+        for name in testfiles:
+            t = plumage.TSDRReq()
+            t.getXMLData(os.path.join(self.TESTFILES_DIR, name))
+            results = self._results_by_engine(t)
+            self.assertEqual(results["XPath"], results["XSLT"], name)
+
+    def test_I002_engines_agree_on_pruned_documents(self):
+        '''
+        Both engines agree when each kind of element, in turn, is missing from
+        the document (exercising absent fields and both sides of each condition)
+        '''
+        for name in ["sn76044902.xml", "rn2178784-ST-962.2.1.xml"]:
+            t = plumage.TSDRReq()
+            t.getXMLData(os.path.join(self.TESTFILES_DIR, name))
+            original = t.XMLTree
+            tags = sorted(set(node.tag for node in original.getroot().iterdescendants()
+                              if isinstance(node.tag, str)))
+            self.assertTrue(len(tags) > 50)
+            for tag in tags:
+                pruned = copy.deepcopy(original)
+                for node in list(pruned.getroot().iterdescendants(tag)):
+                    node.getparent().remove(node)
+                t.XMLTree = pruned
+                results = self._results_by_engine(t)
+                self.assertEqual(results["XPath"], results["XSLT"], "%s without %s" % (name, tag))
+
+    def test_I003_XPath_engine_details(self):
+        t = plumage.TSDRReq()
+        self.assertEqual(t.Engine, "XSLT")
+        self.assertRaises(ValueError, t.setEngine, "xpath")
+        t.setEngine("XPath")
+        testfile = os.path.join(self.TESTFILES_DIR, "sn76044902.xml")
+        t.getXMLData(testfile)
+        t.getCSVData()
+        self.assertTrue(t.CSVDataIsValid)
+        self.assertTrue(t._csv_data is None)
+        # data containing the value separator falls back to one XPath per value
+        mark = t.XMLTree.find(".//{*}MarkVerbalElementText")
+        mark.text = u"PY\ue000THON"
+        t.getTSDRData()
+        self.assertEqual(t.TSDRData.TSDRSingle["MarkVerbalElementText"], "PYTHON")
+        t.getCSVData()
+        t.getTSDRData()
+        self.assertEqual(t.TSDRData.TSDRSingle["MarkVerbalElementText"], u"PY\ue000THON")
+        self.assertEqual(t.TSDRData.TSDRSingle["ApplicationNumber"], "76044902")
+        # a root element the transform doesn't match
+        t.setPTOFormat("ST96")
+        t.getCSVData()
+        self.assertFalse(t.CSVDataIsValid)
+        self.assertEqual(t.ErrorCode, "CSV-ShortCSV")
+        # caller-supplied XSLT is always run as XSLT
+        with open(os.path.join(self.TESTFILES_DIR, "appno+pubdate.xsl")) as f:
+            t.setXSLT(f.read())
+        t.getTSDRInfo(testfile)
+        self.assertTrue(t.TSDRData.TSDRMapIsValid)
+        self.assertEqual(len(t.TSDRData.TSDRSingle), 2)
+        t.reset()
+        self.assertEqual(t.Engine, "XSLT")
+
+    # Group J
+    # Field projection
+
+    PROJECTION = ["MarkCurrentStatusExternalDescriptionText", "MarkCurrentStatusDate",
+                  "RegistrationNumber", "ApplicantList", "MarkEventList", "NoSuchField"]
+
+    def test_J001_projection_with_each_engine(self):
+        for name in ["sn76044902.zip", "rn2178784-ST-962.2.1.xml"]:
+            testfile = os.path.join(self.TESTFILES_DIR, name)
+            t = plumage.TSDRReq()
+            t.getTSDRInfo(testfile)
+            full = t.TSDRData
+            expected_single = dict((key, value) for key, value in full.TSDRSingle.items()
+                                   if key in self.PROJECTION)
+            expected_multi = dict((key, value) for key, value in full.TSDRMulti.items()
+                                  if key in self.PROJECTION)
+            self.assertEqual(len(expected_single), 3)
+            self.assertEqual(sorted(expected_multi), ["ApplicantList", "MarkEventList"])
+            for engine in ["XSLT", "XPath"]:
+                t = plumage.TSDRReq()
+                t.setEngine(engine)
+                t.setProjection(self.PROJECTION)
+                t.getTSDRInfo(testfile)
+                self.assertTrue(t.TSDRData.TSDRMapIsValid, (name, engine))
+                self.assertEqual(t.TSDRData.TSDRSingle, expected_single, (name, engine))
+                self.assertEqual(t.TSDRData.TSDRMulti, expected_multi, (name, engine))
+
+    def test_J002_XPath_engine_evaluates_only_projected_fields(self):
+        t = plumage.TSDRReq()
+        t.setEngine("XPath")
+        t.setProjection(["RegistrationNumber", "AssignmentList"])
+        t.getXMLData(os.path.join(self.TESTFILES_DIR, "sn76044902.xml"))
+        t.getCSVData()
+        self.assertTrue(t.CSVDataIsValid)
+        keys = set(key for key, value in t._csv_fields)
+        self.assertEqual(keys, set(["RegistrationNumber", "BeginRepeatedField", "EndRepeatedField",
+                                    "AssignmentIdentifier", "AssignmentConveyanceCategory",
+                                    "AssignmentGroupCategory", "AssignmentRecordedDate",
+                                    "AssignmentRecordedDateTruncated", "AssignmentExecutedDate",
+                                    "AssignmentExecutedDateTruncated", "AssignorEntityName",
+                                    "AssigneeEntityName", "AssignmentDocumentURL"]))
+        self.assertTrue(t.CSVData.startswith('RegistrationNumber,"2824281"\n'))
+        t.getTSDRData()
+        self.assertEqual(t.TSDRData.TSDRSingle, {"RegistrationNumber" : "2824281"})
+        self.assertEqual(list(t.TSDRData.TSDRMulti), ["AssignmentList"])
+        # one field is enough for a valid map; none, if the mark doesn't have it
+        t.setProjection(["InternationalRegistrationNumber"])
+        t.getCSVData()
+        t.getTSDRData()
+        self.assertTrue(t.TSDRData.TSDRMapIsValid)
+        self.assertEqual(t.TSDRData.TSDRSingle, {})
+
+    def test_J003_projection_setting(self):
+        t = plumage.TSDRReq()
+        self.assertTrue(t.Projection is None)
+        self.assertRaises(ValueError, t.setProjection, "RegistrationNumber")
+        t.setProjection(("RegistrationNumber",))
+        self.assertEqual(t.Projection, frozenset(["RegistrationNumber"]))
+        projected_key = t._mapCacheKey("76044902", "s")
+        t.unsetProjection()
+        self.assertNotEqual(t._mapCacheKey("76044902", "s"), projected_key)
+        t.setProjection([])
+        t.reset()
+        self.assertTrue(t.Projection is None)
+
+    # Group K
+    # Retention ("lean": only the TSDR map is kept)
+
+    def test_K001_lean_retention(self):
+        testfile = os.path.join(self.TESTFILES_DIR, "sn76044902.zip")
+        full = plumage.TSDRReq()
+        full.getTSDRInfo(testfile)
+        t = plumage.TSDRReq()
+        t.setRetention("lean")
+        t.getTSDRInfo(testfile)
+        self.assertTrue(t.TSDRData.TSDRMapIsValid)
+        self.assertEqual(t.TSDRData.TSDRMulti, full.TSDRData.TSDRMulti)
+        for retained in [t.XMLData, t.XMLTree, t.CSVData, t.ZipData, t.ImageFull]:
+            self.assertTrue(retained is None)
+        with open(testfile, "rb") as f:
+            self.assertEqual(t.PayloadDigest, hashlib.sha256(f.read()).hexdigest())
+        self.assertTrue(full.PayloadDigest is None)
+        # nothing left for a further step
+        t.getCSVData()
+        self.assertEqual(t.ErrorCode, "CSV-NoValidXML")
+        # the step-by-step methods keep what they produce
+        t.getXMLData(testfile)
+        t.getCSVData()
+        self.assertTrue(t.XMLData.startswith("<?xml"))
+        self.assertTrue(t.CSVDataIsValid)
+        self.assertEqual(len(t.CSVData.split("\n")), 291)
+        self.assertRaises(ValueError, t.setRetention, "none")
+        t.reset()
+        self.assertEqual(t.Retention, "full")
+
+    @unittest.skipIf(tracemalloc is None, "needs tracemalloc (Python 3)")
+    def test_K002_lean_retention_memory(self):
+        '''
+        With "lean" retention, the memory retained per record is about that of its
+        TSDR map alone; the peak while building it is no more than with "full"
+        '''
+        testfile = os.path.join(self.TESTFILES_DIR, "sn76044902.zip")
+        records = 20
+        plumage.TSDRReq().getTSDRInfo(testfile)    # warm up: compile the transform, etc.
+
+        def measure(retention):
+            # memory retained per record (over records records, all kept), and peak for one
+            kept = []
+            tracemalloc.start()
+            try:
+                for _ in range(records):
+                    t = plumage.TSDRReq()
+                    t.setRetention(retention)
+                    t.getTSDRInfo(testfile)
+                    self.assertTrue(t.TSDRData.TSDRMapIsValid)
+                    kept.append(t)
+                retained = tracemalloc.get_traced_memory()[0] / records
+            finally:
+                tracemalloc.stop()
+            tracemalloc.start()
+            try:
+                t = plumage.TSDRReq()
+                t.setRetention(retention)
+                t.getTSDRInfo(testfile)
+                peak = tracemalloc.get_traced_memory()[1]
+            finally:
+                tracemalloc.stop()
+            return retained, peak
+
+        def map_size(t):
+            # memory of a TSDR map alone (an unpickled copy has strings of its own)
+            pickled = pickle.dumps(t.TSDRData)
+            tracemalloc.start()
+            try:
+                maps = [pickle.loads(pickled) for _ in range(records)]
+                return tracemalloc.get_traced_memory()[0] / records
+            finally:
+                tracemalloc.stop()
+
+        t = plumage.TSDRReq()
+        t.getTSDRInfo(testfile)
+        tsdr_map = map_size(t)
+        full_retained, full_peak = measure("full")
+        lean_retained, lean_peak = measure("lean")
+        self.assertTrue(lean_retained < 1.25 * tsdr_map, (lean_retained, tsdr_map))
+        self.assertTrue(full_retained > 2 * tsdr_map, (full_retained, tsdr_map))
+        # the peak is the zip file, the XML and the CSV lines being mapped, at most
+        self.assertTrue(lean_peak <= 1.1 * full_peak, (lean_peak, full_peak))
+        self.assertTrue(lean_peak < 6 * len(t.XMLData), (lean_peak, len(t.XMLData)))
+
+    # Group L
+    # Compact maps (shared key schemas; read-only records and record lists)
+
+    def test_L001_compact_maps(self):
+        t = plumage.TSDRReq()
+        t.getTSDRInfo(os.path.join(self.TESTFILES_DIR, "sn76044902.zip"))
+        compact = t.TSDRData.compact()
+        self.assertTrue(compact.TSDRMapIsValid)
+        # read, and compare, as dictionaries and lists
+        single, multi = compact.TSDRSingle, compact.TSDRMulti
+        self.assertEqual(single, t.TSDRData.TSDRSingle)
+        self.assertEqual(t.TSDRData.TSDRMulti, multi)
+        self.assertEqual(single["ApplicationNumber"], "76044902")
+        self.assertEqual(single.get("NoSuchField", "none"), "none")
+        self.assertRaises(KeyError, lambda: single["NoSuchField"])
+        self.assertEqual(list(single), list(t.TSDRData.TSDRSingle))
+        events = multi["MarkEventList"]
+        self.assertTrue(isinstance(events, plumage.TSDRRecordList))
+        self.assertEqual(len(events), 31)
+        self.assertEqual(events[0]["MarkEventEntryNumber"], "31")
+        self.assertEqual(events[-1], t.TSDRData.TSDRMulti["MarkEventList"][-1])
+        self.assertEqual(events[1:3], t.TSDRData.TSDRMulti["MarkEventList"][1:3])
+        self.assertRaises(IndexError, lambda: events[31])
+        self.assertNotEqual(events, t.TSDRData.TSDRMulti["ApplicantList"])
+        # read-only
+        def change():
+            single["ApplicationNumber"] = "1"
+        self.assertRaises(TypeError, change)
+        # keys are kept once: records with the same keys share them
+        other = plumage.TSDRReq()
+        other.getTSDRInfo(os.path.join(self.TESTFILES_DIR, "sn76044902.xml"))
+        other_compact = other.TSDRData.compact()
+        self.assertTrue(other_compact.TSDRSingle._schema is single._schema)
+        self.assertTrue(events[0]._schema is events[1]._schema)
+        # entries without the same keys: a list of records
+        mixed = plumage.TSDRMap()
+        mixed.TSDRSingle, mixed.TSDRMulti = {"A" : "1"}, {"XList" : [{"B" : "2"}, {"C" : "3"}]}
+        self.assertEqual(mixed.compact().TSDRMulti, {"XList" : [{"B" : "2"}, {"C" : "3"}]})
+        # copies and pickles
+        self.assertTrue(compact.copy().TSDRSingle is single)
+        self.assertEqual(compact.copy().TSDRMulti, multi)
+        unpickled = pickle.loads(pickle.dumps(compact, 2))
+        self.assertEqual(unpickled.TSDRSingle, single)
+        self.assertTrue(unpickled.TSDRSingle._schema is single._schema)
+        self.assertEqual(unpickled.TSDRMulti, multi)
+
+    def test_L002_compact_maps_setting(self):
+        testfile = os.path.join(self.TESTFILES_DIR, "sn76044902.zip")
+        reference = plumage.TSDRReq()
+        reference.getTSDRInfo(testfile)
+        t = plumage.TSDRReq()
+        self.assertFalse(t.CompactMaps)
+        t.setCompactMaps(True)
+        t.getTSDRInfo(testfile)
+        self.assertTrue(isinstance(t.TSDRData.TSDRSingle, plumage.TSDRRecord))
+        self.assertEqual(t.TSDRData.TSDRSingle, reference.TSDRData.TSDRSingle)
+        self.assertEqual(t.TSDRData.TSDRMulti, reference.TSDRData.TSDRMulti)
+        t.getTSDRInfoStreamed(testfile)
+        self.assertTrue(isinstance(t.TSDRData.TSDRMulti["MarkEventList"], plumage.TSDRRecordList))
+        self.assertEqual(t.TSDRData.TSDRMulti, reference.TSDRData.TSDRMulti)
+        self.assertRaises(ValueError, t.setCompactMaps, "yes")
+        t.reset()
+        self.assertFalse(t.CompactMaps)
+
+    @unittest.skipIf(tracemalloc is None, "needs tracemalloc (Python 3)")
+    def test_L003_compact_maps_memory(self):
+        '''
+        A compact map holds well under half the memory of the same map as
+        dictionaries and lists (see bench_map_memory.py)
+        '''
+        t = plumage.TSDRReq()
+        t.getXMLData(os.path.join(self.TESTFILES_DIR, "sn76044902.xml"))
+        t.getCSVData()
+        records = 50
+
+        def held(compact):
+            t.setCompactMaps(compact)
+            kept = []
+            tracemalloc.start()
+            try:
+                for _ in range(records):
+                    t.getTSDRData()
+                    kept.append(t.TSDRData)
+                t.resetTSDRData()
+                return tracemalloc.get_traced_memory()[0] / records
+            finally:
+                tracemalloc.stop()
+
+        dict_bytes, compact_bytes = held(False), held(True)
+        self.assertTrue(compact_bytes < 0.5 * dict_bytes, (compact_bytes, dict_bytes))
+
+    # Group M
+    # Stage timings
+
+    def test_M001_record_timings(self):
+        t = plumage.TSDRReq()
+        self.assertFalse(t.RecordTimings)
+        t.getTSDRInfo(os.path.join(self.TESTFILES_DIR, "sn76044902.zip"))
+        self.assertEqual(t.Timings, {})
+        t.setRecordTimings(True)
+        t.getTSDRInfo(os.path.join(self.TESTFILES_DIR, "sn76044902.zip"))
+        self.assertEqual(list(t.Timings), ["read", "unzip", "parse", "transform", "validate", "map"])
+        for stage, timing in t.Timings.items():
+            self.assertTrue(timing.seconds >= 0, stage)
+        self.assertEqual(t.Timings["read"].bytes, len(t.ZipData))
+        self.assertEqual(t.Timings["unzip"].bytes, len(t.XMLData))
+        self.assertEqual(t.Timings["parse"].bytes, len(t.XMLData))
+        self.assertTrue(t.Timings["transform"].bytes > 0)
+        self.assertEqual(t.Timings["map"].bytes, None)
+        # substitution only for an XSLT that needs it (a placeholder in an attribute)
+        with open(os.path.join(self.TESTFILES_DIR, "appno+pubdate.xsl")) as f:
+            altXSL = f.read()
+        extra_lines = '\nDiagnosticInfoXMLSource,"<xsl:value-of select="\'$XMLSOURCE$\'"/>"<xsl:text/></xsl:template>'
+        t.setXSLT(altXSL.replace("</xsl:template>\n</xsl:stylesheet>", extra_lines + "\n</xsl:stylesheet>"))
+        t.getTSDRInfo(os.path.join(self.TESTFILES_DIR, "sn76044902.zip"))
+        self.assertEqual(list(t.Timings), ["read", "unzip", "parse", "transform", "substitute",
+                                           "validate", "map"])
+        self.assertTrue(t.Timings["substitute"].bytes > t.Timings["transform"].bytes)
+        t.unsetXSLT()
+        # stage by stage
+        t.getXMLData(os.path.join(self.TESTFILES_DIR, "sn76044902.xml"))
+        self.assertEqual(list(t.Timings), ["read", "parse"])
+        t.getCSVData()
+        t.getTSDRData()
+        self.assertEqual(list(t.Timings)[-1], "map")
+        # the XPath engine
+        t.setEngine("XPath")
+        t.getTSDRInfo(os.path.join(self.TESTFILES_DIR, "rn2178784-ST-962.2.1.xml"))
+        self.assertEqual(list(t.Timings), ["read", "parse", "transform", "validate", "map"])
+        self.assertRaises(ValueError, t.setRecordTimings, "yes")
+        t.reset()
+        self.assertFalse(t.RecordTimings)
+
+    def test_M002_timing_aggregator(self):
+        aggregator = plumage.TSDRTimingAggregator(sample_size=100)
+        for n in range(1, 1001):
+            aggregator.add("parse", n / 1000.0, 10)
+        aggregator.add("map", 0.5)
+        self.assertEqual(aggregator.stages(), ["parse", "map"])
+        summary = aggregator.summary()
+        self.assertEqual(summary["parse"]["count"], 1000)
+        self.assertEqual(summary["parse"]["bytes"], 10000)
+        self.assertAlmostEqual(summary["parse"]["mean"], 0.5005)
+        self.assertEqual(summary["map"]["p99"], 0.5)
+        # percentiles of a sample (of 100 of the 1000): close, not exact
+        self.assertTrue(0.3 < aggregator.percentile("parse", 50) < 0.7)
+        self.assertTrue(aggregator.percentile("parse", 0) <= aggregator.percentile("parse", 100))
+        self.assertRaises(KeyError, aggregator.percentile, "fetch", 50)
+        self.assertRaises(ValueError, aggregator.percentile, "parse", 101)
+        self.assertRaises(ValueError, plumage.TSDRTimingAggregator, sample_size=0)
+        aggregator.reset()
+        self.assertEqual(aggregator.summary(), {})
+        # process-wide: every TSDRReq's stages, whether set to record timings or not
+        self.assertEqual(plumage.timingAggregator(), None)
+        plumage.setTimingAggregator(aggregator)
+        try:
+            for _ in range(3):
+                t = plumage.TSDRReq()
+                t.getTSDRInfo(os.path.join(self.TESTFILES_DIR, "sn76044902.zip"))
+            self.assertEqual(aggregator.summary()["map"]["count"], 3)
+            self.assertEqual(aggregator.summary()["unzip"]["bytes"], 3 * len(t.XMLData))
+            self.assertEqual(list(t.Timings), aggregator.stages())
+        finally:
+            plumage.setTimingAggregator(None)
+        t.getTSDRInfo(os.path.join(self.TESTFILES_DIR, "sn76044902.zip"))
+        self.assertEqual(t.Timings, {})
+        self.assertEqual(aggregator.summary()["map"]["count"], 3)
+
 if __name__ == '__main__':
     unittest.main(verbosity=2)
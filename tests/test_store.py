@@ -0,0 +1,142 @@
+import datetime
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+PYTHON2 = sys.version_info.major == 2
+PYTHON3 = sys.version_info.major == 3
+
+from testing_context import plumage
+from Plumage import batch
+from Plumage import store
+
+TESTFILE_DIR = "testfiles"
+ST66_TESTFILE = os.path.join(TESTFILE_DIR, "sn76044902.zip")
+ST96_TESTFILE = os.path.join(TESTFILE_DIR, "rn2178784-ST-962.2.1.xml")
+
+class TestUM(unittest.TestCase):
+
+    # Group DB: SQLite store of TSDR maps
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.database = os.path.join(self.tempdir, "portfolio.db")
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def _request(self, testfile, projection=None):
+        t = plumage.TSDRReq()
+        t.setProjection(projection)
+        t.getTSDRInfo(testfile)
+        return t
+
+    def test_DB001_round_trip(self):
+        requests = [self._request(ST66_TESTFILE), self._request(ST96_TESTFILE)]
+        with store.TSDRStore(self.database) as s:
+            self.assertEqual(s.storeMany(requests), 2)
+        # and still there, once reopened
+        with store.TSDRStore(self.database) as s:
+            self.assertEqual(s.query("PRAGMA journal_mode"), [("wal",)])
+            for t in requests:
+                tsdrmap = s.getTSDRMap(t.TSDRData.TSDRSingle["ApplicationNumber"])
+                self.assertTrue(tsdrmap.TSDRMapIsValid)
+                self.assertEqual(tsdrmap.TSDRSingle, t.TSDRData.TSDRSingle)
+                self.assertEqual(tsdrmap.TSDRMulti, t.TSDRData.TSDRMulti)
+            self.assertEqual(s.getTSDRMap("99999999"), None)
+            self.assertEqual(s.query("SELECT COUNT(*) FROM MarkEventList"), [(31 + 33,)])
+
+    def test_DB002_upsert_by_application_number(self):
+        t = self._request(ST66_TESTFILE)
+        s = store.TSDRStore(self.database, batch_size=2)
+        s.store(t)
+        changed = t.TSDRData.copy()
+        changed.TSDRSingle["MarkCurrentStatusExternalDescriptionText"] = "Cancelled"
+        del changed.TSDRSingle["StaffName"]
+        changed.TSDRMulti["MarkEventList"] = changed.TSDRMulti["MarkEventList"][:2]
+        del changed.TSDRMulti["AssignmentList"]
+        s.store(changed)
+        self.assertEqual(s.query("SELECT COUNT(*) FROM Marks"), [(1,)])
+        tsdrmap = s.getTSDRMap("76044902")
+        self.assertEqual(tsdrmap.TSDRSingle, changed.TSDRSingle)
+        self.assertEqual(tsdrmap.TSDRMulti, changed.TSDRMulti)
+        # within a batch, the last map for an application number is the one kept;
+        # maps not valid are skipped
+        self.assertEqual(s.storeMany([t.TSDRData, plumage.TSDRMap(), changed, t]), 3)
+        self.assertEqual(s.getTSDRMap("76044902").TSDRMulti, t.TSDRData.TSDRMulti)
+        s.close()
+
+    def test_DB003_indexed_queries(self):
+        s = store.TSDRStore(":memory:")
+        self.assertEqual(s.marksWithEventsSince("2000-01-01"), [])
+        s.storeMany([self._request(ST66_TESTFILE), self._request(ST96_TESTFILE)])
+        self.assertEqual(s.marksWithEventsSince("2010-09-01"), ["74631225", "76044902"])
+        self.assertEqual(s.marksWithEventsSince(datetime.date(2011, 1, 1)), ["74631225"])
+        self.assertEqual(s.marksWithEventsSince("2012-01-01"), [])
+        self.assertEqual(s.marksWithStatusSince("2009-01-01"), ["76044902"])
+        self.assertEqual(s.query("SELECT ApplicationNumber FROM Marks WHERE RegistrationNumber = ?",
+                                 ("2178784",)), [("74631225",)])
+        for sql, index in [
+                ("SELECT ApplicationNumber FROM MarkEventList WHERE MarkEventDateTruncated >= ?",
+                 "MarkEventList_MarkEventDateTruncated"),
+                ("SELECT ApplicationNumber FROM Marks WHERE MarkCurrentStatusDateTruncated >= ?",
+                 "Marks_MarkCurrentStatusDateTruncated"),
+                ("SELECT ApplicationNumber FROM Marks WHERE RegistrationNumber = ?",
+                 "Marks_RegistrationNumber")]:
+            plan = " ".join(str(row[-1]) for row in s.query("EXPLAIN QUERY PLAN " + sql, ("x",)))
+            self.assertTrue(index in plan, plan)
+        s.close()
+
+    def test_DB004_fields_and_errors(self):
+        s = store.TSDRStore(":memory:")
+        # a projection: only some columns; tables only for the lists present
+        t = self._request(ST66_TESTFILE, projection=["ApplicationNumber", "MarkVerbalElementText",
+                                                     "ApplicantList"])
+        s.store(t)
+        tsdrmap = s.getTSDRMap("76044902")
+        self.assertEqual(tsdrmap.TSDRSingle, {"ApplicationNumber" : "76044902",
+                                              "MarkVerbalElementText" : "PYTHON"})
+        self.assertEqual(list(tsdrmap.TSDRMulti), ["ApplicantList"])
+        # new fields become new columns
+        t = self._request(ST96_TESTFILE)
+        s.store(t)
+        self.assertEqual(s.getTSDRMap("74631225").TSDRSingle, t.TSDRData.TSDRSingle)
+        # a map without an application number cannot be stored
+        t = self._request(ST66_TESTFILE, projection=["MarkVerbalElementText"])
+        self.assertRaises(ValueError, s.store, t)
+        bad = plumage.TSDRMap()
+        bad.TSDRSingle, bad.TSDRMulti, bad.TSDRMapIsValid = {"ApplicationNumber" : "1", "Bad-Key" : ""}, {}, True
+        self.assertRaises(ValueError, s.store, bad)
+        self.assertEqual(s.getTSDRMap("1"), None)
+        self.assertRaises(ValueError, store.TSDRStore, ":memory:", batch_size=0)
+        s.close()
+
+    def test_DB005_reprocessor_sink(self):
+        s = store.TSDRStore(self.database)
+        r = batch.TSDRReprocessor(workers=1)
+        # the ST.96 1_D3 test file is not supported, and so not stored
+        self.assertEqual(r.reprocessTo(TESTFILE_DIR, s, chunk_size=2), 4)
+        self.assertEqual(sorted(row[0] for row in s.query("SELECT ApplicationNumber FROM Marks")),
+                         ["74631225", "76044902"])
+        s.close()
+
+    def test_DB006_other_tables_left_alone(self):
+        '''
+        Tables that are not the store's own (a caller's, say) are neither
+        written to nor read as TSDRMulti lists
+        '''
+        t = self._request(ST66_TESTFILE)
+        s = store.TSDRStore(self.database)
+        s.query("CREATE TABLE Notes (x TEXT)")
+        s.query("CREATE TABLE Reviews (ApplicationNumber TEXT, Reviewer TEXT)")
+        s.store(t)
+        s.close()
+        with store.TSDRStore(self.database) as s:
+            s.store(t)
+            tsdrmap = s.getTSDRMap("76044902")
+            self.assertEqual(tsdrmap.TSDRMulti, t.TSDRData.TSDRMulti)
+            self.assertEqual(s.query("SELECT COUNT(*) FROM Notes"), [(0,)])
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
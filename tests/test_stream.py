@@ -0,0 +1,175 @@
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+PYTHON2 = sys.version_info.major == 2
+PYTHON3 = sys.version_info.major == 3
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+from testing_context import plumage
+from large_tsdr import writeLargeTSDR
+from pto_standin import PTOStandIn
+
+TESTFILE_DIR = "testfiles"
+ST66_TESTFILE = os.path.join(TESTFILE_DIR, "sn76044902.xml")
+ZIP_TESTFILE = os.path.join(TESTFILE_DIR, "sn76044902.zip")
+ST96_TESTFILE = os.path.join(TESTFILE_DIR, "rn2178784-ST-962.2.1.xml")
+ST96_1_D3_TESTFILE = os.path.join(TESTFILE_DIR, "rn2178784-ST-961_D3.xml")
+
+# Peak memory (resident set size) of a child process that streams, or loads, a document
+MEMORY_PROBE = '''
+import resource, sys
+from testing_context import plumage
+t = plumage.TSDRReq()
+if sys.argv[1] == "streamed":
+    t.getTSDRInfoStreamed(sys.argv[2], callback=lambda list_name, entry: None)
+else:
+    t.getTSDRInfo(sys.argv[2])
+assert t.TSDRData.TSDRMapIsValid
+print(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+'''
+
+class TestUM(unittest.TestCase):
+
+    # Group S: Streaming (iterparse) mode
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def _maps(self, t):
+        tsdr_single = dict(t.TSDRData.TSDRSingle)
+        del tsdr_single["DiagnosticInfoExecutionDateTime"]
+        return tsdr_single, t.TSDRData.TSDRMulti
+
+    def _large_file(self, mark_events, assignments=None):
+        filename = os.path.join(self.tempdir, "large%s.xml" % mark_events)
+        with open(filename, "wb") as f:
+            writeLargeTSDR(f, mark_events, assignments)
+        return filename
+
+    def test_S001_same_map_as_getTSDRInfo(self):
+        for testfile in [ST66_TESTFILE, ZIP_TESTFILE, ST96_TESTFILE]:
+            t = plumage.TSDRReq()
+            t.getTSDRInfo(testfile)
+            s = plumage.TSDRReq()
+            s.getTSDRInfoStreamed(testfile)
+            self.assertTrue(s.TSDRData.TSDRMapIsValid, testfile)
+            self.assertEqual(self._maps(s), self._maps(t))
+            self.assertTrue(s.XMLDataIsValid)
+            self.assertEqual(s.XMLData, None)
+            self.assertEqual(s.XMLTree, None)
+        # images are still taken from a zip file
+        self.assertTrue(s.ImageThumb is None)
+        s.getTSDRInfoStreamed(ZIP_TESTFILE)
+        self.assertEqual(s.ImageThumb[6:10], b"JFIF")
+        # and the local zip file is only read in full if asked for
+        self.assertEqual(s._zip_data, None)
+        with open(ZIP_TESTFILE, "rb") as f:
+            self.assertEqual(s.ZipData, f.read())
+
+    def test_S002_iter_and_callback(self):
+        t = plumage.TSDRReq()
+        items = list(t.iterTSDRInfo(ST96_TESTFILE))
+        self.assertTrue(t.TSDRData.TSDRMapIsValid)
+        self.assertEqual(t.TSDRData.TSDRMulti, {})
+        single = dict((name, value) for name, value in items if not isinstance(value, dict))
+        self.assertEqual(single, t.TSDRData.TSDRSingle)
+        self.assertEqual(single["ApplicationNumber"], "74631225")
+        events = [value for name, value in items if name == "MarkEventList"]
+        self.assertEqual(len(events), 33)
+        self.assertEqual(events[0]["MarkEventEntryNumber"], "33")
+        received = []
+        t.getTSDRInfoStreamed(ST96_TESTFILE, callback=lambda name, entry: received.append(name))
+        self.assertEqual(t.TSDRData.TSDRMulti, {})
+        self.assertEqual(received.count("MarkEventList"), 33)
+        self.assertEqual(received.count("ApplicantList"), 4)
+
+    def test_S003_projection(self):
+        t = plumage.TSDRReq()
+        t.setProjection(["ApplicationNumber", "MarkEventList"])
+        t.getTSDRInfoStreamed(ST66_TESTFILE)
+        self.assertTrue(t.TSDRData.TSDRMapIsValid)
+        self.assertEqual(t.TSDRData.TSDRSingle, {"ApplicationNumber": "76044902"})
+        self.assertEqual(list(t.TSDRData.TSDRMulti), ["MarkEventList"])
+        self.assertEqual(len(t.TSDRData.TSDRMulti["MarkEventList"]), 31)
+
+    def test_S004_errors(self):
+        t = plumage.TSDRReq()
+        t.getTSDRInfoStreamed(ST96_1_D3_TESTFILE)
+        self.assertFalse(t.TSDRData.TSDRMapIsValid)
+        self.assertEqual(t.ErrorCode, "CSV-UnsupportedXML")
+        self.assertEqual(t.ErrorMessage, "Unsupported XML format found: ST96-1_D3")
+        t.setPTOFormat("ST96")
+        t.getTSDRInfoStreamed(ST66_TESTFILE)
+        self.assertEqual(t.ErrorCode, "CSV-ShortCSV")
+        t.unsetPTOFormat()
+        filename = os.path.join(self.tempdir, "truncated.xml")
+        with open(ST66_TESTFILE, "rb") as f:
+            data = f.read()
+        with open(filename, "wb") as f:
+            f.write(data[:len(data)//2])
+        t.getTSDRInfoStreamed(filename)
+        self.assertFalse(t.XMLDataIsValid)
+        self.assertFalse(t.TSDRData.TSDRMapIsValid)
+        self.assertEqual(t.ErrorCode, "XML-NoValidXML")
+        t.setXSLTFile(os.path.join(TESTFILE_DIR, "appno+pubdate.xsl"))
+        self.assertRaises(ValueError, t.iterTSDRInfo, ST66_TESTFILE)
+
+    def test_S005_from_PTO(self):
+        standin = PTOStandIn().start()
+        saved_url_templates = plumage._pto_url_templates
+        plumage._pto_url_templates = standin.url_templates()
+        try:
+            t = plumage.TSDRReq()
+            t.getTSDRInfoStreamed("76044902", "s")
+            self.assertTrue(t.TSDRData.TSDRMapIsValid)
+            self.assertEqual(len(t.TSDRData.TSDRMulti["MarkEventList"]), 31)
+            self.assertTrue(t.ZipData is not None)
+            t.setPTOFormat("ST96")
+            t.getTSDRInfoStreamed("2178784", "r")
+            self.assertTrue(t.TSDRData.TSDRMapIsValid)
+            self.assertEqual(t.TSDRData.TSDRSingle["DiagnosticInfoXSLTFormat"], "ST.96")
+            t.getTSDRInfoStreamed("9999999", "r")
+            self.assertEqual(t.ErrorCode, "Fetch-404")
+        finally:
+            plumage._pto_url_templates = saved_url_templates
+            standin.stop()
+
+    def test_S006_large_document(self):
+        filename = self._large_file(2000, assignments=500)
+        t = plumage.TSDRReq()
+        t.getTSDRInfo(filename)
+        s = plumage.TSDRReq()
+        s.getTSDRInfoStreamed(filename)
+        self.assertEqual(self._maps(s), self._maps(t))
+        events = s.TSDRData.TSDRMulti["MarkEventList"]
+        self.assertEqual([event["MarkEventEntryNumber"] for event in events],
+                         [str(n+1) for n in range(2000)])
+        self.assertEqual(len(s.TSDRData.TSDRMulti["AssignmentList"]), 500)
+
+    @unittest.skipIf(resource is None, "needs the resource module (Unix)")
+    def test_S007_memory_flat(self):
+        '''
+        Peak memory streaming a document with 40,000 mark events is roughly that of
+        one with 2,000; loading the larger one whole takes far more
+        '''
+        def peak(mode, filename):
+            output = subprocess.check_output([sys.executable, "-c", MEMORY_PROBE, mode, filename],
+                                             cwd=os.path.dirname(os.path.abspath(__file__)))
+            return int(output.split()[-1])
+        small, large = self._large_file(2000), self._large_file(40000)
+        streamed_growth = peak("streamed", large) - peak("streamed", small)
+        loaded_growth = peak("loaded", large) - peak("loaded", small)
+        self.assertTrue(streamed_growth < loaded_growth / 10, (streamed_growth, loaded_growth))
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)